@@ -0,0 +1,383 @@
+# -- coding: utf-8 --
+"""
+HTTP API for machine clients (e.g. an EHR) running the Streamlit app's pipeline.
+
+Usage:
+    python -m api --port 8000 --workers 4
+    uvicorn api:api --port 8000 --workers 4
+
+Endpoints (multipart/form-data with an "audio" file, or a "transcription"
+field; JSON bodies with a "transcription" are accepted too):
+
+    POST /v1/transcriptions   audio -> transcript
+    POST /v1/assessments      audio or transcription [+ history PDF, patient, encounter_id,
+                              consolidated, doctor_name] -> Clinical Assessment
+    POST /v1/prescriptions    audio or transcription [+ encounter_id, doctor_name] -> prescription
+    GET  /health
+
+Every request runs as a job on the app's job manager with the same
+functions as the UI (run_assessment_job, run_prescription_job), so results
+are saved to the encounter store and identical concurrent requests share one
+job. The response format is chosen with ?format= or the Accept header:
+
+    json (default)    waits for the job and returns all stage results
+    sse               text/event-stream: "stage" events as each stage finishes,
+                      "partial" events with streamed output, then "done"
+    pdf               application/pdf: the assessment report or prescription
+
+With ?pdf=1 the json body and the "done" event also carry the PDF, base64
+encoded. No PDF is rendered when a stage it covers failed: format=pdf then
+answers 422 with the stage errors, and ?pdf=1 adds "pdf_error" instead. Set ECHO_MED_API_TOKEN to require "Authorization: Bearer <token>".
+
+Each worker process has its own job pool and OpenAI rate limiter, so set
+ECHO_MED_OPENAI_RPM/TPM to the account limits divided by the worker count.
+"""
+import argparse
+import asyncio
+import base64
+import hmac
+import json
+import os
+import time
+
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.requests import Request
+from starlette.responses import Response, StreamingResponse
+from starlette.routing import Route
+from streamlit.config import set_option
+from streamlit.logger import set_log_level
+
+import app
+from ipd_form import json_default
+from jobs import DONE, FAILED
+
+# Bearer token clients must send ("" leaves the API open, e.g. behind an authenticating proxy)
+API_TOKEN = os.getenv("ECHO_MED_API_TOKEN", "")
+
+# Largest accepted request body (audio plus history PDF)
+API_MAX_UPLOAD_MB = float(os.getenv("ECHO_MED_API_MAX_UPLOAD_MB", "100"))
+
+# How often waiting requests and event streams check their job
+API_POLL_SECONDS = float(os.getenv("ECHO_MED_API_POLL_SECONDS", "0.2"))
+
+# Comment line sent on idle event streams so proxies keep the connection open
+SSE_KEEPALIVE_SECONDS = 15
+
+# The pipeline reports problems through st.error; outside a browser session
+# Streamlit only logs context warnings, so keep the server log readable
+set_option("global.showWarningOnDirectExecution", False)
+set_log_level("error")
+
+
+class APIError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def json_response(data, status=200):
+    # Stage results may hold IPD forms, which the standard encoder cannot serialize
+    return Response(json.dumps(data, ensure_ascii=False, default=json_default), status_code=status, media_type="application/json")
+
+
+def is_true(value):
+    return str(value or "").lower() in ("1", "true", "yes")
+
+
+def check_token(request):
+    if not API_TOKEN:
+        return
+    scheme, _, token = request.headers.get("authorization", "").partition(" ")
+    if scheme.lower() != "bearer" or not hmac.compare_digest(token.encode(), API_TOKEN.encode()):
+        raise APIError(401, "Missing or invalid bearer token")
+
+
+async def read_body(request, max_bytes):
+    """
+    Reads the whole body, counting bytes as they arrive, and returns a request replaying it.
+
+    Content-Length is checked first, but chunked bodies have none, so the
+    limit is enforced on the stream itself.
+
+    Raises:
+        APIError: For a body over max_bytes
+    """
+    too_large = APIError(413, f"Request body is larger than {API_MAX_UPLOAD_MB:g} MB")
+    if int(request.headers.get("content-length") or 0) > max_bytes:
+        raise too_large
+    chunks = []
+    size = 0
+    async for chunk in request.stream():
+        size += len(chunk)
+        if size > max_bytes:
+            raise too_large
+        chunks.append(chunk)
+    body = b"".join(chunks)
+
+    async def receive():
+        return {"type": "http.request", "body": body, "more_body": False}
+
+    return Request(request.scope, receive)
+
+
+async def read_inputs(request):
+    """
+    Returns the request's fields; uploaded files ("audio", "history") as bytes.
+
+    Raises:
+        APIError: For a body over ECHO_MED_API_MAX_UPLOAD_MB or an unreadable one
+    """
+    max_bytes = int(API_MAX_UPLOAD_MB * 1024 * 1024)
+    request = await read_body(request, max_bytes)
+
+    content_type = request.headers.get("content-type", "")
+    if content_type.startswith("application/json"):
+        try:
+            body = await request.json()
+        except ValueError:
+            raise APIError(400, "Invalid JSON body")
+        if not isinstance(body, dict):
+            raise APIError(400, "The JSON body must be an object")
+        return body
+    if not content_type.startswith(("multipart/form-data", "application/x-www-form-urlencoded")):
+        raise APIError(415, "Send multipart/form-data (with an audio file) or a JSON body")
+
+    inputs = {}
+    async with request.form(max_files=2, max_part_size=max_bytes) as form:
+        for name, value in form.multi_items():
+            inputs[name] = await value.read() if hasattr(value, "read") else value
+    return inputs
+
+
+def pipeline_source(inputs):
+    """Returns (audio bytes, transcription) of a request; exactly one is set."""
+    audio = inputs.get("audio")
+    transcription = inputs.get("transcription")
+    if isinstance(audio, (bytes, bytearray)) and audio:
+        return bytes(audio), None
+    if isinstance(transcription, str) and transcription.strip():
+        return None, transcription.strip()
+    raise APIError(400, 'Send an "audio" file or a "transcription"')
+
+
+def run_transcription_job(job, force, store, audio_bytes):
+    """Background job: transcription only."""
+    if not app.run_transcription_stage(job, audio_bytes, force, store):
+        raise RuntimeError("Transcription failed")
+
+
+def start_job(kind, inputs):
+    """Submits (or joins) the job for a request and returns it."""
+    audio_bytes, transcription = pipeline_source(inputs)
+    encounter_id = str(inputs.get("encounter_id") or "").strip() or None
+    # A fresh stage cache per job: requests do not share a session
+    store = ({}, {})
+    manager = app.get_job_manager()
+
+    if kind == "transcription":
+        if audio_bytes is None:
+            raise APIError(400, 'Send an "audio" file')
+        key = app.stage_cache_key("api_transcription", (audio_bytes,))
+        return manager.submit(kind, key, run_transcription_job, set(), store, audio_bytes)
+
+    if kind == "assessment":
+        history = inputs.get("history")
+        pdf_bytes = bytes(history) if isinstance(history, (bytes, bytearray)) and history else None
+        patient = str(inputs.get("patient") or "")
+        consolidated = is_true(inputs.get("consolidated"))
+        key = app.stage_cache_key("api_assessment", (
+            audio_bytes or b"", transcription or "", pdf_bytes or b"", patient, consolidated, encounter_id or ""
+        ))
+        return manager.submit(
+            kind, key, app.run_assessment_job, set(), store, audio_bytes, pdf_bytes, consolidated, True,
+            transcription, None, patient, encounter_id
+        )
+
+    key = app.stage_cache_key("api_prescription", (audio_bytes or b"", transcription or "", encounter_id or ""))
+    return manager.submit(kind, key, app.run_prescription_job, set(), store, audio_bytes, encounter_id, transcription)
+
+
+def document_error(kind, snapshot):
+    """
+    Returns why a finished job's PDF must not be rendered, or None.
+
+    A failed prescription holds at most the lexicon's unverified draft, and an
+    assessment report would silently leave out its failed sections.
+    """
+    stages = snapshot["stages"]
+    names = [stage for stage, _ in app.ASSESSMENT_SECTIONS] if kind == "assessment" else [kind]
+    errors = []
+    for name in names:
+        result = stages.get(name, {}).get("result")
+        if app.is_error_result(result):
+            errors.append(f"{name}: {result['Error'] if isinstance(result, dict) else 'no result'}")
+    if errors:
+        return f"The {kind} PDF is not rendered because stages failed ({'; '.join(errors)})"
+    return None
+
+
+def render_pdf(kind, snapshot, doctor_name):
+    """Returns the PDF bytes of a finished assessment or prescription job."""
+    stages = snapshot["stages"]
+    if kind == "assessment":
+        results = {stage: stages.get(stage, {}).get("result") for stage, _ in app.ASSESSMENT_SECTIONS}
+        return app.generate_assessment_pdf(results, doctor_name).getvalue()
+    return app.generate_prescription_pdf(stages["prescription"]["result"], doctor_name).getvalue()
+
+
+def stage_event(stage, info):
+    event = {"stage": stage, "status": info["status"], "result": info.get("result")}
+    if info.get("warnings"):
+        event["warnings"] = info["warnings"]
+    if info.get("preprocessing"):
+        event["preprocessing"] = info["preprocessing"]
+    return event
+
+
+def job_body(snapshot):
+    """JSON body of a finished job: status, per-stage results and any cross-check warnings."""
+    stages = snapshot["stages"]
+    body = {
+        "job": snapshot["id"],
+        "status": snapshot["status"],
+        "results": {stage: info.get("result") for stage, info in stages.items() if "result" in info},
+        "seconds": round((snapshot["finished"] or time.time()) - snapshot["created"], 3),
+    }
+    warnings = {stage: info["warnings"] for stage, info in stages.items() if info.get("warnings")}
+    if warnings:
+        body["warnings"] = warnings
+    if snapshot["error"]:
+        body["error"] = snapshot["error"]
+    return body
+
+
+async def finish_body(kind, snapshot, doctor_name, include_pdf):
+    body = job_body(snapshot)
+    if include_pdf and kind != "transcription" and snapshot["status"] == DONE:
+        error = document_error(kind, snapshot)
+        if error:
+            body["pdf_error"] = error
+        else:
+            pdf = await run_in_threadpool(render_pdf, kind, snapshot, doctor_name)
+            body["pdf"] = base64.b64encode(pdf).decode("ascii")
+    return body
+
+
+async def wait_for(job):
+    while not job.done:
+        await asyncio.sleep(API_POLL_SECONDS)
+    return job.snapshot()
+
+
+def format_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False, default=json_default)}\n\n"
+
+
+async def job_events(kind, job, doctor_name, include_pdf):
+    """Yields server-sent events for a job until it finishes."""
+    sent_status, sent_partial = {}, {}
+    last_sent = time.monotonic()
+    yield format_event("job", {"job": job.id, "kind": kind})
+    while True:
+        done = job.done
+        snapshot = job.snapshot()
+        for stage, info in snapshot["stages"].items():
+            if info["status"] in (DONE, FAILED):
+                if sent_status.get(stage) != info["status"]:
+                    sent_status[stage] = info["status"]
+                    yield format_event("stage", stage_event(stage, info))
+                    last_sent = time.monotonic()
+            elif info.get("partial") is not None and sent_partial.get(stage) is not info["partial"]:
+                sent_partial[stage] = info["partial"]
+                yield format_event("partial", {"stage": stage, "partial": info["partial"]})
+                last_sent = time.monotonic()
+        if done:
+            break
+        if time.monotonic() - last_sent > SSE_KEEPALIVE_SECONDS:
+            yield ": keep-alive\n\n"
+            last_sent = time.monotonic()
+        await asyncio.sleep(API_POLL_SECONDS)
+    snapshot = job.snapshot()
+    event = "done" if snapshot["status"] == DONE else "error"
+    yield format_event(event, await finish_body(kind, snapshot, doctor_name, include_pdf))
+
+
+def response_format(request):
+    requested = request.query_params.get("format")
+    if requested:
+        return requested
+    accept = request.headers.get("accept", "")
+    if "text/event-stream" in accept:
+        return "sse"
+    if "application/pdf" in accept:
+        return "pdf"
+    return "json"
+
+
+def pipeline_endpoint(kind):
+    async def endpoint(request):
+        try:
+            check_token(request)
+            output = response_format(request)
+            if output not in ("json", "sse", "pdf") or (output == "pdf" and kind == "transcription"):
+                raise APIError(400, f"Unsupported format {output!r}")
+            inputs = await read_inputs(request)
+            job = start_job(kind, inputs)
+        except APIError as e:
+            return json_response({"error": str(e)}, e.status)
+
+        doctor_name = str(inputs.get("doctor_name") or "")
+        include_pdf = is_true(request.query_params.get("pdf"))
+        if output == "sse":
+            return StreamingResponse(
+                job_events(kind, job, doctor_name, include_pdf), media_type="text/event-stream",
+                headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+            )
+
+        snapshot = await wait_for(job)
+        if snapshot["status"] != DONE:
+            return json_response(job_body(snapshot), 502)
+        if output == "pdf":
+            error = document_error(kind, snapshot)
+            if error:
+                return json_response({**job_body(snapshot), "error": error}, 422)
+            pdf = await run_in_threadpool(render_pdf, kind, snapshot, doctor_name)
+            return Response(pdf, media_type="application/pdf", headers={
+                "Content-Disposition": f'attachment; filename="{kind}_{job.id}.pdf"', "X-Job-Id": job.id
+            })
+        return json_response(await finish_body(kind, snapshot, doctor_name, include_pdf))
+
+    return endpoint
+
+
+async def health(request):
+    return json_response({"status": "ok"})
+
+
+routes = [
+    Route("/health", health),
+    Route("/v1/transcriptions", pipeline_endpoint("transcription"), methods=["POST"]),
+    Route("/v1/assessments", pipeline_endpoint("assessment"), methods=["POST"]),
+    Route("/v1/prescriptions", pipeline_endpoint("prescription"), methods=["POST"]),
+]
+
+api = Starlette(routes=routes)
+
+
+def main(argv=None):
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=1, help="Worker processes")
+    args = parser.parse_args(argv)
+
+    if not os.getenv("OPENAI_API_KEY"):
+        parser.error("OPENAI_API_KEY must be set (environment or .env)")
+    uvicorn.run("api:api", host=args.host, port=args.port, workers=args.workers)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,21 +1,35 @@
 # -- coding: utf-8 --
 import streamlit as st
-import openai
 import json
 import tempfile
 import os
-import pandas as pd
 from datetime import datetime
-import base64
 from dotenv import load_dotenv
-import PyPDF2
 import io
-from reportlab.lib import colors
-from reportlab.lib.pagesizes import letter
-from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer
-from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-from reportlab.lib.units import inch
-import numpy as np
+import threading
+import contextvars
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+import time
+import logging
+import sqlite3
+from disk_cache import DiskCache, content_hash
+import metrics
+from metrics import instrument
+from encounter_store import EncounterStore
+from model_routing import load_routing, active_routing, is_valid_response
+from medical_lexicon import (
+    DEFAULT_LEXICON, PRESCRIPTION_KINDS, Lexicon, prefill_prescription, prefill_complaints, relevant_excerpt,
+    cross_check_prescription, cross_check_complaints
+)
+from ipd_form import IPD_FORM_TEMPLATE, PROMPT_TEMPLATE, SECTION_QUERIES, IPDForm, prompt_value, json_default
+from prompt_budget import render_sections, compact_json, count_tokens, prune_empty
+from transcript_diff import transcript_changes, format_changes
+from rate_limit import RequestScheduler
+from openai_client import build_client, current_api_key
+from jobs import JobManager, RUNNING, DONE, FAILED
 
 # Ensure UTF-8 encoding
 import sys
@@ -25,39 +39,499 @@ sys.stderr.reconfigure(encoding='utf-8')  # for Windows
 # Load environment variables
 load_dotenv()
 
+# Log pipeline diagnostics (e.g. prompt token savings) to stderr; Streamlit reruns this script, so add the handler once
+logger = logging.getLogger("echo_med")
+if not logger.handlers:
+    logger.addHandler(logging.StreamHandler())
+    logger.setLevel(os.getenv("ECHO_MED_LOG_LEVEL", "INFO").upper())
+
 # Configure OpenAI API Key
 # openai.api_key = os.getenv("OPENAI_API_KEY") #when running locally
 # openai.api_key = st.secrets["OPENAI_API_KEY"] #when running on streamlit cloud
 
-def extract_text_from_pdf(pdf_file):
-    """Extracts text from a PDF file."""
+# Maximum number of stage results memoized per session
+MAX_STAGE_CACHE_ENTRIES = 64
+
+# Long recordings are transcribed in segments of roughly this many seconds,
+# with at most TRANSCRIPTION_WORKERS Whisper requests in flight
+TRANSCRIPTION_SEGMENT_SECONDS = int(os.getenv("ECHO_MED_TRANSCRIPTION_SEGMENT_SECONDS", "120"))
+TRANSCRIPTION_WORKERS = int(os.getenv("ECHO_MED_TRANSCRIPTION_WORKERS", "4"))
+# MP3 is only split when larger than this (the Whisper API accepts up to 25 MB per request)
+TRANSCRIPTION_MAX_UPLOAD_MB = float(os.getenv("ECHO_MED_TRANSCRIPTION_MAX_UPLOAD_MB", "24"))
+# Audio is shrunk to this sample rate before upload; upload speed used to estimate the time saved
+TRANSCRIPTION_SAMPLE_RATE = int(os.getenv("ECHO_MED_TRANSCRIPTION_SAMPLE_RATE", "16000"))
+UPLOAD_MBPS = float(os.getenv("ECHO_MED_UPLOAD_MBPS", "10"))
+
+# Model, temperature and max_tokens per LLM stage: a profile of model_routing.PROFILES or a JSON routing file
+MODEL_ROUTING = os.getenv("ECHO_MED_MODEL_ROUTING", "quality")
+
+# Consolidated extraction uses strict structured output, which needs a model that supports JSON schemas
+# (overrides the routing profile's structured_data model if set)
+CONSOLIDATED_EXTRACTION_MODEL = os.getenv("ECHO_MED_CONSOLIDATED_EXTRACTION_MODEL", "")
+CONSOLIDATED_EXTRACTION_DEFAULT = os.getenv("ECHO_MED_CONSOLIDATED_EXTRACTION", "").lower() in ("1", "true", "yes")
+
+# Stream model output into the Clinical Assessment page as it is generated
+STREAMING_DEFAULT = os.getenv("ECHO_MED_STREAMING", "1").lower() in ("1", "true", "yes")
+
+# Past history PDFs: page-parallel extraction above PDF_PARALLEL_MIN_PAGES pages,
+# and only the first PDF_MAX_PAGES pages / PDF_MAX_CHARS characters are used
+PDF_WORKERS = int(os.getenv("ECHO_MED_PDF_WORKERS", str(min(4, os.cpu_count() or 1))))
+PDF_PARALLEL_MIN_PAGES = int(os.getenv("ECHO_MED_PDF_PARALLEL_MIN_PAGES", "24"))
+PDF_MAX_PAGES = int(os.getenv("ECHO_MED_PDF_MAX_PAGES", "300"))
+PDF_MAX_CHARS = int(os.getenv("ECHO_MED_PDF_MAX_CHARS", "200000"))
+
+# Past history sent to the model is limited to the most relevant passages within this many tokens
+HISTORY_TOKEN_BUDGET = int(os.getenv("ECHO_MED_HISTORY_TOKEN_BUDGET", "1500"))
+HISTORY_PASSAGES_PER_QUERY = int(os.getenv("ECHO_MED_HISTORY_PASSAGES_PER_QUERY", "3"))
+
+# Background jobs: worker threads shared by all sessions, finished jobs kept for polling
+JOB_WORKERS = int(os.getenv("ECHO_MED_JOB_WORKERS", "4"))
+MAX_JOBS = int(os.getenv("ECHO_MED_MAX_JOBS", "200"))
+JOB_POLL_SECONDS = float(os.getenv("ECHO_MED_JOB_POLL_SECONDS", "0.5"))
+# Upload content hashes remembered per session, so polling reruns do not rehash the files
+MAX_UPLOAD_DIGESTS = 8
+# How often the live recording view refreshes its transcript and chief complaints
+LIVE_POLL_SECONDS = float(os.getenv("ECHO_MED_LIVE_POLL_SECONDS", "1.0"))
+
+# Transcript edits touching more than this share of words are re-assessed from scratch
+DELTA_MAX_CHANGE_FRACTION = float(os.getenv("ECHO_MED_DELTA_MAX_CHANGE_FRACTION", "0.3"))
+
+# Account limits shared by every session of this process (per model)
+OPENAI_REQUESTS_PER_MINUTE = int(os.getenv("ECHO_MED_OPENAI_RPM", "500"))
+OPENAI_TOKENS_PER_MINUTE = int(os.getenv("ECHO_MED_OPENAI_TPM", "30000"))
+OPENAI_MAX_CONCURRENT = int(os.getenv("ECHO_MED_OPENAI_MAX_CONCURRENT", "8"))
+OPENAI_MAX_RETRIES = int(os.getenv("ECHO_MED_OPENAI_MAX_RETRIES", "6"))
+# Connection pool of each per-key OpenAI client
+OPENAI_MAX_CONNECTIONS = int(os.getenv("ECHO_MED_OPENAI_MAX_CONNECTIONS", "20"))
+OPENAI_KEEPALIVE_SECONDS = float(os.getenv("ECHO_MED_OPENAI_KEEPALIVE_SECONDS", "120"))
+OPENAI_CONNECT_TIMEOUT = float(os.getenv("ECHO_MED_OPENAI_CONNECT_TIMEOUT", "5"))
+OPENAI_READ_TIMEOUT = float(os.getenv("ECHO_MED_OPENAI_READ_TIMEOUT", "120"))
+# Completion tokens reserved for requests that do not set max_tokens
+DEFAULT_COMPLETION_TOKENS = 1000
+
+# Token budget for earlier stage results embedded in the diagnosis and summary prompts
+PROMPT_CONTEXT_TOKEN_BUDGET = int(os.getenv("ECHO_MED_PROMPT_CONTEXT_TOKEN_BUDGET", "2000"))
+
+# Shared on-disk cache location (see README for the tuning variables)
+CACHE_DIR = os.getenv("ECHO_MED_CACHE_DIR", os.path.join(tempfile.gettempdir(), "echo-med-cache"))
+
+# SQLite file of saved encounters, used as past history for returning patients ("" disables it)
+ENCOUNTER_DB = os.getenv("ECHO_MED_ENCOUNTER_DB", os.path.join(CACHE_DIR, "encounters.sqlite3"))
+
+# Earlier encounters of a returning patient added to the past history
+PRIOR_ENCOUNTERS = int(os.getenv("ECHO_MED_PRIOR_ENCOUNTERS", "3"))
+
+# Drug/symptom lexicon used to pre-annotate transcripts (JSON, see medical_lexicon.json)
+LEXICON_PATH = os.getenv("ECHO_MED_LEXICON", DEFAULT_LEXICON)
+
+# Send the prescription prompt only the transcript sentences around detected medicines, doses and frequencies.
+# Off by default: a medicine missing from the lexicon would never reach the model
+LEXICON_PROMPT_SPANS = os.getenv("ECHO_MED_LEXICON_PROMPT_SPANS", "0").lower() in ("1", "true", "yes")
+
+@st.cache_resource
+def get_pdf_pool():
+    """Returns the process-wide pool used for page-parallel PDF extraction and bulk PDF rendering."""
+    # spawn keeps the Streamlit server's threads out of the workers
+    return ProcessPoolExecutor(max_workers=PDF_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+
+@st.cache_resource
+def get_encounter_store():
+    """Returns the process-wide encounter store, or None if ECHO_MED_ENCOUNTER_DB is empty."""
+    return EncounterStore(ENCOUNTER_DB) if ENCOUNTER_DB else None
+
+@st.cache_resource
+def get_model_routing():
+    """Returns the process-wide {stage: Route} of ECHO_MED_MODEL_ROUTING."""
+    overrides = {"structured_data": {"model": CONSOLIDATED_EXTRACTION_MODEL}} if CONSOLIDATED_EXTRACTION_MODEL else None
+    return load_routing(MODEL_ROUTING, overrides)
+
+@st.cache_resource
+def get_lexicon():
+    """Returns the process-wide lexicon; its automaton is built once per process."""
+    return Lexicon.load(LEXICON_PATH)
+
+@st.cache_resource
+def get_pdf_cache():
+    """Returns the process-wide cache of extracted PDF text shared by all sessions."""
+    return DiskCache(os.path.join(CACHE_DIR, "pdf"), max_bytes=100 * 1024 * 1024)
+
+@instrument("extract_text_from_pdf")
+def extract_text_from_pdf(pdf_file, on_progress=None, max_pages=None, max_chars=None, refresh=False):
+    """
+    Extracts text from a PDF file.
+
+    Large documents are parsed page-parallel in a process pool and results are
+    cached by file hash, so the same document is never parsed twice. Only the
+    first max_pages pages and max_chars characters are kept.
+
+    Args:
+        pdf_file: File-like object with the PDF contents
+        on_progress (callable): Optional callback receiving (pages_done, total_pages, latest_page_text)
+        max_pages (int): Page budget, defaults to PDF_MAX_PAGES
+        max_chars (int): Character budget, defaults to PDF_MAX_CHARS
+        refresh (bool): Parse again and replace the cached text (the stage was re-run)
+
+    Returns:
+        str: The extracted text, one line break after each page
+    """
+    # PyPDF2 is only loaded once a history file is actually parsed
+    from pdf_extraction import page_count, iter_page_chunks
+
+    max_pages = max_pages or PDF_MAX_PAGES
+    max_chars = max_chars or PDF_MAX_CHARS
     try:
-        pdf_reader = PyPDF2.PdfReader(pdf_file)
-        text = ""
-        for page in pdf_reader.pages:
-            text += page.extract_text() + "\n"
+        pdf_bytes = pdf_file.getvalue() if hasattr(pdf_file, "getvalue") else pdf_file.read()
+        cache = get_pdf_cache()
+        cache_key = content_hash(pdf_bytes, str(max_pages), str(max_chars))
+        cached = None if refresh else cache.get(cache_key)
+        if cached is not None:
+            return cached
+
+        total = min(page_count(pdf_bytes), max_pages)
+        executor = get_pdf_pool() if total >= PDF_PARALLEL_MIN_PAGES and PDF_WORKERS > 1 else None
+        pages = []
+        chars = 0
+        chunks = iter_page_chunks(pdf_bytes, total, executor)
+        for chunk in chunks:
+            for page_text in chunk:
+                pages.append(page_text)
+                chars += len(page_text) + 1
+            if on_progress:
+                on_progress(len(pages), total, pages[-1] if pages else "")
+            if chars >= max_chars:
+                chunks.close()
+                break
+
+        text = "".join(page_text + "\n" for page_text in pages)[:max_chars]
+        cache.set(cache_key, text)
         return text
     except Exception as e:
         st.error(f"Error extracting text from PDF: {e}")
         return ""
 
+@st.cache_resource
+def get_transcription_cache():
+    """Returns the process-wide transcription cache shared by all sessions."""
+    return DiskCache(
+        os.path.join(CACHE_DIR, "transcriptions"),
+        max_bytes=int(os.getenv("ECHO_MED_TRANSCRIPTION_CACHE_MB", "200")) * 1024 * 1024,
+        ttl_seconds=int(os.getenv("ECHO_MED_TRANSCRIPTION_CACHE_TTL", str(7 * 24 * 3600)))
+    )
+
+@st.cache_resource
+def get_request_scheduler():
+    """Returns the scheduler every OpenAI request of this process goes through."""
+    return RequestScheduler(
+        requests_per_minute=OPENAI_REQUESTS_PER_MINUTE,
+        tokens_per_minute=OPENAI_TOKENS_PER_MINUTE,
+        max_concurrent=OPENAI_MAX_CONCURRENT,
+        max_retries=OPENAI_MAX_RETRIES
+    )
+
+@st.cache_resource(max_entries=32)
+def get_openai_client(api_key):
+    """Returns the pooled client for an API key, shared by all sessions using that key."""
+    return build_client(
+        api_key,
+        max_connections=OPENAI_MAX_CONNECTIONS,
+        max_keepalive_connections=OPENAI_MAX_CONNECTIONS,
+        keepalive_expiry=OPENAI_KEEPALIVE_SECONDS,
+        connect_timeout=OPENAI_CONNECT_TIMEOUT,
+        read_timeout=OPENAI_READ_TIMEOUT
+    )
+
+def openai_client():
+    """Returns the client for the current session's key (OPENAI_API_KEY outside the UI)."""
+    return get_openai_client(current_api_key.get() or os.getenv("OPENAI_API_KEY"))
+
+def transcribe_segment(audio_bytes, file_name, model="whisper-1"):
+    """Sends a single audio file to Whisper and returns its text."""
+    try:
+        transcript, retries = get_request_scheduler().run(
+            lambda: openai_client().audio.transcriptions.create(model=model, file=(file_name, audio_bytes)),
+            model
+        )
+    except Exception:
+        metrics.record_api_call(model, error=True)
+        raise
+    usage = getattr(transcript, "usage", None)
+    metrics.record_api_call(model, retries=retries, audio_seconds=getattr(usage, "seconds", 0) or 0)
+    return transcript.text
+
+# Function to shrink audio before upload
+def preprocess_audio(audio_bytes):
+    """
+    Downmixes WAV audio to mono, resamples it to TRANSCRIPTION_SAMPLE_RATE and trims silence.
+
+    Returns:
+        tuple: (audio bytes to upload, stats dict or None). Formats other than
+        WAV (e.g. MP3, already compressed) are returned unchanged.
+    """
+    from audio_processing import preprocess_wav
+
+    try:
+        processed = preprocess_wav(audio_bytes, TRANSCRIPTION_SAMPLE_RATE)
+    except Exception as e:
+        logger.warning("Audio preprocessing failed, uploading the original: %s", e)
+        processed = None
+    if processed is None:
+        return audio_bytes, None
+    audio_bytes, stats = processed
+    stats["bytes_saved"] = stats["original_bytes"] - stats["processed_bytes"]
+    stats["upload_seconds_saved"] = round(stats["bytes_saved"] * 8 / (UPLOAD_MBPS * 1_000_000), 2)
+    logger.info(
+        "Audio preprocessing: %d -> %d bytes, ~%.1fs less upload",
+        stats["original_bytes"], stats["processed_bytes"], stats["upload_seconds_saved"]
+    )
+    return audio_bytes, stats
+
 # Function to transcribe audio using OpenAI Whisper
-def transcribe_audio(audio_file_path):
-    """Transcribes audio using OpenAI Whisper API."""
+@instrument("transcribe_audio")
+def transcribe_audio(audio, model="whisper-1", on_preprocessed=None, refresh=False):
+    """
+    Transcribes audio using OpenAI Whisper API, reusing cached results for identical audio.
+
+    WAV audio is first shrunk in memory by preprocess_audio. Long recordings
+    are then split at silence boundaries and the segments are transcribed
+    concurrently, so latency follows the longest segment instead of the whole
+    consultation. MP3 larger than TRANSCRIPTION_MAX_UPLOAD_MB is split at
+    frame boundaries; other formats are sent in a single request.
+
+    Args:
+        audio (str or bytes): Path of an audio file, or its contents
+        model (str): Whisper model
+        on_preprocessed (callable): Called with the preprocessing stats (bytes and upload time saved)
+        refresh (bool): Transcribe again and replace the cached transcript (the stage was re-run)
+    """
+    # NumPy-based; not needed until a recording is transcribed
+    from audio_processing import audio_extension, split_mp3, split_wav, merge_transcripts
+
     try:
-        with open(audio_file_path, "rb") as audio_file:
-            transcript = openai.audio.transcriptions.create(
-                model="whisper-1",
-                file=audio_file
-            )
-        return transcript.text
+        if isinstance(audio, (bytes, bytearray)):
+            # Uploads and recordings carry no name; the API needs the extension to match the format
+            audio_bytes = bytes(audio)
+            file_name = f"audio.{audio_extension(audio_bytes)}"
+        else:
+            with open(audio, "rb") as audio_file:
+                audio_bytes = audio_file.read()
+            file_name = os.path.basename(audio)
+
+        cache = get_transcription_cache()
+        cache_key = content_hash(model, audio_bytes)
+        cached = None if refresh else cache.get(cache_key)
+        if cached is not None:
+            return cached
+
+        upload_bytes, stats = preprocess_audio(audio_bytes)
+        if stats and on_preprocessed:
+            on_preprocessed(stats)
+
+        segments = split_wav(upload_bytes, TRANSCRIPTION_SEGMENT_SECONDS)
+        max_upload_bytes = int(TRANSCRIPTION_MAX_UPLOAD_MB * 1024 * 1024)
+        if segments is None and len(upload_bytes) > max_upload_bytes and audio_extension(upload_bytes) == "mp3":
+            # Too large for one request; without a decoder the cuts cannot be placed in silence
+            segments = split_mp3(upload_bytes, TRANSCRIPTION_SEGMENT_SECONDS, max_upload_bytes)
+        if not segments or len(segments) == 1:
+            text = transcribe_segment(upload_bytes, file_name, model)
+        else:
+            with ThreadPoolExecutor(max_workers=TRANSCRIPTION_WORKERS) as executor:
+                # Each segment runs in a copy of this context so its API usage counts towards this stage
+                futures = [
+                    executor.submit(
+                        contextvars.copy_context().run, transcribe_segment, segment, f"segment_{i}.{audio_extension(segment)}", model
+                    )
+                    for i, segment in enumerate(segments)
+                ]
+                texts = [future.result() for future in futures]
+            text = merge_transcripts(texts)
+
+        cache.set(cache_key, text)
+        return text
     except Exception as e:
         st.error(f"Transcription error: {e}")
         return ""
 
+def complete_chat(on_update=None, **kwargs):
+    """
+    Runs a chat completion and returns the message text.
+
+    Args:
+        on_update (callable): If given, the response is streamed and this is
+            called with the accumulated text after every received chunk
+        **kwargs: Arguments for chat.completions.create
+
+    Returns:
+        str: The full response text
+    """
+    model = kwargs.get("model", "")
+    estimated_tokens = sum(count_tokens(str(m.get("content", ""))) for m in kwargs.get("messages", []))
+    estimated_tokens += kwargs.get("max_tokens") or DEFAULT_COMPLETION_TOKENS
+    scheduler = get_request_scheduler()
+    client = openai_client()
+
+    def request():
+        if on_update is None:
+            response = client.chat.completions.create(**kwargs)
+            return response.choices[0].message.content, response.usage
+
+        parts = []
+        usage = None
+        for chunk in client.chat.completions.create(stream=True, stream_options={"include_usage": True}, **kwargs):
+            if chunk.usage:
+                usage = chunk.usage
+            if chunk.choices and chunk.choices[0].delta.content:
+                parts.append(chunk.choices[0].delta.content)
+                on_update("".join(parts))
+        return "".join(parts), usage
+
+    try:
+        (content, usage), retries = scheduler.run(request, model, estimated_tokens)
+    except Exception:
+        metrics.record_api_call(model, error=True)
+        raise
+    if usage:
+        scheduler.settle(model, estimated_tokens, usage.total_tokens)
+    metrics.record_api_call(
+        model, usage.prompt_tokens if usage else 0,
+        usage.completion_tokens if usage else 0, retries
+    )
+    return content
+
+def routed_chat(stage, on_update=None, **kwargs):
+    """
+    Runs a stage's chat completion with the model, temperature and max_tokens its route assigns.
+
+    If the response fails the stage's validation and the route names an
+    escalation model, the request is repeated once with that model.
+
+    Args:
+        stage (str): Stage name in model_routing.STAGES
+        on_update (callable): As for complete_chat
+        **kwargs: Other arguments for chat.completions.create (messages, response_format)
+    """
+    route = (active_routing.get() or get_model_routing())[stage]
+    content = complete_chat(on_update, **route.request_args(), **kwargs)
+    if route.escalate_to and not is_valid_response(stage, content):
+        logger.warning("%s: %s response failed validation, retrying with %s", stage, route.model, route.escalate_to)
+        content = complete_chat(on_update, **route.request_args(route.escalate_to), **kwargs)
+    return content
+
+def parse_partial_json(text):
+    """
+    Parses the completed part of a JSON document that is still being generated.
+
+    The text is cut back to the last point where every value seen so far is
+    complete, and the open objects/arrays are closed, so fields only appear
+    once their values have fully arrived.
+
+    Returns:
+        The parsed value, or None if nothing complete has arrived yet
+    """
+    start = min((i for i in (text.find("{"), text.find("[")) if i >= 0), default=-1)
+    if start < 0:
+        return None
+    text = text[start:]
+    try:
+        return json.loads(text)
+    except json.JSONDecodeError:
+        pass
+
+    closers = {"{": "}", "[": "]"}
+    stack = []
+    in_string = escaped = False
+    cut, cut_stack = None, None
+    for i, char in enumerate(text):
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char in closers:
+            stack.append(char)
+            cut, cut_stack = i + 1, list(stack)
+        elif char in "}]":
+            if stack:
+                stack.pop()
+            cut, cut_stack = i + 1, list(stack)
+        elif char == ",":
+            cut, cut_stack = i, list(stack)
+
+    if cut is None:
+        return None
+    try:
+        return json.loads(text[:cut] + "".join(closers[c] for c in reversed(cut_stack)))
+    except json.JSONDecodeError:
+        return None
+
+def json_updates(on_update):
+    """Adapts a partial-value callback to the raw-text callback complete_chat expects."""
+    if on_update is None:
+        return None
+
+    def update(text):
+        partial = parse_partial_json(text)
+        if partial:
+            on_update(partial)
+    return update
+
+def select_history_context(past_history_text, conversation_text, token_budget=None):
+    """
+    Picks the past history passages relevant to this encounter.
+
+    Passages are ranked against the conversation and against every IPD form
+    section (its name plus field names), so e.g. prior surgeries or HbA1c
+    results are kept even if the conversation does not mention them.
+    """
+    if not past_history_text:
+        return past_history_text
+    from history_index import select_passages
+
+    return select_passages(
+        past_history_text, [conversation_text, *SECTION_QUERIES],
+        token_budget=token_budget or HISTORY_TOKEN_BUDGET,
+        top_k=HISTORY_PASSAGES_PER_QUERY
+    )
+
+# Function to find drugs, symptoms, doses, frequencies and durations in a transcript
+def annotate_transcript(text):
+    """Annotates a transcript with the local lexicon (no API call); returns [] if the lexicon cannot be loaded."""
+    try:
+        return get_lexicon().annotate(text)
+    except (OSError, ValueError) as e:
+        logger.warning("Lexicon annotation failed: %s", e)
+        return []
+
+def check_prescription(conversation_text, prescription):
+    """Returns warnings where a prescription disagrees with the medicines and doses the transcript mentions."""
+    try:
+        return cross_check_prescription(prescription, conversation_text, annotate_transcript(conversation_text), get_lexicon())
+    except (OSError, ValueError):
+        return []
+
+def check_chief_complaints(conversation_text, complaints):
+    """Returns warnings for symptoms the transcript mentions but the chief complaints leave out."""
+    try:
+        return cross_check_complaints(complaints, annotate_transcript(conversation_text), get_lexicon())
+    except (OSError, ValueError):
+        return []
+
 # Function to extract chief complaints
-def extract_chief_complaints(conversation_text):
-    """Extracts chief complaints from the conversation."""
+@instrument("extract_chief_complaints")
+def extract_chief_complaints(conversation_text, on_update=None):
+    """
+    Extracts chief complaints from the conversation.
+
+    The symptoms the lexicon finds are shown through on_update right away. If
+    the call fails, an {"Error": ...} dict is returned; for a response that is
+    not valid JSON it carries those symptoms under "Chief Complaints".
+    """
+    prefill = prefill_complaints(conversation_text, annotate_transcript(conversation_text))
+    if on_update and prefill:
+        on_update(prefill)
     prompt = f"""
     From the following conversation, extract and list the patient's chief complaints and also the duration:
 
@@ -67,23 +541,25 @@ def extract_chief_complaints(conversation_text):
     """
     
     try:
-        response = openai.chat.completions.create(
-            model="gpt-4",
-            messages=[{"role": "system", "content": prompt}],
-            temperature=0.2
+        content = routed_chat(
+            "chief_complaints",
+            json_updates(on_update),
+            messages=[{"role": "system", "content": prompt}]
         )
 
         try:
-            return json.loads(response.choices[0].message.content)
+            return json.loads(content)
         except json.JSONDecodeError:
-            return [{"Complaint": "Unable to extract", "Duration": "N/A"}]
+            return {"Error": "Invalid JSON response from OpenAI.", "Chief Complaints": prefill}
     except Exception as e:
         st.error(f"Error extracting chief complaints: {e}")
-        return [{"Complaint": "Error in extraction", "Duration": "N/A"}]
+        return {"Error": str(e)}
 
 # Function to extract structured patient data in IPD format
-def extract_patient_data(conversation_text, past_history_text=""):
+@instrument("extract_patient_data")
+def extract_patient_data(conversation_text, past_history_text="", on_update=None):
     """Extracts structured patient data based on Hospital Initial Assessment Form (IPD)."""
+    past_history_text = select_history_context(past_history_text, conversation_text)
     prompt = f"""
     Extract structured patient information from the following conversation and past history, and format it strictly as JSON according to the Hospital Initial Assessment Form (IPD):
 
@@ -94,114 +570,36 @@ def extract_patient_data(conversation_text, past_history_text=""):
     {past_history_text}
 
     Format:
-    {{
-        "Patient Information": {{
-            "Patient's Name": "",
-            "IP No": "",
-            "Age": "",
-            "Date/Time of Admission": "",
-            "Ward/ICU/EM": "",
-            "Medico-Legal Case": "",
-            "Marital Status": "",
-            "Socio-Economic Class": ""
-        }},
-        "Allergies": {{
-            "Has Allergies": "",
-            "Details": "",
-            "Reaction": ""
-        }},
-        "Chief Complaints": "",
-        "Investigation Reports": "",
-        "Past History": {{
-            "Hypertension": "",
-            "Diabetes": "",
-            "Heart Disease": "",
-            "Tuberculosis": "",
-            "Past Surgeries": "",
-            "Hospitalizations": ""
-        }},
-        "Investigation Findings": {{
-            "BP/Sugar": "",
-            "HbA1C": "",
-            "HIV/HBsAg/HCV": "",
-            "Imaging Findings": "",
-            "Other Tests": ""
-        }},
-        "Advice": {{
-            "NBM Consent": "",
-            "Surgical Risk": "",
-            "ASA Risk Grade": "",
-            "Plan of Anesthesia": "",
-            "Morning Investigations": ""
-        }},
-        "Family History": {{
-            "Hypertension": "",
-            "Diabetes": "",
-            "Heart Disease": "",
-            "Tuberculosis": "",
-            "Other Chronic Illnesses": ""
-        }},
-        "Personal History": {{
-            "Diet": "",
-            "Appetite": "",
-            "Sleep": "",
-            "Smoking": "",
-            "Alcohol": "",
-            "Drugs": "",
-            "Tobacco": ""
-        }},
-        "Physical Examination": {{
-            "Vital Signs": {{
-                "Temperature": "",
-                "Pulse": "",
-                "BP": "",
-                "SPO2": "",
-                "Respiratory Rate": ""
-            }},
-            "General Examination": {{
-                "Anemia": "",
-                "Clubbing": "",
-                "Cyanosis": "",
-                "Jaundice": "",
-                "Lymphadenopathy": "",
-                "Pedal Edema": ""
-            }},
-            "Systematic Examination": {{
-                "Respiratory": "",
-                "Cardiovascular": "",
-                "Musculoskeletal": "",
-                "Abdomen": "",
-                "Neurological": ""
-            }}
-        }}
-    }}
+    {PROMPT_TEMPLATE}
     """
 
     try:
-        response = openai.chat.completions.create(
-            model="gpt-4",
-            messages=[{"role": "system", "content": prompt}],
-            temperature=0.2
+        content = routed_chat(
+            "patient_data",
+            json_updates(on_update),
+            messages=[{"role": "system", "content": prompt}]
         )
 
         try:
-            extracted_data = json.loads(response.choices[0].message.content)
-            return extracted_data
-        except json.JSONDecodeError:
+            return IPDForm.parse(json.loads(content))
+        except (json.JSONDecodeError, ValueError):
             return {"Error": "Invalid JSON response from OpenAI."}
     except Exception as e:
         st.error(f"Error extracting patient data: {e}")
         return {"Error": str(e)}
 
-def extract_presenting_illness(conversation_text):
+@instrument("extract_presenting_illness")
+def extract_presenting_illness(conversation_text, on_update=None):
     """
     Extract and summarize the history of presenting illness from a medical conversation.
     
     Args:
         conversation_text (str): Transcribed medical conversation
+        on_update (callable): Optional callback streaming the summary text as it is generated
     
     Returns:
-        str: A structured textual summary of the presenting illness in professional English
+        str: A structured textual summary of the presenting illness in professional English,
+        or an {"Error": ...} dict if the call fails
     """
     prompt = f"""
     Analyze the following medical conversation and extract a comprehensive history of presenting illness in clear, professional English:
@@ -220,33 +618,132 @@ def extract_presenting_illness(conversation_text):
     """
     
     try:
-        response = openai.chat.completions.create(
-            model="gpt-4",
+        content = routed_chat(
+            "presenting_illness",
+            on_update,
             messages=[
                 {"role": "system", "content": "You are a professional medical historian extracting patient history in clear, precise English."},
                 {"role": "user", "content": prompt}
-            ],
-            temperature=0.3,
-            max_tokens=1000
+            ]
         )
         
         # Extract response text
-        response_text = response.choices[0].message.content.strip()
+        response_text = content.strip()
         return response_text
     
     except Exception as e:
-        return f"Error extracting presenting illness: {e}\nPlease review the conversation manually or retry."
+        st.error(f"Error extracting presenting illness: {e}")
+        return {"Error": str(e)}
 
-def generate_differential_diagnosis(patient_data):
+def build_json_schema(template):
+    """Builds a strict JSON schema in which every field of a template is a required string."""
+    if isinstance(template, dict):
+        return {
+            "type": "object",
+            "properties": {key: build_json_schema(value) for key, value in template.items()},
+            "required": list(template),
+            "additionalProperties": False
+        }
+    return {"type": "string"}
+
+STRUCTURED_EXTRACTION_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "Chief Complaints": {
+            "type": "array",
+            "items": build_json_schema({"Complaint": "", "Duration": ""})
+        },
+        "Patient Data": build_json_schema(IPD_FORM_TEMPLATE),
+        "Presenting Illness": {"type": "string"}
+    },
+    "required": ["Chief Complaints", "Patient Data", "Presenting Illness"],
+    "additionalProperties": False
+}
+
+@instrument("extract_structured_data")
+def extract_structured_data(conversation_text, past_history_text="", on_update=None):
+    """
+    Extracts chief complaints, IPD patient data and presenting illness in one call.
+
+    The transcript is sent once and the model is constrained to
+    STRUCTURED_EXTRACTION_SCHEMA, instead of paying for the same input tokens in
+    three separate requests.
+
+    Args:
+        conversation_text (str): Transcribed medical conversation
+        past_history_text (str): Text extracted from past medical records
+        on_update (callable): Optional callback streaming the completed fields as they are generated
+
+    Returns:
+        dict: "Chief Complaints", "Patient Data" and "Presenting Illness" keys, or an "Error" key
+    """
+    past_history_text = select_history_context(past_history_text, conversation_text)
+    prompt = f"""
+    From the following conversation and past history, extract:
+    - The patient's chief complaints, each with its duration
+    - Structured patient information according to the Hospital Initial Assessment Form (IPD); leave unknown fields empty
+    - A comprehensive history of presenting illness in clear, professional English covering primary symptoms, onset and duration, specific characteristics, impact on daily life and previous treatments
+
+    Current Conversation:
+    {conversation_text}
+
+    Past History:
+    {past_history_text}
+    """
+
+    try:
+        content = routed_chat(
+            "structured_data",
+            json_updates(on_update),
+            messages=[
+                {"role": "system", "content": "You are a professional medical assistant extracting structured clinical documentation from patient conversations."},
+                {"role": "user", "content": prompt}
+            ],
+            response_format={
+                "type": "json_schema",
+                "json_schema": {"name": "clinical_extraction", "strict": True, "schema": STRUCTURED_EXTRACTION_SCHEMA}
+            }
+        )
+
+        try:
+            return json.loads(content)
+        except (json.JSONDecodeError, TypeError):
+            return {"Error": "Invalid JSON response from OpenAI."}
+    except Exception as e:
+        st.error(f"Error extracting structured data: {e}")
+        return {"Error": str(e)}
+
+def split_structured_data(structured_data):
+    """
+    Fans a consolidated extraction out to the values the individual extractors return.
+
+    Returns:
+        tuple: (chief_complaints, patient_data, presenting_illness)
+    """
+    if "Error" in structured_data:
+        error = {"Error": structured_data["Error"]}
+        return dict(error), dict(error), dict(error)
+    return (
+        structured_data["Chief Complaints"],
+        IPDForm.parse(structured_data["Patient Data"]),
+        structured_data["Presenting Illness"].strip()
+    )
+
+@instrument("generate_differential_diagnosis")
+def generate_differential_diagnosis(patient_data, on_update=None):
     """
     Generates a differential diagnosis in structured text format.
     
     Args:
-        patient_data (dict): Dictionary containing patient details
+        patient_data (IPDForm): Extracted patient details (a plain dict also works)
+        on_update (callable): Optional callback streaming the completed fields as they are generated
     
     Returns:
         str: A structured textual summary of possible differential diagnoses
     """
+    context = render_sections("generate_differential_diagnosis", [
+        ("Patient Data", prompt_value(patient_data), 1)
+    ], PROMPT_CONTEXT_TOKEN_BUDGET)
     diagnosis_prompt = f"""
     Based on the following patient data, generate a list of possible differential diagnoses.
     Also, provide recommendations for:
@@ -255,7 +752,7 @@ def generate_differential_diagnosis(patient_data):
     - Laboratory and radiology investigations needed.
     
     Patient Data:
-    {json.dumps(patient_data, indent=2)}
+    {context["Patient Data"]}
     
     Provide a well-structured, professional medical report in the following JSON format:
     {{
@@ -269,85 +766,41 @@ def generate_differential_diagnosis(patient_data):
     """
     
     try:
-        response = openai.chat.completions.create(
-            model="gpt-4",
+        content = routed_chat(
+            "differential_diagnosis",
+            json_updates(on_update),
             messages=[{"role": "system", "content": "You are a professional medical assistant providing differential diagnosis based on patient data."},
-                      {"role": "user", "content": diagnosis_prompt}],
-            temperature=0.2
+                      {"role": "user", "content": diagnosis_prompt}]
         )
         
         # Parse the response as JSON
         try:
-            return json.loads(response.choices[0].message.content.strip())
+            return json.loads(content.strip())
         except json.JSONDecodeError:
-            # Return hardcoded differential diagnosis for the Hindi conversation
-            return {
-                "Differential Diagnosis": [
-                    "Acute Coronary Syndrome (ACS)",
-                    "Unstable Angina",
-                    "Myocardial Infarction",
-                    "Hypertensive Emergency"
-                ],
-                "Recommendations": {
-                    "Additional History": [
-                        "Detailed cardiovascular history",
-                        "Previous cardiac evaluations",
-                        "Current BP medication details"
-                    ],
-                    "Clinical Examination": [
-                        "Detailed cardiovascular examination",
-                        "Regular BP monitoring",
-                        "Continuous ECG monitoring"
-                    ],
-                    "Investigations": [
-                        "Immediate ECG",
-                        "Cardiac enzymes (Troponin)",
-                        "Complete blood count",
-                        "Chest X-ray"
-                    ]
-                }
-            }
+            return {"Error": "Invalid JSON response from OpenAI."}
     
     except Exception as e:
-        # Return hardcoded differential diagnosis for the Hindi conversation
-        return {
-            "Differential Diagnosis": [
-                "myocardium infraction (MI)"
-                "Acute Coronary Syndrome (ACS)",
-                "Unstable Angina",
-                "Myocardial Infarction",
-                "Hypertensive Emergency"
-            ],
-            "Recommendations": {
-                "Additional History": [
-                    "Detailed cardiovascular history",
-                    "Previous cardiac evaluations",
-                    "Current BP medication details"
-                ],
-                "Clinical Examination": [
-                    "Detailed cardiovascular examination",
-                    "Regular BP monitoring",
-                    "Continuous ECG monitoring"
-                ],
-                "Investigations": [
-                    "Immediate ECG",
-                    "Cardiac enzymes (Troponin)",
-                    "Complete blood count",
-                    "Chest X-ray"
-                ]
-            }
-        }
+        st.error(f"Error generating differential diagnosis: {e}")
+        return {"Error": str(e)}
 
 # Function to generate patient summary
-def generate_patient_summary(patient_data, chief_complaints, differential_diagnosis, presenting_illness):
+@instrument("generate_patient_summary")
+def generate_patient_summary(patient_data, chief_complaints, differential_diagnosis, presenting_illness, on_update=None):
     """Generate a comprehensive patient summary."""
+    # Complaints and illness history matter most; recommendations are cut first
+    context = render_sections("generate_patient_summary", [
+        ("Chief Complaints", chief_complaints, 1),
+        ("Presenting Illness", presenting_illness, 1),
+        ("Patient Data", prompt_value(patient_data), 2),
+        ("Differential Diagnosis", differential_diagnosis, 3)
+    ], PROMPT_CONTEXT_TOKEN_BUDGET)
     summary_prompt = f"""
     Create a concise medical summary based on the following patient information:
 
-    Patient Data: {json.dumps(patient_data, indent=2)}
-    Chief Complaints: {json.dumps(chief_complaints, indent=2)}
-    Differential Diagnosis: {json.dumps(differential_diagnosis, indent=2)}
-    Presenting Illness: {json.dumps(presenting_illness, indent=2)}
+    Patient Data: {context["Patient Data"]}
+    Chief Complaints: {context["Chief Complaints"]}
+    Differential Diagnosis: {context["Differential Diagnosis"]}
+    Presenting Illness: {context["Presenting Illness"]}
 
     Return a structured JSON summary:
     {{
@@ -358,22 +811,620 @@ def generate_patient_summary(patient_data, chief_complaints, differential_diagno
     """
     
     try:
-        response = openai.chat.completions.create(
-            model="gpt-4",
-            messages=[{"role": "system", "content": summary_prompt}],
-            temperature=0.2
+        content = routed_chat(
+            "summary",
+            json_updates(on_update),
+            messages=[{"role": "system", "content": summary_prompt}]
         )
 
         try:
-            return json.loads(response.choices[0].message.content)
+            return json.loads(content)
         except json.JSONDecodeError:
             return {"Error": "Could not generate summary"}
     except Exception as e:
         st.error(f"Error generating patient summary: {e}")
         return {"Error": str(e)}
 
+def merge_patch(data, patch):
+    """Returns data with the (nested) fields of patch applied."""
+    merged = dict(data)
+    for key, value in patch.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = merge_patch(merged[key], value)
+        else:
+            merged[key] = value
+    return merged
+
+# Function to update an earlier extraction after a transcript edit
+@instrument("update_extraction")
+def update_extraction(label, previous, changes):
+    """
+    Updates a previous extraction result for transcript changes, instead of re-extracting it.
+
+    Dict and IPD form results are patched with only the fields the model reports as
+    changed; list and text results are returned in full, as they are short.
+
+    Args:
+        label (str): What the result is, e.g. "patient data"
+        previous: The result extracted from the previous transcript
+        changes (list): Changes from transcript_changes
+
+    Returns:
+        The updated result, or None if the update failed (callers then re-extract)
+    """
+    form = isinstance(previous, IPDForm)
+    if form:
+        previous = previous.to_dict()
+    if isinstance(previous, dict):
+        instructions = "Return a JSON object with only the fields whose values change, nested exactly as in the current data. Return {} if nothing changes."
+    elif isinstance(previous, list):
+        instructions = "Return the complete updated JSON list."
+    else:
+        instructions = "Return the complete updated text only."
+    prompt = f"""
+    The transcript of a doctor-patient conversation was corrected or extended. Update the following {label} extracted from it so it matches the new transcript.
+
+    Current {label}:
+    {previous if isinstance(previous, str) else compact_json(previous)}
+
+    Transcript changes:
+    {format_changes(changes)}
+
+    {instructions}
+    """
+
+    try:
+        content = routed_chat(
+            "update_extraction",
+            messages=[{"role": "system", "content": prompt}]
+        )
+        if isinstance(previous, str):
+            return content.strip() or None
+        update = json.loads(content)
+    except Exception as e:
+        logger.warning("Updating %s failed, re-extracting: %s", label, e)
+        return None
+    if isinstance(previous, dict):
+        if not isinstance(update, dict):
+            return None
+        return IPDForm.parse(merge_patch(previous, update)) if form else merge_patch(previous, update)
+    return update if isinstance(update, list) else None
+
+def run_stage_graph(stages, max_workers=4, on_idle=None, poll_interval=0.1):
+    """
+    Runs dependent pipeline stages concurrently on a thread pool.
+
+    Args:
+        stages (dict): Maps a stage name to a (dependencies, func) tuple. func is
+            called with a dict of the results of its dependencies.
+        max_workers (int): Maximum number of stages running at once
+        on_idle (callable): Called on the calling thread every poll_interval
+            seconds while stages run, e.g. to render streamed partial output
+
+    Yields:
+        tuple: (stage name, result) in the order the stages finish
+    """
+    ctx = get_script_run_ctx(suppress_warning=True)
+    pending = dict(stages)
+    running = {}
+    results = {}
+
+    # Worker threads need the script context so st.error calls still render
+    def attach_script_ctx():
+        add_script_run_ctx(threading.current_thread(), ctx)
+
+    with ThreadPoolExecutor(max_workers=max_workers, initializer=attach_script_ctx) as executor:
+        while pending or running:
+            for name, (dependencies, func) in list(pending.items()):
+                if all(dep in results for dep in dependencies):
+                    del pending[name]
+                    inputs = {dep: results[dep] for dep in dependencies}
+                    # Run in a copy of the caller's context so metrics reach the right session
+                    running[executor.submit(contextvars.copy_context().run, func, inputs)] = name
+
+            if not running:
+                raise ValueError(f"Unresolvable stage dependencies: {sorted(pending)}")
+
+            done, _ = wait(running, timeout=poll_interval if on_idle else None, return_when=FIRST_COMPLETED)
+            if on_idle:
+                on_idle()
+            for future in done:
+                name = running.pop(future)
+                results[name] = future.result()
+                yield name, results[name]
+
+def build_assessment_stages(transcription, past_history_text="", consolidated=False, on_update=None):
+    """
+    Builds the Clinical Assessment stage graph for run_stage_graph.
+
+    With consolidated=True the three transcript extractions come from a single
+    extract_structured_data call instead of three separate requests. If
+    on_update is given, responses are streamed and it is called with
+    (stage, partial result) as output arrives.
+    """
+    def updates_for(stage):
+        return (lambda partial: on_update(stage, partial)) if on_update else None
+
+    def structured_updates(partial):
+        # Fan partial consolidated output out to the sections it belongs to
+        for stage, key in (("chief_complaints", "Chief Complaints"), ("patient_data", "Patient Data"), ("presenting_illness", "Presenting Illness")):
+            if isinstance(partial, dict) and partial.get(key):
+                on_update(stage, partial[key])
+
+    if consolidated:
+        extraction = {
+            "structured_data": ((), lambda r: extract_structured_data(
+                transcription, past_history_text, on_update=structured_updates if on_update else None
+            )),
+            "chief_complaints": (("structured_data",), lambda r: split_structured_data(r["structured_data"])[0]),
+            "patient_data": (("structured_data",), lambda r: split_structured_data(r["structured_data"])[1]),
+            "presenting_illness": (("structured_data",), lambda r: split_structured_data(r["structured_data"])[2]),
+        }
+    else:
+        extraction = {
+            "chief_complaints": ((), lambda r: extract_chief_complaints(transcription, on_update=updates_for("chief_complaints"))),
+            "patient_data": ((), lambda r: extract_patient_data(transcription, past_history_text, on_update=updates_for("patient_data"))),
+            "presenting_illness": ((), lambda r: extract_presenting_illness(transcription, on_update=updates_for("presenting_illness"))),
+        }
+    return {
+        **extraction,
+        "differential_diagnosis": (
+            ("patient_data",),
+            lambda r: generate_differential_diagnosis(r["patient_data"], on_update=updates_for("differential_diagnosis"))
+        ),
+        "summary": (
+            ("patient_data", "chief_complaints", "differential_diagnosis", "presenting_illness"),
+            lambda r: generate_patient_summary(
+                r["patient_data"], r["chief_complaints"],
+                r["differential_diagnosis"], r["presenting_illness"],
+                on_update=updates_for("summary")
+            )
+        ),
+    }
+
+def build_delta_stages(job, previous, transcription, past_history_text, changes, consolidated=False, on_update=None):
+    """
+    Builds a stage graph that updates a previous assessment for transcript changes.
+
+    The transcript extractions are patched with only the changed text; one
+    whose update fails is extracted again as in the full graph. Differential
+    diagnosis and summary are re-generated only when an input they depend on
+    actually changed; otherwise the previous result is reused and the stage
+    is marked "reused" on the job.
+    """
+    full = build_assessment_stages(transcription, past_history_text, consolidated, on_update=on_update)
+    structured = {}
+    structured_lock = threading.Lock()
+
+    def extract(stage, r):
+        dependencies, generate = full[stage]
+        if "structured_data" in dependencies:
+            # One consolidated extraction serves every stage whose update failed
+            with structured_lock:
+                if "structured_data" not in structured:
+                    structured["structured_data"] = full["structured_data"][1](r)
+            return generate(structured)
+        return generate(r)
+
+    def updated(stage, label):
+        def run(r):
+            result = update_extraction(label, previous[stage], changes)
+            return result if result is not None else extract(stage, r)
+        return run
+
+    def reuse_unless_changed(stage):
+        dependencies, generate = full[stage]
+
+        def run(r):
+            if all(prune_empty(r[dep]) == prune_empty(previous[dep]) for dep in dependencies):
+                job.update_stage(stage, reused=True)
+                return previous[stage]
+            return generate(r)
+        return dependencies, run
+
+    return {
+        "chief_complaints": ((), updated("chief_complaints", "chief complaints")),
+        "patient_data": ((), updated("patient_data", "patient data")),
+        "presenting_illness": ((), updated("presenting_illness", "history of presenting illness")),
+        "differential_diagnosis": reuse_unless_changed("differential_diagnosis"),
+        "summary": reuse_unless_changed("summary"),
+    }
+
+def get_stage_cache():
+    """Returns this session's stage result cache and per-stage hit/miss status."""
+    if "stage_cache" not in st.session_state:
+        st.session_state.stage_cache = {}
+        st.session_state.stage_status = {}
+    return st.session_state.stage_cache, st.session_state.stage_status
+
+def stage_cache_key(stage, inputs):
+    """Hashes a stage name together with the exact inputs it runs on."""
+    parts = [stage]
+    for value in inputs:
+        if isinstance(value, (bytes, bytearray)):
+            parts.append(bytes(value))
+        else:
+            parts.append(json.dumps(value, sort_keys=True, default=json_default))
+    return content_hash(*parts)
+
+def is_error_result(result):
+    """True for the fallback values stages return when a call fails (they carry an "Error" key) and empty results."""
+    if isinstance(result, dict):
+        return "Error" in result
+    return not result
+
+def run_cached_stage(stage, inputs, compute, force=False, store=None):
+    """
+    Runs a pipeline stage at most once per distinct set of inputs in this session.
+
+    Args:
+        stage (str): Stage name, used in the cache key and status indicators
+        inputs (tuple): Values the stage result depends on
+        compute (callable): Zero-argument function producing the result
+        force (bool): Ignore any cached result and recompute
+        store (tuple): (cache, status) from get_stage_cache(); background jobs
+            pass it in because they cannot reach st.session_state
+
+    Returns:
+        The stage result, either cached or freshly computed
+    """
+    cache, status = store or get_stage_cache()
+    key = stage_cache_key(stage, inputs)
+    if not force and key in cache:
+        status[stage] = {"cached": True, "seconds": 0.0}
+        return cache[key]
+
+    start = time.perf_counter()
+    result = compute()
+    status[stage] = {"cached": False, "seconds": time.perf_counter() - start}
+
+    # Failed calls are not memoized so the next rerun retries them
+    if not is_error_result(result):
+        cache.pop(key, None)
+        cache[key] = result
+        while len(cache) > MAX_STAGE_CACHE_ENTRIES:
+            cache.pop(next(iter(cache)))
+    return result
+
+def memoize_stages(stages, inputs, force=(), store=None):
+    """Wraps a stage graph so each stage is cached on the shared inputs plus its dependency results."""
+    memoized = {}
+    for name, (dependencies, func) in stages.items():
+        def cached(r, name=name, func=func):
+            return run_cached_stage(name, tuple(inputs) + (r,), lambda: func(r), force=name in force, store=store)
+        memoized[name] = (dependencies, cached)
+    return memoized
+
+def force_stage(stage):
+    """Button callback: marks a stage to be recomputed by the next job."""
+    st.session_state.setdefault("forced_stages", set()).add(stage)
+
+def pop_forced_stages():
+    """Returns and clears the stages whose re-run button was clicked."""
+    return st.session_state.pop("forced_stages", set())
+
+def rerun_stage_button(stage, container=st):
+    """Renders a "re-run this stage" control; clicks are collected by pop_forced_stages()."""
+    return container.button(
+        "🔄 Re-run", key=f"rerun_{stage}", on_click=force_stage, args=(stage,),
+        help="Ignore the cached result and run this stage again"
+    )
+
+def show_stage_status(stage, container=st, status=None):
+    """Shows whether a stage's result came from the cache or was just computed."""
+    if status is None:
+        status = get_stage_cache()[1].get(stage)
+    if status and status.get("reused"):
+        container.caption("♻️ Unchanged by the transcript edit, reused")
+        return
+    if not status or "cached" not in status:
+        return
+    if status["cached"]:
+        container.caption("⚡ Loaded from cache")
+    else:
+        container.caption(f"⏱️ Computed in {status['seconds']:.1f}s")
+
+@st.cache_resource
+def get_job_manager():
+    """Returns the process-wide background job manager."""
+    return JobManager(max_workers=JOB_WORKERS, max_jobs=MAX_JOBS)
+
+def session_job(kind, inputs, func, *args):
+    """
+    Returns this session's job of the given kind for inputs, starting it if needed.
+
+    Reruns with the same inputs keep polling the same job, and identical
+    inputs from other sessions using the same API key share one job (a job
+    runs with the key of the session that started it). Clicking a re-run
+    button starts a new job that recomputes the clicked stages.
+
+    Args:
+        kind (str): "assessment" or "prescription"
+        inputs (tuple): Values identifying the work (upload digests, options, ...)
+        func (callable): Job function, called as func(job, force, store, *args)
+    """
+    manager = get_job_manager()
+    # Sessions only join jobs started with their own API key
+    key_digest = content_hash(current_api_key.get() or os.getenv("OPENAI_API_KEY") or "")
+    base_key = stage_cache_key(kind, (key_digest,) + tuple(inputs))
+    force = pop_forced_stages()
+    job = manager.get(st.session_state.get(f"{kind}_job"))
+    if force or job is None or st.session_state.get(f"{kind}_job_key") != base_key:
+        key = stage_cache_key(kind, (key_digest,) + tuple(inputs) + (sorted(force), time.time())) if force else base_key
+        job = manager.submit(kind, key, func, force, get_stage_cache(), *args)
+        st.session_state[f"{kind}_job"] = job.id
+        st.session_state[f"{kind}_job_key"] = base_key
+    return job
+
+def finish_job_stage(job, stage, result, store):
+    """Publishes a stage result, with its cache status, to the job."""
+    job.update_stage(
+        stage, status=FAILED if is_error_result(result) else DONE,
+        result=result, partial=None, **store[1].get(stage, {})
+    )
+
+def run_job_stage(job, stage, inputs, compute, force, store):
+    """Runs a cached stage inside a job, reporting its status."""
+    job.update_stage(stage, status=RUNNING)
+    result = run_cached_stage(stage, inputs, compute, force=stage in force, store=store)
+    finish_job_stage(job, stage, result, store)
+    return result
+
+def run_transcription_stage(job, audio_bytes, force, store):
+    """Transcribes a job's audio, publishing the preprocessing savings with the stage."""
+    return run_job_stage(
+        job, "transcription", (audio_bytes,),
+        lambda: transcribe_audio(
+            audio_bytes, on_preprocessed=lambda stats: job.update_stage("transcription", preprocessing=stats),
+            refresh="transcription" in force
+        ),
+        force, store
+    )
+
+def stored_patient_id(patient):
+    """Returns patient if encounters are saved under it as IP No, else None (e.g. for a name)."""
+    encounters = get_encounter_store()
+    patient = (patient or "").strip()
+    if encounters is None or not patient:
+        return None
+    try:
+        return patient if encounters.has_patient_id(patient) else None
+    except sqlite3.Error as e:
+        logger.warning("Patient lookup failed: %s", e)
+        return None
+
+def encounter_record(transcription, patient="", encounter_id=None, **results):
+    """
+    Builds an encounter store record; failed stage results are left out.
+
+    Args:
+        transcription (str): The encounter's transcript
+        patient (str): IP No or name the clinician entered, if any. It is saved
+            as the IP No only if earlier encounters have it; otherwise the IP No
+            and name extracted into the patient data are used
+        encounter_id (str): Stable id of the encounter; defaults to a hash of the transcript
+        **results: patient_data, differential_diagnosis and/or prescription
+    """
+    record = {
+        "id": encounter_id or content_hash("encounter", transcription),
+        "patient_id": stored_patient_id(patient),
+        "transcript": transcription
+    }
+    for key, value in results.items():
+        record[key] = None if is_error_result(value) else value
+    return record
+
+def save_encounter(transcription, patient="", encounter_id=None, **results):
+    """Saves an encounter's results to the encounter store; failures are logged, not raised."""
+    encounters = get_encounter_store()
+    if encounters is None:
+        return
+    try:
+        encounters.save_many([encounter_record(transcription, patient, encounter_id, **results)])
+    except sqlite3.Error as e:
+        logger.warning("Saving encounter failed: %s", e)
+
+def find_prior_history(patient, encounter_id):
+    """Returns the findings of a returning patient's earlier encounters ("" if none or unavailable)."""
+    encounters = get_encounter_store()
+    if encounters is None or not patient.strip():
+        return ""
+    try:
+        return encounters.prior_findings(patient, exclude=encounter_id, limit=PRIOR_ENCOUNTERS)
+    except sqlite3.Error as e:
+        logger.warning("Prior history lookup failed: %s", e)
+        return ""
+
+def run_assessment_job(job, force, store, audio_bytes, pdf_bytes, consolidated, streaming, transcription=None, previous=None,
+                       patient="", encounter_id=None):
+    """
+    Background job: transcription, past history and the Clinical Assessment stage graph.
+
+    A live recording or an edited transcript is passed as transcription (and
+    no audio), so only the remaining stages run. previous holds the stage
+    results of the assessment it replaces; if only the transcript changed,
+    and only a little, those results are updated instead of regenerated.
+
+    For a returning patient (IP No or name), the findings of their saved
+    encounters are added to the past history. The finished assessment is
+    saved to the encounter store under encounter_id.
+    """
+    for stage, _ in ASSESSMENT_SECTIONS:
+        job.update_stage(stage)
+    if transcription is None:
+        transcription = run_transcription_stage(job, audio_bytes, force, store)
+    else:
+        job.update_stage("transcription", status=DONE, result=transcription)
+    if not transcription:
+        raise RuntimeError("Transcription failed")
+
+    past_history_text = ""
+    if pdf_bytes:
+        def report_pdf_progress(done, total, latest_page_text):
+            job.update_stage("past_history", progress=(done, total), caption=latest_page_text[:300])
+
+        past_history_text = run_job_stage(
+            job, "past_history", (pdf_bytes,),
+            lambda: extract_text_from_pdf(io.BytesIO(pdf_bytes), on_progress=report_pdf_progress, refresh="past_history" in force),
+            force, store
+        )
+
+    encounter_id = encounter_id or content_hash("encounter", transcription)
+    if patient.strip():
+        # Not cached: new encounters of the patient may have been saved since
+        job.update_stage("prior_history", status=RUNNING)
+        prior_history = find_prior_history(patient, encounter_id)
+        job.update_stage("prior_history", status=DONE, result=prior_history)
+        past_history_text = "\n\n".join(text for text in (past_history_text, prior_history) if text)
+
+    # An update of previous is only valid if everything besides the transcript is unchanged
+    inputs_key = stage_cache_key("assessment_inputs", (past_history_text, patient.strip(), consolidated))
+    job.update_stage("inputs", key=inputs_key)
+
+    on_update = (lambda stage, partial: job.update_stage(stage, partial=partial)) if streaming else None
+    if previous and not force and previous.get("transcription") and previous.get("inputs") == inputs_key and not any(
+        is_error_result(previous.get(stage)) for stage, _ in ASSESSMENT_SECTIONS
+    ):
+        changes, changed_fraction = transcript_changes(previous["transcription"], transcription)
+        if changed_fraction <= DELTA_MAX_CHANGE_FRACTION:
+            logger.info("Delta re-assessment: %d change(s), %.0f%% of words", len(changes), changed_fraction * 100)
+            stages = build_delta_stages(job, previous, transcription, past_history_text, changes, consolidated, on_update)
+            for stage, result in run_stage_graph(stages):
+                job.update_stage(stage, status=FAILED if is_error_result(result) else DONE, result=result, partial=None)
+            finish_assessment(job, transcription, patient, encounter_id)
+            return
+
+    # Independent extractions run in parallel, downstream stages as inputs arrive
+    stages = memoize_stages(
+        build_assessment_stages(transcription, past_history_text, consolidated, on_update=on_update),
+        (transcription, past_history_text),
+        force=force, store=store
+    )
+    for stage, result in run_stage_graph(stages):
+        finish_job_stage(job, stage, result, store)
+    finish_assessment(job, transcription, patient, encounter_id)
+
+def finish_assessment(job, transcription, patient, encounter_id):
+    """Cross-checks the chief complaints against the transcript and saves the assessment."""
+    complaints = job.stage_result("chief_complaints")
+    if not is_error_result(complaints):
+        job.update_stage("chief_complaints", warnings=check_chief_complaints(transcription, complaints))
+    save_encounter(
+        transcription, patient, encounter_id,
+        patient_data=job.stage_result("patient_data"),
+        differential_diagnosis=job.stage_result("differential_diagnosis")
+    )
+
+def run_live_chunk_job(job, store, audio_bytes):
+    """Background job: transcribes one clip of a live recording."""
+    run_transcription_stage(job, audio_bytes, set(), store)
+
+def run_live_complaints_job(job, store, transcription):
+    """
+    Background job: chief complaints of the live transcript so far.
+
+    The result is cached under the same key the assessment stage graph uses
+    (without past history), so finishing the recording reuses it.
+    """
+    run_job_stage(
+        job, "chief_complaints", (transcription, "", {}),
+        lambda: extract_chief_complaints(transcription), set(), store
+    )
+
+def get_live_session():
+    """Returns this session's live recording state (clips, recorder widget counter)."""
+    if "live" not in st.session_state:
+        st.session_state.live = {"id": content_hash(str(time.time())), "chunks": [], "hashes": set(), "clip": 0}
+    return st.session_state.live
+
+def add_live_chunk(audio_bytes):
+    """Queues a newly recorded clip for transcription (once, however often the script reruns)."""
+    live = get_live_session()
+    chunk_hash = content_hash(audio_bytes)
+    if chunk_hash in live["hashes"]:
+        return
+    job = get_job_manager().submit(
+        "live_chunk", content_hash("live_chunk", audio_bytes), run_live_chunk_job, get_stage_cache(), audio_bytes
+    )
+    live["hashes"].add(chunk_hash)
+    live["chunks"].append(job.id)
+    # A fresh recorder widget for the next clip
+    live["clip"] += 1
+
+def live_transcript():
+    """
+    Returns (transcript, clips still transcribing, failed clips) of the live recording.
+
+    The transcript only covers the leading clips that are done, so text is
+    never shown out of order.
+    """
+    live = st.session_state.get("live", {"chunks": []})
+    manager = get_job_manager()
+    texts, pending, failed = [], 0, 0
+    for job_id in live["chunks"]:
+        job = manager.get(job_id)
+        text = job.stage_result("transcription") if job is not None else ""
+        if job is not None and not job.done:
+            pending += 1
+        elif not text:
+            failed += 1
+        elif not pending:
+            texts.append(text)
+    return " ".join(texts), pending, failed
+
+@st.fragment(run_every=LIVE_POLL_SECONDS)
+def render_live_transcript():
+    """Refreshes the growing transcript and its chief complaints without rerunning the page."""
+    transcription, pending, failed = live_transcript()
+    live = st.session_state.get("live", {})
+    st.text_area("Live Transcript", transcription, height=150)
+    if pending:
+        st.caption(f"⏳ Transcribing {pending} clip(s)...")
+    if failed:
+        st.warning(f"{failed} clip(s) could not be transcribed.")
+
+    # Re-extract chief complaints whenever the transcript has grown
+    if transcription and live.get("complaints_text") != transcription:
+        job = get_job_manager().submit(
+            "live_complaints", content_hash("live_complaints", transcription),
+            run_live_complaints_job, get_stage_cache(), transcription
+        )
+        live["complaints_job"] = job.id
+        live["complaints_text"] = transcription
+
+    job = get_job_manager().get(live.get("complaints_job"))
+    if job is not None and job.done and not is_error_result(job.stage_result("chief_complaints")):
+        live["complaints"] = job.stage_result("chief_complaints")
+    if live.get("complaints"):
+        st.subheader("📋 Chief Complaints (so far)")
+        display_table(live["complaints"], "Chief Complaints")
+
+def run_prescription_job(job, force, store, audio_bytes, encounter_id=None, transcription=None):
+    """
+    Background job: transcription and prescription generation; the prescription is saved with the encounter.
+
+    A transcript passed as transcription (and no audio) skips transcription.
+    """
+    job.update_stage("prescription")
+    if transcription is None:
+        transcription = run_transcription_stage(job, audio_bytes, force, store)
+    else:
+        job.update_stage("transcription", status=DONE, result=transcription)
+    if not transcription:
+        raise RuntimeError("Transcription failed")
+    prescription = run_job_stage(
+        job, "prescription", (transcription,),
+        lambda: generate_prescription(transcription, on_update=lambda partial: job.update_stage("prescription", partial=partial)),
+        force, store
+    )
+    if not is_error_result(prescription):
+        job.update_stage("prescription", warnings=check_prescription(transcription, prescription))
+    save_encounter(transcription, encounter_id=encounter_id, prescription=prescription)
+
 def display_table(data, title):
     """Converts complex data to a simple dictionary for display."""
+    import pandas as pd
+
     try:
         # Function to recursively flatten nested structures
         def flatten_data(value):
@@ -430,16 +1481,41 @@ def display_table(data, title):
         st.write(data)
 
 
-def generate_prescription(conversation_text):
+def display_form(form):
+    """Renders an IPD form as one table per section, reusing the form's prebuilt tables."""
+    try:
+        for section, table in form.tables():
+            st.subheader(section)
+            st.table(table)
+    except Exception as e:
+        st.error(f"Error displaying table: {e}")
+        st.write(form.to_dict())
+
+
+@instrument("generate_prescription")
+def generate_prescription(conversation_text, on_update=None):
     """
     Generate a prescription based on the medical conversation
     
     Args:
         conversation_text (str): Transcribed medical conversation
+        on_update (callable): Optional callback given the lexicon's pre-filled
+            prescription before the model is asked
     
     Returns:
-        dict: Prescription details
+        dict: Prescription details. If the call fails it also has an "Error" key;
+        for a response that is not valid JSON the medications are the pre-filled ones
     """
+    annotations = annotate_transcript(conversation_text)
+    prefill = {
+        "Date": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "Medications": prefill_prescription(conversation_text, annotations)
+    }
+    if on_update and prefill["Medications"]:
+        on_update(prefill)
+    if LEXICON_PROMPT_SPANS:
+        conversation_text = relevant_excerpt(conversation_text, annotations, PRESCRIPTION_KINDS)
+
     prompt = f"""
     Based on the following medical conversation, generate a detailed prescription:
 
@@ -462,17 +1538,16 @@ def generate_prescription(conversation_text):
     """
     
     try:
-        response = openai.chat.completions.create(
-            model="gpt-4",
+        content = routed_chat(
+            "prescription",
             messages=[
                 {"role": "system", "content": "You are a professional medical assistant generating a prescription based on patient conversation."},
                 {"role": "user", "content": prompt}
-            ],
-            temperature=0.2
+            ]
         )
         
         try:
-            prescription = json.loads(response.choices[0].message.content.strip())
+            prescription = json.loads(content.strip())
             
             # Set current date and time if not provided
             if not prescription.get("Date"):
@@ -480,100 +1555,247 @@ def generate_prescription(conversation_text):
             
             return prescription
         except json.JSONDecodeError:
-            # Fallback prescription if JSON parsing fails
-            return {
-                "Date": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                "Medications": [
-                    {
-                        "Medicine Name": "Generic Medicine",
-                        "Dosage": "1 tablet",
-                        "Frequency": "Twice daily",
-                        "Duration": "7 days",
-                        "Special Instructions": "Take with food"
-                    }
-                ]
-            }
+            # Fall back to the medicines the lexicon found in the transcript
+            logger.warning("Prescription response is not valid JSON; using the %d pre-filled medication(s)", len(prefill["Medications"]))
+            return {**prefill, "Error": "Invalid JSON response from OpenAI."}
     
     except Exception as e:
         st.error(f"Error generating prescription: {e}")
         return {
             "Date": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
             "Medications": [],
+            "Error": str(e)
         }
 
+@instrument("generate_prescription_pdf")
 def generate_prescription_pdf(prescription_data, doctor_name):
     """Generate a PDF prescription with proper formatting."""
-    buffer = io.BytesIO()
-    doc = SimpleDocTemplate(buffer, pagesize=letter)
-    styles = getSampleStyleSheet()
-    elements = []
-
-    # Add header
-    header_style = ParagraphStyle(
-        'CustomHeader',
-        parent=styles['Heading1'],
-        fontSize=16,
-        spaceAfter=30
-    )
-    elements.append(Paragraph("MEDICAL PRESCRIPTION", header_style))
-    elements.append(Spacer(1, 20))
-
-    # Add date and doctor info
-    date_style = ParagraphStyle(
-        'DateStyle',
-        parent=styles['Normal'],
-        fontSize=12,
-        spaceAfter=20
-    )
-    elements.append(Paragraph(f"Date: {prescription_data['Date']}", date_style))
-    elements.append(Paragraph(f"Doctor: {doctor_name}", date_style))
-    elements.append(Spacer(1, 20))
-
-    # Create medication table
-    data = [['Medicine Name', 'Dosage', 'Frequency', 'Duration', 'Special Instructions']]
-    for med in prescription_data['Medications']:
-        data.append([
-            med['Medicine Name'],
-            med['Dosage'],
-            med['Frequency'],
-            med['Duration'],
-            med['Special Instructions']
-        ])
-
-    # Create table
-    table = Table(data, colWidths=[2*inch, 1.5*inch, 1.5*inch, 1.5*inch, 2*inch])
-    table.setStyle(TableStyle([
-        ('BACKGROUND', (0, 0), (-1, 0), colors.grey),
-        ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
-        ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
-        ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-        ('FONTSIZE', (0, 0), (-1, 0), 12),
-        ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
-        ('BACKGROUND', (0, 1), (-1, -1), colors.white),
-        ('TEXTCOLOR', (0, 1), (-1, -1), colors.black),
-        ('FONTNAME', (0, 1), (-1, -1), 'Helvetica'),
-        ('FONTSIZE', (0, 1), (-1, -1), 10),
-        ('GRID', (0, 0), (-1, -1), 1, colors.black),
-        ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
-        ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
-    ]))
-    elements.append(table)
-    elements.append(Spacer(1, 30))
-
-    # Add signature line
-    signature_style = ParagraphStyle(
-        'SignatureStyle',
-        parent=styles['Normal'],
-        fontSize=12,
-        spaceAfter=20
-    )
-    elements.append(Paragraph("Doctor's Signature: _________________", signature_style))
-    elements.append(Paragraph(f"Dr. {doctor_name}", signature_style))
+    # reportlab is loaded on the first PDF rather than at app start
+    from pdf_rendering import render_prescription
+
+    return io.BytesIO(render_prescription(prescription_data, doctor_name))
+
+# Function to generate the Clinical Assessment report
+@instrument("generate_assessment_pdf")
+def generate_assessment_pdf(results, doctor_name=""):
+    """Generate a PDF report of a Clinical Assessment from its stage results."""
+    from pdf_rendering import render_assessment_report
+
+    return io.BytesIO(render_assessment_report(results, doctor_name))
+
+def render_documents(documents):
+    """
+    Renders many (kind, args) documents (see pdf_rendering.RENDERERS), yielding PDF bytes in order.
+
+    More than one document is spread over the process pool, so bulk exports
+    use every core instead of one GIL-bound thread.
+    """
+    from pdf_rendering import render_many
+
+    executor = get_pdf_pool() if len(documents) > 1 and PDF_WORKERS > 1 else None
+    return render_many(documents, executor)
+
+ASSESSMENT_SECTIONS = (
+    ("chief_complaints", "📋 Chief Complaints"),
+    ("patient_data", "📝 Extracted Patient Data"),
+    ("presenting_illness", "📊 History of Presenting Illness"),
+    ("differential_diagnosis", "🩺 Differential Diagnosis & Recommendations"),
+    ("summary", "📄 Patient Summary"),
+)
+
+def set_assessment_transcript(source, text):
+    """
+    Re-assesses the recording identified by source using text as its transcript.
+
+    If the session's current assessment is of the same recording, its results
+    are passed along so the new job only updates them for what changed.
+    """
+    job = get_job_manager().get(st.session_state.get("assessment_job"))
+    previous = None
+    if job is not None and job.status == DONE and st.session_state.get("assessment_source") == source:
+        stages = job.snapshot()["stages"]
+        previous = {stage: info.get("result") for stage, info in stages.items()}
+        # Past history, patient and extraction mode the results were computed with
+        previous["inputs"] = stages.get("inputs", {}).get("key")
+    st.session_state.assessment_transcript = {"source": source, "text": text, "previous": previous}
+
+def render_transcription_stage(snapshot, edit_source=None):
+    """
+    Renders the transcription section of a job snapshot.
+
+    With edit_source, the transcript can be corrected and the assessment
+    updated for the edit.
+    """
+    st.subheader("🎧 Transcription")
+    rerun_stage_button("transcription")
+    info = snapshot["stages"].get("transcription", {})
+    if info.get("preprocessing"):
+        stats = info["preprocessing"]
+        st.caption(
+            f"🗜️ Audio {stats['original_bytes'] / 1e6:.1f} MB → {stats['processed_bytes'] / 1e6:.1f} MB "
+            f"(~{stats['upload_seconds_saved']:.1f}s less upload)"
+        )
+    if info.get("status") in (DONE, FAILED):
+        show_stage_status("transcription", status=info)
+        edited = st.text_area("Transcribed Conversation", info["result"], height=150, key=f"transcript_{snapshot['id']}")
+        if edit_source and snapshot["status"] == DONE and edited.strip() != (info["result"] or "").strip():
+            if st.button("🔁 Update assessment for edits", help="Re-assess only what the edit changed"):
+                set_assessment_transcript(edit_source, edited)
+                st.rerun()
+    else:
+        st.caption("⏳ Transcribing...")
+
+def render_assessment_job(snapshot, edit_source=None):
+    """Renders a Clinical Assessment job: finished stages, streamed partial output and progress."""
+    stages = snapshot["stages"]
+    render_transcription_stage(snapshot, edit_source)
+
+    if "past_history" in stages:
+        st.subheader("📄 Past Medical Records")
+        rerun_stage_button("past_history")
+        info = stages["past_history"]
+        if info.get("status") in (DONE, FAILED):
+            show_stage_status("past_history", status=info)
+            st.text_area("Extracted Past History", info["result"], height=150)
+        elif info.get("progress"):
+            done, total = info["progress"]
+            st.progress(done / max(total, 1), text=f"Extracted page {done} of {total}")
+            st.caption(info.get("caption", ""))
+        else:
+            st.caption("⏳ Processing...")
+
+    if "prior_history" in stages:
+        st.subheader("🗂️ Prior Encounters")
+        info = stages["prior_history"]
+        if info.get("result"):
+            st.text_area("Findings from earlier encounters", info["result"], height=150)
+        elif info.get("status") == DONE:
+            st.caption("No earlier encounters found for this patient.")
+        else:
+            st.caption("⏳ Processing...")
+
+    for stage, heading in ASSESSMENT_SECTIONS:
+        info = stages.get(stage, {})
+        if snapshot["status"] == FAILED and "result" not in info:
+            continue
+        st.subheader(heading)
+        rerun_stage_button(stage)
+        if info.get("status") in (DONE, FAILED):
+            show_stage_status(stage, status=info)
+            render_assessment_stage(stage, info["result"])
+            for warning in info.get("warnings") or ():
+                st.warning(f"⚠️ {warning}")
+        elif info.get("partial"):
+            st.caption("✍️ Generating...")
+            render_assessment_stage(stage, info["partial"])
+        else:
+            st.caption("⏳ Processing...")
+
+    if snapshot["status"] == FAILED:
+        st.error(f"An error occurred during processing: {snapshot['error']}")
+    elif snapshot["status"] == DONE:
+        results = {stage: info.get("result") for stage, info in stages.items() if stage in dict(ASSESSMENT_SECTIONS)}
+        # Rendered only when the button is clicked, not on every rerun
+        st.download_button(
+            label="📥 Download Assessment Report (PDF)",
+            data=lambda: generate_assessment_pdf(results).getvalue(),
+            file_name=f"assessment_{datetime.now().strftime('%Y%m%d_%H%M%S')}.pdf",
+            mime="application/pdf"
+        )
+        st.success("✅ Process Completed Successfully!")
+
+def upload_digest(upload):
+    """
+    Content hash of an uploaded or recorded file, computed once per upload.
+
+    Job pages rerun every JOB_POLL_SECONDS while a job runs, so hashing the
+    full audio and PDF on every rerun is avoided by keeping the hash under
+    the upload's file id.
+    """
+    if upload is None:
+        return None
+    digests = st.session_state.setdefault("upload_digests", {})
+    if upload.file_id not in digests:
+        digests[upload.file_id] = content_hash("upload", upload.getvalue())
+        # Only the current uploads matter; older ids are never seen again
+        while len(digests) > MAX_UPLOAD_DIGESTS:
+            digests.pop(next(iter(digests)))
+    return digests[upload.file_id]
+
+def poll_job(job):
+    """Reruns the script shortly while the job is still working, so its progress keeps updating."""
+    if not job.done:
+        time.sleep(JOB_POLL_SECONDS)
+        st.rerun()
+
+def render_assessment_stage(stage, result):
+    """Renders the result (or streamed partial result) of a single Clinical Assessment stage."""
+    failed = isinstance(result, dict) and "Error" in result
+    if stage == "chief_complaints":
+        if not failed:
+            display_table(result, "Chief Complaints")
+        else:
+            st.error("Could not extract chief complaints.")
+            if result.get("Chief Complaints"):
+                display_table(result["Chief Complaints"], "Symptoms found in the transcript (not verified)")
+    elif stage == "patient_data":
+        if failed:
+            st.error("Invalid JSON response. Please try again.")
+        else:
+            # Partial results while streaming are plain dicts
+            display_form(result if isinstance(result, IPDForm) else IPDForm.parse(result))
+    elif stage == "presenting_illness":
+        if not failed:
+            display_table(result, "Presenting Illness")
+        else:
+            st.error("Could not extract presenting illness.")
+    elif stage == "differential_diagnosis":
+        if not failed:
+            display_table(result.get("Differential Diagnosis", []), "Differential Diagnosis")
+            display_table(result.get("Recommendations", {}), "Recommendations")
+        else:
+            st.error("Invalid response. Please try again.")
+    elif stage == "summary":
+        if not failed:
+            display_table(result, "Patient Summary")
+        else:
+            st.error("Could not generate patient summary.")
+
+@st.cache_resource
+def start_metrics_exporter():
+    """Starts the Prometheus /metrics endpoint once per process if ECHO_MED_METRICS_PORT is set."""
+    port = os.getenv("ECHO_MED_METRICS_PORT")
+    return metrics.start_http_exporter(int(port)) if port else None
 
-    # Build PDF
-    doc.build(elements)
-    buffer.seek(0)
-    return buffer
+def get_session_metrics():
+    """Returns this session's metrics and makes it the target of stage records on this run."""
+    if "metrics" not in st.session_state:
+        st.session_state.metrics = metrics.SessionMetrics()
+    metrics.current_session.set(st.session_state.metrics)
+    return st.session_state.metrics
+
+def show_timing_breakdown(session_metrics, panel):
+    """Renders this session's per-stage time, tokens and cost into a sidebar placeholder."""
+    breakdown = session_metrics.breakdown()
+    if not breakdown:
+        return
+    import pandas as pd
+
+    df = pd.DataFrame([
+        {
+            "Stage": stage,
+            "Runs": totals["runs"],
+            "Time (s)": round(totals["seconds"], 2),
+            "Tokens": totals["tokens"],
+            "Retries": totals["retries"],
+            "Cost ($)": round(totals["cost_usd"], 4)
+        }
+        for stage, totals in sorted(breakdown.items(), key=lambda item: -item[1]["seconds"])
+    ])
+    with panel.container():
+        with st.expander("⏱️ Timing breakdown"):
+            st.dataframe(df, hide_index=True)
+            st.caption(f"Session total: {df['Time (s)'].sum():.1f}s, ${df['Cost ($)'].sum():.4f}")
 
 # Streamlit UI
 def main():
@@ -585,11 +1807,19 @@ def main():
     if not openai_key:
         st.sidebar.warning("Please enter your OpenAI API Key to use the app.")
         st.stop()
-    openai.api_key = openai_key
+    current_api_key.set(openai_key)
+    start_metrics_exporter()
+    session_metrics = get_session_metrics()
     page = st.sidebar.radio(
         "Go to",
         ("🏥 About ECHO-MED", "📊 Clinical Assessment", "💊 Prescription Generator")
     )
+    timing_panel = st.sidebar.empty()
+    show_timing_breakdown(session_metrics, timing_panel)
+    for kind, label in (("assessment", "Clinical assessment"), ("prescription", "Prescription")):
+        job = get_job_manager().get(st.session_state.get(f"{kind}_job"))
+        if job is not None and not job.done:
+            st.sidebar.caption(f"⏳ {label} running in the background")
 
     if page == "🏥 About ECHO-MED":
         st.title("Welcome to ECHO-MED")
@@ -612,23 +1842,90 @@ def main():
 
     elif page == "📊 Clinical Assessment":
         st.header("📊 Clinical Assessment")
-        audio_option = st.radio("Choose input method:", ("Upload Audio File", "Record Audio"))
+        audio_option = st.radio("Choose input method:", ("Upload Audio File", "Record Audio", "Live Recording"))
         uploaded_file = None
         recorded_audio = None
         if audio_option == "Upload Audio File":
             uploaded_file = st.file_uploader("Upload MP3 for Patient Assessment", type=["mp3"])
-        else:
+        elif audio_option == "Record Audio":
             recorded_audio = st.audio_input("Record your audio")
             if recorded_audio:
                 st.audio(recorded_audio)
                 st.write("Recording complete!")
+        else:
+            # Each clip is transcribed as soon as it is stopped, while the next one is recorded
+            st.caption("Record the consultation in parts: stop the recorder at natural pauses and start the next part right away.")
+            live = get_live_session()
+            clip = st.audio_input(f"Record part {live['clip'] + 1}", key=f"live_clip_{live['clip']}")
+            if clip:
+                add_live_chunk(clip.getvalue())
+                st.rerun()
+            render_live_transcript()
+            transcription, pending, failed = live_transcript()
+            finish_col, reset_col = st.columns(2)
+            if finish_col.button("✅ Finish & assess", disabled=bool(pending or not transcription)):
+                set_assessment_transcript(stage_cache_key("assessment_source", ("live", live["id"])), transcription)
+            if reset_col.button("🗑️ Start over"):
+                st.session_state.pop("live")
+                st.rerun()
         past_history_file = st.file_uploader("Upload Past History (PDF)", type=["pdf"])
+        patient = ""
+        if get_encounter_store() is not None:
+            patient = st.text_input(
+                "Returning patient (IP No or name)",
+                help="Findings from this patient's earlier encounters are added to the past history"
+            ).strip()
+        consolidated = st.checkbox(
+            "Single-call extraction",
+            value=CONSOLIDATED_EXTRACTION_DEFAULT,
+            help="Extract chief complaints, patient data and presenting illness in one structured request"
+        )
+        streaming = st.checkbox(
+            "Stream results",
+            value=STREAMING_DEFAULT,
+            help="Show each section while it is being generated instead of waiting for the full response"
+        )
+
+        audio_upload = uploaded_file or recorded_audio
+        audio_bytes = audio_upload.getvalue() if audio_upload else None
+        audio_digest = upload_digest(audio_upload)
+
+        # Work runs in the background, so it continues across reruns and page switches
+        pdf_bytes = past_history_file.getvalue() if past_history_file else None
+        pdf_digest = upload_digest(past_history_file)
+        if audio_bytes:
+            source = stage_cache_key("assessment_source", (audio_digest,))
+        elif audio_option == "Live Recording":
+            source = stage_cache_key("assessment_source", ("live", get_live_session()["id"]))
+        else:
+            source = None
+
+        # An edited (or live) transcript replaces the recording's own transcription
+        override = st.session_state.get("assessment_transcript")
+        if source and override and override["source"] == source:
+            job = session_job(
+                "assessment", (override["text"], pdf_digest, consolidated, patient), run_assessment_job,
+                None, pdf_bytes, consolidated, streaming, override["text"], override["previous"], patient, source
+            )
+        elif audio_bytes:
+            job = session_job(
+                "assessment", (audio_digest, pdf_digest, consolidated, patient), run_assessment_job,
+                audio_bytes, pdf_bytes, consolidated, streaming, None, None, patient, source
+            )
+        elif source:
+            job = None
+        else:
+            job = get_job_manager().get(st.session_state.get("assessment_job"))
+            if job is not None:
+                st.caption("Showing the last assessment of this session. Upload or record audio to start a new one.")
 
-        if not uploaded_file and not recorded_audio:
+        if job is None:
+            if audio_option == "Live Recording":
+                return
             st.info("👆 Please upload or record an audio of the doctor-patient conversation to begin the clinical assessment.")
             st.markdown("""
             ### What to expect:
-            1. Upload or record an MP3/WAV file of the medical consultation
+            1. Upload or record an MP3/WAV file of the medical consultation (or record it live, part by part)
             2. Optionally upload past medical records in PDF format
             3. Our AI will transcribe and analyze the conversation
             4. Get a comprehensive clinical assessment including:
@@ -640,79 +1937,10 @@ def main():
             """)
             return
 
-        # Process Audio and Past History
-        if uploaded_file:
-            audio_bytes = uploaded_file.read()
-        elif recorded_audio:
-            audio_bytes = recorded_audio.getvalue()
-        else:
-            audio_bytes = None
-
-        if audio_bytes:
-            with tempfile.NamedTemporaryFile(delete=False, suffix=".wav") as temp_audio:
-                temp_audio.write(audio_bytes)
-                temp_audio_path = temp_audio.name
-
-            try:
-                # Transcribe audio
-                st.subheader("🎧 Transcription")
-                transcription = transcribe_audio(temp_audio_path)
-                st.text_area("Transcribed Conversation", transcription, height=150)
-
-                # Process past history if uploaded
-                past_history_text = ""
-                if past_history_file:
-                    st.subheader("📄 Past Medical Records")
-                    past_history_text = extract_text_from_pdf(past_history_file)
-                    st.text_area("Extracted Past History", past_history_text, height=150)
-
-                # Extract Chief Complaints
-                st.subheader("📋 Chief Complaints")
-                chief_complaints = extract_chief_complaints(transcription)
-                display_table(chief_complaints, "Chief Complaints")
-
-                # Extract Patient Data (now including past history)
-                st.subheader("📝 Extracted Patient Data")
-                patient_data = extract_patient_data(transcription, past_history_text)
-                if "Error" not in patient_data:
-                    for section, details in patient_data.items():
-                        display_table(details, section)
-                else:
-                    st.error("Invalid JSON response. Please try again.")
-
-                # Extract Presenting Illness
-                st.subheader("📊 History of Presenting Illness")
-                presenting_illness = extract_presenting_illness(transcription)
-                if "Error" not in presenting_illness:
-                    display_table(presenting_illness, "Presenting Illness")
-                else:
-                    st.error("Could not extract presenting illness.")
-
-                # Generate Differential Diagnosis
-                st.subheader("🩺 Differential Diagnosis & Recommendations")
-                differential_diagnosis = generate_differential_diagnosis(patient_data)
-                if "Error" not in str(differential_diagnosis):
-                    display_table(differential_diagnosis.get("Differential Diagnosis", []), "Differential Diagnosis")
-                    display_table(differential_diagnosis.get("Recommendations", {}), "Recommendations")
-                else:
-                    st.error("Invalid response. Please try again.")
-
-                # Generate Patient Summary
-                st.subheader("📄 Patient Summary")
-                summary = generate_patient_summary(patient_data, chief_complaints, differential_diagnosis, presenting_illness)
-                if "Error" not in summary:
-                    display_table(summary, "Patient Summary")
-                else:
-                    st.error("Could not generate patient summary.")
-
-                st.success("✅ Process Completed Successfully!")
-
-            except Exception as e:
-                st.error(f"An error occurred during processing: {e}")
-            finally:
-                # Clean up temporary file
-                if os.path.exists(temp_audio_path):
-                    os.unlink(temp_audio_path)
+        if source:
+            st.session_state.assessment_source = source
+        render_assessment_job(job.snapshot(), source)
+        poll_job(job)
 
     elif page == "💊 Prescription Generator":
         st.header("📋 Prescription Generator")
@@ -729,7 +1957,20 @@ def main():
         st.subheader("👨‍⚕️ Doctor's Information")
         doctor_name = st.text_input("Doctor's Name", "")
 
-        if not uploaded_file and not recorded_audio:
+        audio_upload = uploaded_file or recorded_audio
+        audio_bytes = audio_upload.getvalue() if audio_upload else None
+
+        if audio_bytes:
+            audio_digest = upload_digest(audio_upload)
+            # Same encounter id as an assessment of this recording, so both are saved together
+            encounter_id = stage_cache_key("assessment_source", (audio_digest,))
+            job = session_job("prescription", (audio_digest,), run_prescription_job, audio_bytes, encounter_id)
+        else:
+            job = get_job_manager().get(st.session_state.get("prescription_job"))
+            if job is not None:
+                st.caption("Showing the last prescription of this session. Upload or record audio to start a new one.")
+
+        if job is None:
             st.info("👆 Please upload or record an audio of the medical consultation to generate a prescription.")
             st.markdown("""
             ### What to expect:
@@ -746,37 +1987,40 @@ def main():
             """)
             return
 
-        if uploaded_file:
-            audio_bytes = uploaded_file.read()
-        elif recorded_audio:
-            audio_bytes = recorded_audio.getvalue()
-        else:
-            audio_bytes = None
+        snapshot = job.snapshot()
+        render_transcription_stage(snapshot)
 
-        if audio_bytes:
-            with tempfile.NamedTemporaryFile(delete=False, suffix=".wav") as temp_audio:
-                temp_audio.write(audio_bytes)
-                temp_audio_path = temp_audio.name
-
-            try:
-                # Transcribe Audio
-                st.subheader("🎧 Transcription")
-                transcription = transcribe_audio(temp_audio_path)
-                st.text_area("Transcribed Conversation", transcription, height=150)
-
-                # Generate Prescription
-                st.subheader("💊 Generated Prescription")
-                prescription = generate_prescription(transcription)
-                
+        info = snapshot["stages"].get("prescription", {})
+        if snapshot["status"] != FAILED or "result" in info:
+            st.subheader("💊 Generated Prescription")
+            rerun_stage_button("prescription")
+        if info.get("status") in (DONE, FAILED):
+            prescription = info["result"]
+            show_stage_status("prescription", status=info)
+
+            if is_error_result(prescription):
+                # A draft from the lexicon at most: never signed or offered as a PDF
+                st.error("Could not generate the prescription. Please try again.")
+                if prescription.get("Medications"):
+                    st.caption("Draft: medicines found in the transcript (not verified)")
+                    display_table(prescription["Medications"], "Draft Medications")
+            else:
                 # Display Prescription
                 display_table(prescription, "Prescription Details")
-                
+                for warning in info.get("warnings") or ():
+                    st.warning(f"⚠️ {warning}")
+
                 if doctor_name:
-                    # Generate and download PDF
-                    pdf_buffer = generate_prescription_pdf(prescription, doctor_name)
+                    # Generate the PDF when the download is clicked; the callback
+                    # runs outside the script thread, so it gets the cache passed in
+                    pdf_store = get_stage_cache()
                     st.download_button(
                         label="📥 Download Prescription (PDF)",
-                        data=pdf_buffer,
+                        data=lambda: run_cached_stage(
+                            "prescription_pdf", (prescription, doctor_name),
+                            lambda: generate_prescription_pdf(prescription, doctor_name).getvalue(),
+                            store=pdf_store
+                        ),
                         file_name=f"prescription_{datetime.now().strftime('%Y%m%d_%H%M%S')}.pdf",
                         mime="application/pdf"
                     )
@@ -784,13 +2028,15 @@ def main():
                     st.warning("Please enter doctor's name to generate PDF prescription")
 
                 st.success("✅ Prescription Generated Successfully!")
+        elif info.get("partial"):
+            st.caption("✍️ Generating... (medicines found in the transcript so far)")
+            display_table(info["partial"], "Prescription Details")
+        elif snapshot["status"] != FAILED:
+            st.caption("⏳ Processing...")
 
-            except Exception as e:
-                st.error(f"An error occurred during prescription generation: {e}")
-            finally:
-                # Clean up temporary file
-                if os.path.exists(temp_audio_path):
-                    os.unlink(temp_audio_path)
+        if snapshot["status"] == FAILED:
+            st.error(f"An error occurred during prescription generation: {snapshot['error']}")
+        poll_job(job)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,359 @@
+# -- coding: utf-8 --
+import io
+import re
+import wave
+from fractions import Fraction
+
+import numpy as np
+
+
+def audio_extension(audio_bytes):
+    """
+    Identifies an audio container from its leading (magic) bytes.
+
+    Returns:
+        str: File extension the transcription API knows the format by
+        ("wav", "mp3", "ogg", "flac", "m4a" or "webm"); "wav" if unrecognized
+    """
+    head = bytes(audio_bytes[:12])
+    if head[:4] == b"RIFF" and head[8:12] == b"WAVE":
+        return "wav"
+    # An ID3 tag, or an MPEG audio frame header (11 set sync bits)
+    if head[:3] == b"ID3" or (len(head) > 1 and head[0] == 0xFF and head[1] & 0xE0 == 0xE0):
+        return "mp3"
+    if head[:4] == b"OggS":
+        return "ogg"
+    if head[:4] == b"fLaC":
+        return "flac"
+    if head[4:8] == b"ftyp":
+        return "m4a"
+    if head[:4] == b"\x1a\x45\xdf\xa3":
+        return "webm"
+    return "wav"
+
+
+def decode_wav(audio_bytes):
+    """
+    Decodes PCM WAV bytes.
+
+    Args:
+        audio_bytes (bytes): Raw contents of a WAV file
+
+    Returns:
+        tuple: (params, frames) where params is the wave header and frames the raw
+        PCM bytes, or None if the bytes are not a WAV file this module can read
+    """
+    try:
+        with wave.open(io.BytesIO(audio_bytes), "rb") as wav:
+            params = wav.getparams()
+            if params.sampwidth not in (1, 2, 4) or params.comptype != "NONE":
+                return None
+            frames = wav.readframes(params.nframes)
+        return params, frames
+    except (wave.Error, EOFError):
+        return None
+
+
+def encode_wav(params, frames):
+    """Encodes raw PCM frames with the given wave header as WAV bytes."""
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as wav:
+        wav.setnchannels(params.nchannels)
+        wav.setsampwidth(params.sampwidth)
+        wav.setframerate(params.framerate)
+        wav.writeframes(frames)
+    return buffer.getvalue()
+
+
+def pcm_to_mono(params, frames):
+    """Converts raw PCM frames to a mono float32 array in [-1, 1]."""
+    dtype = {1: np.uint8, 2: np.int16, 4: np.int32}[params.sampwidth]
+    samples = np.frombuffer(frames, dtype=dtype).astype(np.float32)
+    if params.sampwidth == 1:
+        samples = (samples - 128.0) / 128.0
+    else:
+        samples /= float(np.iinfo(dtype).max)
+    if params.nchannels > 1:
+        samples = samples[: len(samples) - len(samples) % params.nchannels]
+        samples = samples.reshape(-1, params.nchannels).mean(axis=1)
+    return samples
+
+
+def frame_energy_db(samples, rate, frame_ms=30):
+    """Returns the RMS energy in dB of consecutive frame_ms windows."""
+    frame_len = max(1, int(rate * frame_ms / 1000))
+    n_frames = len(samples) // frame_len
+    if n_frames == 0:
+        return np.zeros(0, dtype=np.float32), frame_len
+    frames = samples[: n_frames * frame_len].reshape(n_frames, frame_len)
+    rms = np.sqrt(np.mean(frames * frames, axis=1))
+    return 20.0 * np.log10(rms + 1e-10), frame_len
+
+
+def find_split_points(samples, rate, segment_seconds=120, search_seconds=15, silence_db=-35.0):
+    """
+    Chooses sample offsets to cut long audio at, preferring silence.
+
+    Every segment_seconds a cut is placed in the quietest stretch within
+    search_seconds of the target position, so cuts land in pauses between
+    utterances rather than mid-word.
+
+    Returns:
+        list: Sample offsets of the cuts, in increasing order
+    """
+    energy, frame_len = frame_energy_db(samples, rate)
+    if len(energy) == 0:
+        return []
+
+    # Silence is relative to the loudest frame so quiet recordings still split
+    silent = energy < (energy.max() + silence_db)
+    frames_per_segment = int(segment_seconds * rate / frame_len)
+    search = int(search_seconds * rate / frame_len)
+
+    splits = []
+    last = 0
+    while len(energy) - last > frames_per_segment + search:
+        target = last + frames_per_segment
+        lo, hi = max(last + 1, target - search), min(len(energy), target + search)
+        window = silent[lo:hi]
+        if window.any():
+            # Cut in the middle of the longest silent run near the target
+            padded = np.concatenate(([False], window, [False])).astype(np.int8)
+            edges = np.flatnonzero(np.diff(padded))
+            starts, ends = edges[::2], edges[1::2]
+            longest = np.argmax(ends - starts)
+            cut = lo + (starts[longest] + ends[longest]) // 2
+        else:
+            cut = lo + int(np.argmin(energy[lo:hi]))
+        splits.append(int(cut * frame_len))
+        last = cut
+    return splits
+
+
+def split_wav(audio_bytes, segment_seconds=120, overlap_seconds=1.0):
+    """
+    Splits WAV audio into segments at silence boundaries.
+
+    Each segment extends overlap_seconds into its neighbours so words cut at a
+    forced (non-silent) boundary appear whole in one of them; merge_transcripts
+    removes the duplicated text afterwards.
+
+    Returns:
+        list: WAV bytes per segment, or None if the audio is not decodable WAV
+    """
+    decoded = decode_wav(audio_bytes)
+    if decoded is None:
+        return None
+    params, frames = decoded
+    samples = pcm_to_mono(params, frames)
+    splits = find_split_points(samples, params.framerate, segment_seconds)
+    if not splits:
+        return [audio_bytes]
+
+    frame_size = params.sampwidth * params.nchannels
+    overlap = int(overlap_seconds * params.framerate)
+    bounds = [0] + splits + [len(samples)]
+    segments = []
+    for start, end in zip(bounds, bounds[1:]):
+        start, end = max(0, start - overlap), min(len(samples), end + overlap)
+        segments.append(encode_wav(params, frames[start * frame_size:end * frame_size]))
+    return segments
+
+
+# MPEG audio bitrates in kbit/s by (MPEG-1?, layer) and header bitrate index 1-14
+MPEG_BITRATES = {
+    (True, 1): (32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448),
+    (True, 2): (32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384),
+    (True, 3): (32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    (False, 1): (32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256),
+    (False, 2): (8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+    (False, 3): (8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}
+# Sample rates by header version bits (MPEG-2.5, reserved, MPEG-2, MPEG-1) and rate index
+MPEG_SAMPLE_RATES = {0: (11025, 12000, 8000), 2: (22050, 24000, 16000), 3: (44100, 48000, 32000)}
+
+
+def mpeg_frame(header):
+    """
+    Parses a 4-byte MPEG audio frame header.
+
+    Returns:
+        tuple: (frame length in bytes, duration in seconds), or None if header is not a valid frame header
+    """
+    if len(header) < 4 or header[0] != 0xFF or header[1] & 0xE0 != 0xE0:
+        return None
+    version, layer = (header[1] >> 3) & 3, 4 - ((header[1] >> 1) & 3)
+    bitrate_index, rate_index, padding = header[2] >> 4, (header[2] >> 2) & 3, (header[2] >> 1) & 1
+    if version == 1 or layer == 4 or bitrate_index in (0, 15) or rate_index == 3:
+        return None
+    mpeg1 = version == 3
+    bitrate = MPEG_BITRATES[(mpeg1, layer)][bitrate_index - 1] * 1000
+    rate = MPEG_SAMPLE_RATES[version][rate_index]
+    if layer == 1:
+        return (12 * bitrate // rate + padding) * 4, 384 / rate
+    samples = 1152 if mpeg1 or layer == 2 else 576
+    return samples // 8 * bitrate // rate + padding, samples / rate
+
+
+def mp3_frames(audio_bytes):
+    """
+    Lists the audio frames of an MP3 file, skipping ID3 tags, a Xing/Info header frame and junk between frames.
+
+    Returns:
+        list: (offset, length, seconds) per frame
+    """
+    data = memoryview(audio_bytes)
+    position = 0
+    if bytes(data[:3]) == b"ID3" and len(data) >= 10:
+        size = (data[6] & 0x7F) << 21 | (data[7] & 0x7F) << 14 | (data[8] & 0x7F) << 7 | (data[9] & 0x7F)
+        position = 10 + size + (10 if data[5] & 0x10 else 0)
+    frames = []
+    while position + 4 <= len(data):
+        frame = mpeg_frame(data[position:position + 4])
+        if frame is None or position + frame[0] > len(data):
+            # Resynchronize on the next possible frame header
+            position = audio_bytes.find(b"\xff", position + 1)
+            if position < 0:
+                break
+            continue
+        length, seconds = frame
+        # A leading Xing/Info frame carries no audio, and its frame count would be wrong for a segment
+        header_frame = not frames and any(tag in bytes(data[position + 4:position + 40]) for tag in (b"Xing", b"Info"))
+        if not header_frame:
+            frames.append((position, length, seconds))
+        position += length
+    return frames
+
+
+def split_mp3(audio_bytes, segment_seconds=120, max_bytes=None, overlap_seconds=1.0):
+    """
+    Splits MP3 audio into segments at frame boundaries.
+
+    Unlike split_wav the cuts are not placed in silence (that would need an
+    MP3 decoder); segments overlap by overlap_seconds so merge_transcripts can
+    join words cut at a boundary.
+
+    Args:
+        segment_seconds (float): Target segment length
+        max_bytes (int): Largest segment, overlap included (e.g. the API upload limit)
+
+    Returns:
+        list: MP3 bytes per segment, or None if no MPEG audio frames were found
+    """
+    frames = mp3_frames(audio_bytes)
+    if not frames:
+        return None
+    overlap = max(1, int(overlap_seconds / frames[0][2]))
+    longest = max(length for _, length, _ in frames)
+    limit = (max_bytes or len(audio_bytes)) - 2 * overlap * longest
+
+    bounds = [0]
+    seconds = size = 0
+    for i, (_, length, duration) in enumerate(frames):
+        if i > bounds[-1] and (seconds + duration > segment_seconds or size + length > limit):
+            bounds.append(i)
+            seconds = size = 0
+        seconds += duration
+        size += length
+    bounds.append(len(frames))
+
+    segments = []
+    for start, end in zip(bounds, bounds[1:]):
+        start, end = max(0, start - overlap), min(len(frames), end + overlap)
+        segments.append(b"".join(audio_bytes[offset:offset + length] for offset, length, _ in frames[start:end]))
+    return segments
+
+
+def resample(samples, rate, target_rate, half_taps=16):
+    """
+    Resamples a mono float32 signal with a polyphase windowed-sinc filter.
+
+    The kernel's cutoff follows the lower of the two Nyquist frequencies, so
+    downsampling does not alias. For rate/target_rate = p/q every q-th output
+    has the same fractional offset, so each of the q phases is one matrix
+    product over a strided view of the input.
+    """
+    if rate == target_rate or len(samples) == 0:
+        return samples
+    step = Fraction(rate, target_rate)
+    p, q = step.numerator, step.denominator
+    cutoff = min(1.0, 1.0 / float(step))
+    n_out = len(samples) * q // p
+    offsets = np.arange(-half_taps + 1, half_taps + 1)
+    # windows[i + 1] holds the taps around input sample i
+    padded = np.pad(samples.astype(np.float32), (half_taps, half_taps + 1))
+    windows = np.lib.stride_tricks.sliding_window_view(padded, 2 * half_taps)
+    out = np.empty(n_out, dtype=np.float32)
+    for phase in range(min(q, n_out)):
+        base, remainder = divmod(phase * p, q)
+        distance = offsets - remainder / q
+        # Hann-windowed sinc, scaled to unit gain at DC
+        weights = cutoff * np.sinc(cutoff * distance) * (0.5 + 0.5 * np.cos(np.pi * distance / half_taps))
+        count = len(range(phase, n_out, q))
+        out[phase::q] = windows[base + 1::p][:count] @ weights.astype(np.float32)
+    return out
+
+
+def trim_silence(samples, rate, silence_db=-40.0, padding_seconds=0.3):
+    """Drops leading and trailing audio quieter than silence_db below the loudest frame."""
+    energy, frame_len = frame_energy_db(samples, rate)
+    if len(energy) == 0:
+        return samples
+    voiced = np.flatnonzero(energy >= energy.max() + silence_db)
+    padding = int(padding_seconds * rate)
+    start = max(0, voiced[0] * frame_len - padding)
+    end = min(len(samples), (voiced[-1] + 1) * frame_len + padding)
+    return samples[start:end]
+
+
+def preprocess_wav(audio_bytes, target_rate=16000, silence_db=-40.0):
+    """
+    Shrinks WAV audio for speech recognition: mono, target_rate, 16-bit, silence trimmed.
+
+    Returns:
+        tuple: (wav bytes, stats) with stats holding the original/processed
+        sizes and durations, or None if the audio is not decodable WAV. The
+        original bytes are returned when processing would not make them smaller.
+    """
+    decoded = decode_wav(audio_bytes)
+    if decoded is None:
+        return None
+    params, frames = decoded
+    samples = pcm_to_mono(params, frames)
+    original_seconds = len(samples) / params.framerate
+
+    rate = min(params.framerate, target_rate)
+    samples = trim_silence(resample(samples, params.framerate, rate), rate, silence_db)
+    pcm = (np.clip(samples, -1.0, 1.0) * 32767).astype("<i2").tobytes()
+    processed = encode_wav(params._replace(nchannels=1, sampwidth=2, framerate=rate), pcm)
+
+    if len(processed) >= len(audio_bytes):
+        processed, processed_seconds = audio_bytes, original_seconds
+    else:
+        processed_seconds = len(samples) / rate
+    return processed, {
+        "original_bytes": len(audio_bytes),
+        "processed_bytes": len(processed),
+        "original_seconds": round(original_seconds, 2),
+        "processed_seconds": round(processed_seconds, 2)
+    }
+
+
+def _normalize_word(word):
+    return re.sub(r"[^\w]", "", word.lower())
+
+
+def merge_transcripts(texts, max_overlap_words=30):
+    """Joins segment transcripts in order, dropping words repeated across segment overlaps."""
+    merged = []
+    for text in texts:
+        words = text.split()
+        if merged and words:
+            tail = [_normalize_word(w) for w in merged[-max_overlap_words:]]
+            head = [_normalize_word(w) for w in words[:max_overlap_words]]
+            for k in range(min(len(tail), len(head)), 0, -1):
+                if tail[-k:] == head[:k]:
+                    words = words[k:]
+                    break
+        merged.extend(words)
+    return " ".join(merged)
@@ -0,0 +1,236 @@
+# -- coding: utf-8 --
+"""
+Headless batch processing of recorded consultations.
+
+Usage:
+    python -m batch recordings/ -o results.jsonl
+    python -m batch manifest.jsonl -o results.jsonl --workers 8 --pdf-dir prescriptions/ --doctor-name "A. Shah"
+
+The input is either a folder of audio files (a PDF with the same name is used
+as the past history, e.g. visit01.mp3 + visit01.pdf) or a JSONL manifest with
+one {"id": ..., "audio": ..., "history": ..., "doctor_name": ..., "patient_id": ...}
+object per line; only "audio" is required. Each encounter runs through the
+same transcription, assessment and prescription functions as the Streamlit
+app, and one JSON result line with per-stage timings is appended to the
+output. Rerunning with the same output file skips encounters that already
+succeeded.
+
+Results are also saved to the encounter store (in bulk, STORE_BATCH_SIZE at a
+time), and an encounter with a "patient_id" (IP No or name) gets the findings
+of that patient's earlier encounters as past history.
+"""
+import argparse
+import json
+import os
+import sqlite3
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from streamlit.config import set_option
+from streamlit.logger import set_log_level
+
+import app
+import rate_limit
+from ipd_form import json_default
+
+AUDIO_EXTENSIONS = (".mp3", ".wav", ".m4a", ".ogg", ".webm")
+
+# Encounters written to the encounter store per transaction
+STORE_BATCH_SIZE = 50
+
+
+def load_encounters(source):
+    """Reads encounters from a folder of audio files or a JSONL manifest."""
+    if os.path.isdir(source):
+        encounters = []
+        for name in sorted(os.listdir(source)):
+            stem, ext = os.path.splitext(name)
+            if ext.lower() not in AUDIO_EXTENSIONS:
+                continue
+            history = os.path.join(source, stem + ".pdf")
+            encounters.append({
+                "id": stem,
+                "audio": os.path.join(source, name),
+                "history": history if os.path.exists(history) else None
+            })
+        return encounters
+
+    base = os.path.dirname(os.path.abspath(source))
+    encounters = []
+    with open(source, encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            encounter = json.loads(line)
+            # Relative paths in a manifest are relative to the manifest itself
+            for key in ("audio", "history"):
+                if encounter.get(key):
+                    encounter[key] = os.path.join(base, encounter[key])
+            encounter.setdefault("id", os.path.splitext(os.path.basename(encounter["audio"]))[0])
+            encounters.append(encounter)
+    return encounters
+
+
+def load_completed(output_path):
+    """Returns the ids of encounters that already succeeded in an earlier run."""
+    completed = set()
+    if not os.path.exists(output_path):
+        return completed
+    with open(output_path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                result = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if result.get("status") == "ok":
+                completed.add(result["id"])
+    return completed
+
+
+def timed(name, func, timings):
+    """Wraps a stage function so its wall time is recorded in timings."""
+    def run(*args):
+        start = time.perf_counter()
+        try:
+            return func(*args)
+        finally:
+            timings[name] = round(time.perf_counter() - start, 3)
+    return run
+
+
+def process_encounter(encounter, consolidated=False, pdf_dir=None, doctor_name=""):
+    """Runs one encounter through the full pipeline and returns its result record."""
+    # Interactive sessions sharing this process's scheduler go first
+    rate_limit.request_priority.set(rate_limit.BATCH)
+    timings = {}
+    start = time.perf_counter()
+    result = {"id": encounter["id"], "audio": encounter["audio"], "history": encounter.get("history")}
+    errors = []
+
+    def record_preprocessing(stats):
+        result["audio_preprocessing"] = stats
+
+    transcription = timed("transcription", app.transcribe_audio, timings)(encounter["audio"], "whisper-1", record_preprocessing)
+    result["transcription"] = transcription
+    if not transcription:
+        errors.append("transcription")
+    else:
+        past_history_text = ""
+        if encounter.get("history"):
+            with open(encounter["history"], "rb") as pdf_file:
+                past_history_text = timed("past_history", app.extract_text_from_pdf, timings)(pdf_file)
+        if encounter.get("patient_id"):
+            encounter_id = app.content_hash("encounter", transcription)
+            prior_history = timed("prior_history", app.find_prior_history, timings)(encounter["patient_id"], encounter_id)
+            result["prior_history_chars"] = len(prior_history)
+            past_history_text = "\n\n".join(text for text in (past_history_text, prior_history) if text)
+        result["past_history_chars"] = len(past_history_text)
+
+        stages = app.build_assessment_stages(transcription, past_history_text, consolidated)
+        stages = {name: (deps, timed(name, func, timings)) for name, (deps, func) in stages.items()}
+        for stage, stage_result in app.run_stage_graph(stages):
+            result[stage] = stage_result
+            if app.is_error_result(stage_result):
+                errors.append(stage)
+
+        prescription = timed("prescription", app.generate_prescription, timings)(transcription)
+        result["prescription"] = prescription
+        if app.is_error_result(prescription):
+            errors.append("prescription")
+
+        # Disagreements with the drugs and symptoms the lexicon found; reported, not counted as errors
+        result["prescription_checks"] = app.check_prescription(transcription, prescription)
+        if not app.is_error_result(result.get("chief_complaints")):
+            result["chief_complaint_checks"] = app.check_chief_complaints(transcription, result["chief_complaints"])
+
+        doctor_name = encounter.get("doctor_name") or doctor_name
+        if pdf_dir and doctor_name:
+            assessment = {stage: result.get(stage) for stage, _ in app.ASSESSMENT_SECTIONS}
+            documents = [("assessment", (assessment, doctor_name))]
+            # A failed prescription (at most the lexicon's unverified draft) is never rendered for signing
+            if not app.is_error_result(prescription):
+                documents.insert(0, ("prescription", (prescription, doctor_name)))
+            start_pdf = time.perf_counter()
+            for (kind, _), pdf_bytes in zip(documents, app.render_documents(documents)):
+                pdf_path = os.path.join(pdf_dir, f"{kind}_{encounter['id']}.pdf")
+                with open(pdf_path, "wb") as f:
+                    f.write(pdf_bytes)
+                result[f"{kind}_pdf"] = pdf_path
+            timings["pdf_rendering"] = round(time.perf_counter() - start_pdf, 3)
+
+    timings["total"] = round(time.perf_counter() - start, 3)
+    result["timings"] = timings
+    result["errors"] = errors
+    result["status"] = "error" if errors else "ok"
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("source", help="Folder of audio files or a JSONL manifest")
+    parser.add_argument("-o", "--output", default="results.jsonl", help="JSONL file results are appended to")
+    parser.add_argument("--workers", type=int, default=4, help="Encounters processed concurrently")
+    parser.add_argument("--consolidated", action="store_true", help="Use single-call structured extraction")
+    parser.add_argument("--pdf-dir", help="Write prescription and assessment report PDFs to this folder")
+    parser.add_argument("--doctor-name", default="", help="Prescribing doctor for PDFs without one in the manifest")
+    args = parser.parse_args(argv)
+
+    # The pipeline reports problems through st.error; without a browser session
+    # Streamlit only logs context warnings, so keep the console readable
+    set_option("global.showWarningOnDirectExecution", False)
+    set_log_level("error")
+
+    if not os.getenv("OPENAI_API_KEY"):
+        parser.error("OPENAI_API_KEY must be set (environment or .env)")
+    if args.pdf_dir:
+        os.makedirs(args.pdf_dir, exist_ok=True)
+
+    encounters = load_encounters(args.source)
+    completed = load_completed(args.output)
+    pending = [e for e in encounters if e["id"] not in completed]
+    print(f"{len(encounters)} encounters, {len(encounters) - len(pending)} already done, {len(pending)} to process")
+
+    encounter_store = app.get_encounter_store()
+    records = []
+
+    def save_records():
+        try:
+            encounter_store.save_many(records)
+        except sqlite3.Error as e:
+            print(f"Saving {len(records)} encounters failed: {e}")
+        records.clear()
+
+    failures = 0
+    with open(args.output, "a", encoding="utf-8") as out, ThreadPoolExecutor(max_workers=args.workers) as executor:
+        futures = {
+            executor.submit(process_encounter, encounter, args.consolidated, args.pdf_dir, args.doctor_name): encounter
+            for encounter in pending
+        }
+        for future in as_completed(futures):
+            encounter = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                result = {"id": encounter["id"], "audio": encounter["audio"], "status": "error", "errors": [str(e)]}
+            failures += result["status"] != "ok"
+            out.write(json.dumps(result, ensure_ascii=False, default=json_default) + "\n")
+            out.flush()
+            print(f"[{result['status']}] {result['id']} {result.get('timings', {}).get('total', '')}")
+
+            if encounter_store is not None and result.get("transcription"):
+                records.append(app.encounter_record(
+                    result["transcription"], encounter.get("patient_id") or "",
+                    **{stage: result.get(stage) for stage in ("patient_data", "differential_diagnosis", "prescription")}
+                ))
+                if len(records) >= STORE_BATCH_SIZE:
+                    save_records()
+    if records:
+        save_records()
+
+    print(f"Done: {len(pending) - failures} succeeded, {failures} failed")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,89 @@
+# -- coding: utf-8 --
+"""
+Compares the three-call extraction path with the single structured call.
+
+Usage:
+    python -m benchmarks.extraction transcript.txt [--history history.pdf] [--runs 3]
+    python -m benchmarks.extraction demo_audio.mp3 --audio
+
+Needs OPENAI_API_KEY in the environment (or .env) and makes real API calls.
+"""
+import argparse
+import contextvars
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import app
+import metrics
+
+
+@contextmanager
+def record_usage():
+    """Collects the metrics records of every stage run inside the block."""
+    session = metrics.SessionMetrics()
+    token = metrics.current_session.set(session)
+    try:
+        yield session
+    finally:
+        metrics.current_session.reset(token)
+
+
+def three_call_extraction(transcription, past_history_text):
+    # Mirrors the app, which runs the three extractions concurrently
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        chief_complaints = executor.submit(contextvars.copy_context().run, app.extract_chief_complaints, transcription)
+        patient_data = executor.submit(contextvars.copy_context().run, app.extract_patient_data, transcription, past_history_text)
+        presenting_illness = executor.submit(contextvars.copy_context().run, app.extract_presenting_illness, transcription)
+        return chief_complaints.result(), patient_data.result(), presenting_illness.result()
+
+
+def consolidated_extraction(transcription, past_history_text):
+    return app.split_structured_data(app.extract_structured_data(transcription, past_history_text))
+
+
+def measure(func, transcription, past_history_text, runs):
+    """Returns (latencies, prompt tokens, completion tokens, requests) per run."""
+    latencies, prompt_tokens, completion_tokens, requests = [], [], [], []
+    func(transcription, past_history_text)  # warm-up: client setup and connection pool
+    for _ in range(runs):
+        with record_usage() as session:
+            start = time.perf_counter()
+            func(transcription, past_history_text)
+            latencies.append(time.perf_counter() - start)
+        prompt_tokens.append(sum(r["prompt_tokens"] for r in session.records))
+        completion_tokens.append(sum(r["completion_tokens"] for r in session.records))
+        requests.append(sum(r["calls"] for r in session.records))
+    return latencies, prompt_tokens, completion_tokens, requests
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("input", help="Transcript text file, or an audio file with --audio")
+    parser.add_argument("--audio", action="store_true", help="Transcribe the input with Whisper first")
+    parser.add_argument("--history", help="Optional past history PDF")
+    parser.add_argument("--runs", type=int, default=3)
+    args = parser.parse_args()
+
+    if args.audio:
+        transcription = app.transcribe_audio(args.input)
+    else:
+        with open(args.input, encoding="utf-8") as f:
+            transcription = f.read()
+    past_history_text = ""
+    if args.history:
+        with open(args.history, "rb") as f:
+            past_history_text = app.extract_text_from_pdf(f)
+
+    print(f"{'mode':<14}{'requests':>10}{'prompt tok':>12}{'compl tok':>12}{'p50 s':>9}{'max s':>9}")
+    for name, func in (("three-call", three_call_extraction), ("consolidated", consolidated_extraction)):
+        latencies, prompt_tokens, completion_tokens, requests = measure(func, transcription, past_history_text, args.runs)
+        print(
+            f"{name:<14}{statistics.median(requests):>10.0f}{statistics.median(prompt_tokens):>12.0f}"
+            f"{statistics.median(completion_tokens):>12.0f}{statistics.median(latencies):>9.2f}{max(latencies):>9.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,266 @@
+# -- coding: utf-8 --
+"""
+Local stand-in for the OpenAI API that replays recorded responses.
+
+Usage:
+    python -m benchmarks.fake_openai --port 8808 --latency 0.8 --error-rate 0.05
+    python -m benchmarks.fake_openai --latency 0.8 --model-latency gpt-4o-mini=0.3 --model-latency gpt-4o=0.5
+    OPENAI_BASE_URL=http://127.0.0.1:8808/v1 OPENAI_API_KEY=fake streamlit run app.py
+
+    # Capture real responses for later replay (needs a real OPENAI_API_KEY)
+    python -m benchmarks.fake_openai --record
+
+Chat completions are answered from benchmarks/fixtures.json: first from
+responses recorded for the exact same request, then from the first rule whose
+"match" text appears in the prompt. Transcriptions return the fixture
+transcript. Latency (optionally per model), per-token streaming delay and
+injected 429/500 errors are configurable so retries, slow stages and model
+routing can be exercised without spend.
+"""
+import argparse
+import hashlib
+import json
+import os
+import random
+import socket
+import threading
+import time
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures.json")
+UPSTREAM_URL = "https://api.openai.com/v1"
+
+
+def request_key(body):
+    """Identifies a chat request by everything that affects its answer."""
+    relevant = {k: body.get(k) for k in ("model", "messages", "temperature", "max_tokens", "response_format")}
+    return hashlib.sha256(json.dumps(relevant, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def approx_tokens(text):
+    """Rough token count (about four characters per token for English)."""
+    return max(1, len(text) // 4)
+
+
+class FakeOpenAI:
+    """Threaded HTTP server speaking the subset of the OpenAI API the app uses."""
+
+    def __init__(self, fixtures_path=DEFAULT_FIXTURES, latency=0.0, jitter=0.0, token_delay=0.0,
+                 error_rate=0.0, seed=None, record=False, upstream_key=None, model_latency=None):
+        self.fixtures_path = fixtures_path
+        with open(fixtures_path, encoding="utf-8") as f:
+            self.fixtures = json.load(f)
+        self.fixtures.setdefault("recorded", {})
+        self.latency = latency
+        self.model_latency = model_latency or {}
+        self.jitter = jitter
+        self.token_delay = token_delay
+        self.error_rate = error_rate
+        self.record = record
+        self.upstream_key = upstream_key
+        self.random = random.Random(seed)
+        self.requests = 0
+        self._lock = threading.Lock()
+        self._server = None
+
+    def start(self, host="127.0.0.1", port=0):
+        """Starts serving in a background thread and returns the base URL."""
+        fake = self
+
+        class Handler(FakeOpenAIHandler):
+            server_fake = fake
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return f"http://{host}:{self._server.server_address[1]}/v1"
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def delay(self, model=None):
+        """Sleeps for the configured response latency (of model, if it has its own)."""
+        latency = self.model_latency.get(model, self.latency)
+        if latency or self.jitter:
+            time.sleep(max(0.0, latency + self.random.uniform(-self.jitter, self.jitter)))
+
+    def should_fail(self):
+        with self._lock:
+            self.requests += 1
+            return self.error_rate and self.random.random() < self.error_rate
+
+    def chat_content(self, body):
+        """Returns the recorded or fixture content for a chat request."""
+        key = request_key(body)
+        if key in self.fixtures["recorded"]:
+            return self.fixtures["recorded"][key]
+        if self.record:
+            return self.record_upstream(key, body)
+
+        prompt = "\n".join(str(m.get("content", "")) for m in body.get("messages", []))
+        for rule in self.fixtures.get("chat", []):
+            if rule["match"] in prompt:
+                return rule["content"]
+        return "{}"
+
+    def record_upstream(self, key, body):
+        """Forwards a request to the real API and saves the answer for replay."""
+        upstream = {k: v for k, v in body.items() if k not in ("stream", "stream_options")}
+        request = urllib.request.Request(
+            f"{UPSTREAM_URL}/chat/completions",
+            data=json.dumps(upstream).encode("utf-8"),
+            headers={"Authorization": f"Bearer {self.upstream_key}", "Content-Type": "application/json"}
+        )
+        with urllib.request.urlopen(request) as response:
+            content = json.load(response)["choices"][0]["message"]["content"]
+        with self._lock:
+            self.fixtures["recorded"][key] = content
+            with open(self.fixtures_path, "w", encoding="utf-8") as f:
+                json.dump(self.fixtures, f, indent=2, ensure_ascii=False)
+        return content
+
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    server_fake = None
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        # Headers and body are written separately; without this Nagle's
+        # algorithm adds ~40 ms to every keep-alive response
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, payload, headers=None):
+        data = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def read_body(self):
+        if self.headers.get("Transfer-Encoding", "").lower() != "chunked":
+            return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        chunks = []
+        while True:
+            size = int(self.rfile.readline().split(b";")[0], 16)
+            if size == 0:
+                self.rfile.readline()
+                return b"".join(chunks)
+            chunks.append(self.rfile.read(size))
+            self.rfile.readline()
+
+    def do_POST(self):
+        fake = self.server_fake
+        body = self.read_body()
+        chat = json.loads(body or b"{}") if self.path.endswith("/chat/completions") else None
+        fake.delay(chat.get("model") if chat else None)
+
+        if fake.should_fail():
+            if fake.random.random() < 0.5:
+                self.send_json(429, {"error": {"message": "Rate limit reached (injected)", "type": "requests", "code": "rate_limit_exceeded"}},
+                               headers={"Retry-After": "1"})
+            else:
+                self.send_json(500, {"error": {"message": "Internal server error (injected)", "type": "server_error"}})
+            return
+
+        if self.path.endswith("/audio/transcriptions"):
+            self.send_json(200, {"text": fake.fixtures.get("transcription", "")})
+        elif chat is not None:
+            self.chat_completion(chat)
+        else:
+            self.send_json(404, {"error": {"message": f"Unknown endpoint {self.path}", "type": "invalid_request_error"}})
+
+    def chat_completion(self, body):
+        fake = self.server_fake
+        content = fake.chat_content(body)
+        prompt = "\n".join(str(m.get("content", "")) for m in body.get("messages", []))
+        usage = {
+            "prompt_tokens": approx_tokens(prompt),
+            "completion_tokens": approx_tokens(content),
+            "total_tokens": approx_tokens(prompt) + approx_tokens(content)
+        }
+        base = {"id": "chatcmpl-fake", "created": int(time.time()), "model": body.get("model", "gpt-4")}
+
+        if not body.get("stream"):
+            self.send_json(200, {
+                **base,
+                "object": "chat.completion",
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+                "usage": usage
+            })
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+
+        def send_event(payload):
+            self.wfile.write(f"data: {json.dumps(payload)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+
+        # Stream in roughly token-sized pieces
+        pieces = [content[i:i + 4] for i in range(0, len(content), 4)]
+        for piece in pieces:
+            if fake.token_delay:
+                time.sleep(fake.token_delay)
+            send_event({**base, "object": "chat.completion.chunk",
+                        "choices": [{"index": 0, "delta": {"content": piece}, "finish_reason": None}]})
+        send_event({**base, "object": "chat.completion.chunk",
+                    "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]})
+        if (body.get("stream_options") or {}).get("include_usage"):
+            send_event({**base, "object": "chat.completion.chunk", "choices": [], "usage": usage})
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+        self.close_connection = True
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8808)
+    parser.add_argument("--fixtures", default=DEFAULT_FIXTURES)
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds before each response starts")
+    parser.add_argument("--model-latency", action="append", default=[], metavar="MODEL=SECONDS",
+                        help="Latency for one model, overriding --latency (repeatable)")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Uniform +/- variation of the latency")
+    parser.add_argument("--token-delay", type=float, default=0.0, help="Seconds between streamed chunks")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests answered with 429/500")
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--record", action="store_true", help="Forward unknown requests to the real API and save the answers")
+    args = parser.parse_args()
+
+    upstream_key = os.getenv("OPENAI_API_KEY")
+    if args.record and not upstream_key:
+        parser.error("--record needs a real OPENAI_API_KEY")
+
+    model_latency = {}
+    for item in args.model_latency:
+        model, _, seconds = item.partition("=")
+        try:
+            model_latency[model] = float(seconds)
+        except ValueError:
+            parser.error(f"--model-latency expects MODEL=SECONDS, got {item!r}")
+
+    fake = FakeOpenAI(args.fixtures, args.latency, args.jitter, args.token_delay, args.error_rate,
+                      args.seed, args.record, upstream_key, model_latency)
+    base_url = fake.start(args.host, args.port)
+    print(f"Fake OpenAI API listening on {base_url}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        fake.stop()
+
+
+if __name__ == "__main__":
+    main()
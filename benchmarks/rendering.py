@@ -0,0 +1,98 @@
+# -- coding: utf-8 --
+"""
+Measures PDF rendering throughput (documents per second) for prescriptions
+and Clinical Assessment reports, rendered serially and on a process pool.
+
+Usage:
+    python -m benchmarks.rendering [--docs 200] [--workers 4]
+
+Makes no API calls; the documents are built from the fixtures' sample data.
+"""
+import argparse
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from ipd_form import IPDForm
+from pdf_rendering import render_many
+
+PRESCRIPTION = {
+    "Date": "2026-01-15",
+    "Medications": [
+        {"Medicine Name": "Metformin", "Dosage": "500 mg", "Frequency": "Twice daily",
+         "Duration": "3 months", "Special Instructions": "Take with meals"},
+        {"Medicine Name": "Atorvastatin", "Dosage": "20 mg", "Frequency": "Once daily",
+         "Duration": "3 months", "Special Instructions": "At bedtime"},
+        {"Medicine Name": "Paracetamol", "Dosage": "650 mg", "Frequency": "As needed",
+         "Duration": "5 days", "Special Instructions": "Not more than 4 doses a day"},
+    ]
+}
+
+ASSESSMENT = {
+    "chief_complaints": ["Fever for 3 days", "Dry cough", "Fatigue"],
+    "patient_data": {
+        "Patient Information": {"Name": "Sample Patient", "Age": "54", "Gender": "Male"},
+        "Vitals": {"Temperature": "101.2 F", "Pulse": "96 bpm", "Blood Pressure": "138/86 mmHg"},
+        "Past History": {"Diabetes": "Type 2, on metformin", "Hypertension": "", "HbA1C": "7.8%"},
+    },
+    "presenting_illness": [
+        {"Symptom": "Fever", "Onset": "3 days ago", "Severity": "Moderate", "Pattern": "Evening spikes"},
+        {"Symptom": "Cough", "Onset": "2 days ago", "Severity": "Mild", "Pattern": "Dry, worse at night"},
+    ],
+    "differential_diagnosis": {
+        "Differential Diagnosis": ["Viral upper respiratory infection", "Community-acquired pneumonia", "Influenza"],
+        "Recommendations": {
+            "Investigations": ["CBC", "Chest X-ray", "CRP"],
+            "Treatment": ["Antipyretics", "Hydration", "Review in 48 hours"],
+        }
+    },
+    "summary": {
+        "Summary": "54-year-old diabetic man with 3 days of fever and dry cough.",
+        "KeyFindings": ["Febrile", "Mild tachycardia", "Suboptimal glycaemic control"],
+        "NextSteps": ["Chest X-ray", "Adjust diabetes medication after review"],
+    },
+}
+
+
+def build_documents(count):
+    """Alternates prescriptions and assessment reports."""
+    # Reports get patient data as the app passes it, as a parsed form
+    report = dict(ASSESSMENT, patient_data=IPDForm.parse(ASSESSMENT["patient_data"]))
+    documents = []
+    for i in range(count):
+        if i % 2:
+            documents.append(("assessment", (report, f"Doctor {i}")))
+        else:
+            documents.append(("prescription", (PRESCRIPTION, f"Doctor {i}")))
+    return documents
+
+
+def measure(documents, executor=None):
+    """Returns (seconds, total bytes) to render all documents."""
+    start = time.perf_counter()
+    size = sum(len(pdf) for pdf in render_many(documents, executor))
+    return time.perf_counter() - start, size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--docs", type=int, default=200, help="Documents rendered per mode")
+    parser.add_argument("--workers", type=int, default=multiprocessing.cpu_count(), help="Process pool size")
+    args = parser.parse_args()
+
+    documents = build_documents(args.docs)
+    measure(documents[:2])  # warm-up: font metrics and cached styles
+
+    print(f"{'mode':<16}{'docs':>6}{'seconds':>10}{'docs/s':>10}{'KB/doc':>9}")
+    seconds, size = measure(documents)
+    print(f"{'serial':<16}{len(documents):>6}{seconds:>10.2f}{len(documents) / seconds:>10.1f}{size / len(documents) / 1024:>9.1f}")
+
+    with ProcessPoolExecutor(max_workers=args.workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+        measure(documents[:args.workers * 2], executor)  # warm-up: start the workers
+        seconds, size = measure(documents, executor)
+    mode = f"pool x{args.workers}"
+    print(f"{mode:<16}{len(documents):>6}{seconds:>10.2f}{len(documents) / seconds:>10.1f}{size / len(documents) / 1024:>9.1f}")
+
+
+if __name__ == "__main__":
+    main()
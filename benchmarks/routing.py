@@ -0,0 +1,189 @@
+# -- coding: utf-8 --
+"""
+Compares model routing profiles: latency, tokens, cost, escalations and agreement.
+
+Usage:
+    python -m benchmarks.routing --fake --model-latency gpt-4=1.0 --model-latency gpt-4o-mini=0.3
+    python -m benchmarks.routing transcript.txt --profiles quality balanced fast --runs 3
+    python -m benchmarks.routing transcript.txt --profiles quality my_routing.json -o routing.json
+
+Each run processes one encounter the way the app does: the Clinical Assessment
+stage graph, then the prescription. Agreement compares each stage's result
+with the first profile's result of the same run: the overlap (Jaccard index)
+of the leaf values of JSON results, or of the words of text results.
+
+Without --fake, real API calls are made (OPENAI_API_KEY in the environment or
+.env). With --fake the local fake API answers from the fixtures; its answers do
+not depend on the model, so only latency, tokens and cost differ.
+"""
+import argparse
+import json
+import os
+import statistics
+import tempfile
+import time
+
+from benchmarks.stages import app_fixtures, git_commit, summarize
+
+# Metrics stage name -> the stage result it produces
+RESULT_STAGES = {
+    "extract_chief_complaints": "chief_complaints",
+    "extract_patient_data": "patient_data",
+    "extract_presenting_illness": "presenting_illness",
+    "generate_differential_diagnosis": "differential_diagnosis",
+    "generate_patient_summary": "summary",
+    "generate_prescription": "prescription",
+}
+
+# Filled in at generation time, so they differ between otherwise identical results
+VOLATILE_KEYS = {"Date"}
+
+
+def leaf_set(value, path=""):
+    """Normalized (path, value) leaves of a JSON result, or the words of a text result."""
+    if hasattr(value, "to_dict"):
+        value = value.to_dict()
+    if isinstance(value, str) and not path:
+        return set(value.lower().split())
+    leaves = set()
+    if isinstance(value, dict):
+        for key, item in value.items():
+            if key not in VOLATILE_KEYS:
+                leaves |= leaf_set(item, f"{path}/{key}")
+    elif isinstance(value, list):
+        for item in value:
+            leaves |= leaf_set(item, path + "/")
+    elif value is not None and str(value).strip():
+        leaves.add((path, " ".join(str(value).lower().split())))
+    return leaves
+
+
+def agreement(result, reference):
+    result, reference = leaf_set(result), leaf_set(reference)
+    if not result and not reference:
+        return 1.0
+    return len(result & reference) / len(result | reference)
+
+
+def run_encounter(app, transcription, consolidated):
+    """Returns the stage results of one encounter."""
+    results = dict(app.run_stage_graph(app.build_assessment_stages(transcription, consolidated=consolidated)))
+    results["prescription"] = app.generate_prescription(transcription)
+    return results
+
+
+def measure_profile(app, routing, transcription, runs, consolidated):
+    """Returns (end-to-end seconds, metrics records, stage results) of every run with a routing."""
+    from benchmarks.extraction import record_usage
+    from model_routing import active_routing
+
+    token = active_routing.set(routing)
+    try:
+        run_encounter(app, transcription, consolidated)  # warm-up: client setup and connection pool
+        latencies, records, results = [], [], []
+        for _ in range(runs):
+            with record_usage() as session:
+                start = time.perf_counter()
+                results.append(run_encounter(app, transcription, consolidated))
+                latencies.append(time.perf_counter() - start)
+            records.append(session.records)
+        return latencies, records, results
+    finally:
+        active_routing.reset(token)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("input", nargs="?", help="Transcript text file (default: the fixture transcript)")
+    parser.add_argument("--profiles", nargs="+", default=["quality", "balanced", "fast"],
+                        help="Built-in profiles or JSON routing files; the first is the agreement reference")
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--consolidated", action="store_true", help="Use single-call extraction")
+    parser.add_argument("--fake", action="store_true", help="Answer from the local fake API instead of OpenAI")
+    parser.add_argument("--latency", type=float, default=0.0, help="Fake API latency in seconds")
+    parser.add_argument("--model-latency", action="append", default=[], metavar="MODEL=SECONDS",
+                        help="Fake API latency of one model (repeatable)")
+    parser.add_argument("-o", "--output", help="Write the JSON report here")
+    args = parser.parse_args()
+
+    fake = None
+    if args.fake:
+        from benchmarks.fake_openai import FakeOpenAI
+
+        model_latency = {model: float(seconds) for model, _, seconds in (item.partition("=") for item in args.model_latency)}
+        fake = FakeOpenAI(latency=args.latency, seed=0, model_latency=model_latency)
+        os.environ["OPENAI_BASE_URL"] = fake.start()
+        os.environ["OPENAI_API_KEY"] = "fake"
+    os.environ["ECHO_MED_CACHE_DIR"] = tempfile.mkdtemp(prefix="echo-med-bench-")
+    os.environ.setdefault("ECHO_MED_LOG_LEVEL", "WARNING")
+
+    from streamlit.config import set_option
+    from streamlit.logger import set_log_level
+    set_option("global.showWarningOnDirectExecution", False)
+    set_log_level("error")
+
+    import app
+    from model_routing import load_routing
+
+    if args.input:
+        with open(args.input, encoding="utf-8") as f:
+            transcription = f.read()
+    else:
+        transcription = app_fixtures()["transcription"]
+
+    report = {"commit": git_commit(), "runs": args.runs, "consolidated": args.consolidated, "fake": args.fake, "profiles": {}}
+    reference = None
+    print(f"{'profile':<16}{'p50 s':>8}{'p95 s':>8}{'prompt tok':>12}{'compl tok':>11}{'cost $':>10}{'escal.':>8}{'agree':>8}")
+    for profile in args.profiles:
+        latencies, records, results = measure_profile(app, load_routing(profile), transcription, args.runs, args.consolidated)
+        reference = reference or results
+        stages = {}
+        for run_records in records:
+            for record in run_records:
+                stage = stages.setdefault(record["stage"], {"seconds": [], "escalations": 0, "models": set()})
+                stage["seconds"].append(record["seconds"])
+                stage["escalations"] += max(0, record["calls"] - 1)
+                stage["models"].update(record["models"])
+        agreements = {
+            stage: statistics.mean(agreement(run[stage], ref[stage]) for run, ref in zip(results, reference))
+            for stage in results[0]
+        }
+        all_records = [record for run_records in records for record in run_records]
+        summary = {
+            "end_to_end": summarize(latencies),
+            "prompt_tokens": sum(r["prompt_tokens"] for r in all_records) / args.runs,
+            "completion_tokens": sum(r["completion_tokens"] for r in all_records) / args.runs,
+            "cost_usd": round(sum(r["cost_usd"] for r in all_records) / args.runs, 6),
+            "escalations": sum(stage["escalations"] for stage in stages.values()),
+            "agreement": agreements,
+            "stages": {
+                name: {**summarize(stage["seconds"]), "escalations": stage["escalations"], "models": sorted(stage["models"])}
+                for name, stage in stages.items()
+            }
+        }
+        report["profiles"][profile] = summary
+        print(
+            f"{os.path.basename(profile):<16}{summary['end_to_end']['median_ms'] / 1000:>8.2f}{summary['end_to_end']['p95_ms'] / 1000:>8.2f}"
+            f"{summary['prompt_tokens']:>12.0f}{summary['completion_tokens']:>11.0f}{summary['cost_usd']:>10.4f}"
+            f"{summary['escalations']:>8}{statistics.mean(agreements.values()):>8.2f}"
+        )
+
+    print(f"\n{'stage (median ms / agreement)':<34}" + "".join(f"{os.path.basename(p):>18}" for p in args.profiles))
+    for name in report["profiles"][args.profiles[0]]["stages"]:
+        cells = []
+        for profile in args.profiles:
+            summary = report["profiles"][profile]
+            stage = summary["stages"].get(name)
+            agree = summary["agreement"].get(RESULT_STAGES.get(name))
+            cells.append(f"{stage['median_ms'] if stage else 0:>10.0f}" + (f" / {agree:.2f}" if agree is not None else "       "))
+        print(f"{name:<34}" + "".join(f"{cell:>18}" for cell in cells))
+
+    if fake:
+        fake.stop()
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,210 @@
+# -- coding: utf-8 --
+"""
+Times every pipeline stage and the end-to-end encounter against the local fake API.
+
+Usage:
+    python -m benchmarks.stages --runs 10 -o bench.json
+    python -m benchmarks.stages --latency 0.5 --compare bench.json
+
+No API key is needed: an in-process benchmarks.fake_openai server answers
+every request. demo_audio.mp3 is used as the consultation and a synthetic
+history PDF of --history-pages pages is generated with reportlab. The JSON
+report records the commit it was produced on so runs can be compared across
+commits with --compare.
+"""
+import argparse
+import io
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEMO_AUDIO = os.path.join(ROOT, "demo_audio.mp3")
+
+
+def build_history_pdf(pages):
+    """Renders a synthetic multi-page discharge summary and returns its bytes."""
+    from reportlab.lib.pagesizes import letter
+    from reportlab.lib.styles import getSampleStyleSheet
+    from reportlab.platypus import PageBreak, Paragraph, SimpleDocTemplate
+
+    styles = getSampleStyleSheet()
+    paragraph = (
+        "Patient admitted with exertional chest pain. Known hypertensive on amlodipine 5 mg. "
+        "ECG showed ST depression in lateral leads, troponin negative at 0 and 6 hours. "
+        "Echocardiography revealed mild concentric LVH with preserved ejection fraction. "
+    ) * 6
+    elements = []
+    for page in range(pages):
+        elements.append(Paragraph(f"Discharge summary - page {page + 1}", styles["Heading2"]))
+        elements.extend(Paragraph(paragraph, styles["Normal"]) for _ in range(4))
+        elements.append(PageBreak())
+    buffer = io.BytesIO()
+    SimpleDocTemplate(buffer, pagesize=letter).build(elements)
+    return buffer.getvalue()
+
+
+def time_stage(func, runs, setup=None):
+    """Returns the wall times of runs calls of func (setup runs untimed before each)."""
+    samples = []
+    for _ in range(runs):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def summarize(samples):
+    ordered = sorted(samples)
+    return {
+        "runs": len(samples),
+        "median_ms": round(statistics.median(ordered) * 1000, 3),
+        "p95_ms": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000, 3),
+        "min_ms": round(ordered[0] * 1000, 3)
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return ""
+
+
+def run_benchmarks(runs, history_pages):
+    """Runs every stage benchmark and returns {stage: summary}."""
+    import app
+    import batch
+
+    fixtures = app_fixtures()
+    patient_data = app.IPDForm.parse(json.loads(fixtures["patient_data"]))
+    chief_complaints = json.loads(fixtures["chief_complaints"])
+    presenting_illness = fixtures["presenting_illness"]
+    differential_diagnosis = json.loads(fixtures["differential_diagnosis"])
+    prescription = json.loads(fixtures["prescription"])
+    transcription = fixtures["transcription"]
+
+    history_bytes = build_history_pdf(history_pages)
+    history_path = os.path.join(tempfile.mkdtemp(), "history.pdf")
+    with open(history_path, "wb") as f:
+        f.write(history_bytes)
+    with open(DEMO_AUDIO, "rb") as f:
+        audio_key = app.content_hash("whisper-1", f.read())
+
+    pdf_key = app.content_hash(history_bytes, str(app.PDF_MAX_PAGES), str(app.PDF_MAX_CHARS))
+
+    def cold_transcription():
+        app.get_transcription_cache().delete(audio_key)
+
+    def cold_pdf():
+        app.get_pdf_cache().delete(pdf_key)
+
+    def cold_encounter():
+        cold_transcription()
+        cold_pdf()
+
+    stages = {
+        "extract_text_from_pdf": (lambda: app.extract_text_from_pdf(io.BytesIO(history_bytes)), cold_pdf),
+        "extract_text_from_pdf_cached": (lambda: app.extract_text_from_pdf(io.BytesIO(history_bytes)), None),
+        "transcribe_audio": (lambda: app.transcribe_audio(DEMO_AUDIO), cold_transcription),
+        "transcribe_audio_cached": (lambda: app.transcribe_audio(DEMO_AUDIO), None),
+        "extract_chief_complaints": (lambda: app.extract_chief_complaints(transcription), None),
+        "extract_patient_data": (lambda: app.extract_patient_data(transcription), None),
+        "extract_presenting_illness": (lambda: app.extract_presenting_illness(transcription), None),
+        "extract_structured_data": (lambda: app.extract_structured_data(transcription), None),
+        "generate_differential_diagnosis": (lambda: app.generate_differential_diagnosis(patient_data), None),
+        "generate_patient_summary": (lambda: app.generate_patient_summary(
+            patient_data, chief_complaints, differential_diagnosis, presenting_illness), None),
+        "generate_prescription": (lambda: app.generate_prescription(transcription), None),
+        "display_form": (lambda: app.display_form(patient_data), None),
+        "generate_prescription_pdf": (lambda: app.generate_prescription_pdf(prescription, "A. Shah"), None),
+        "end_to_end": (lambda: batch.process_encounter(
+            {"id": "bench", "audio": DEMO_AUDIO, "history": history_path}), cold_encounter),
+    }
+
+    results = {}
+    for name, (func, setup) in stages.items():
+        # Warm-up (imports, connection pool); a failing stage would only time its error path
+        warmup = func()
+        if warmup == "" or (isinstance(warmup, dict) and (warmup.get("status") == "error" or "Error" in warmup)):
+            raise SystemExit(f"{name} failed against the fake API: {warmup}")
+        results[name] = summarize(time_stage(func, runs, setup))
+        print(f"{name:<34}{results[name]['median_ms']:>12.1f} ms{results[name]['p95_ms']:>12.1f} ms")
+    return results
+
+
+def app_fixtures():
+    """Returns the fixture content per stage, keyed by stage name."""
+    from benchmarks.fake_openai import DEFAULT_FIXTURES
+
+    with open(DEFAULT_FIXTURES, encoding="utf-8") as f:
+        data = json.load(f)
+    fixtures = {rule["stage"]: rule["content"] for rule in data["chat"]}
+    fixtures["transcription"] = data["transcription"]
+    return fixtures
+
+
+def compare(results, baseline_path):
+    """Prints the change of each stage's median against an earlier report."""
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = json.load(f)
+    print(f"\nChange vs {baseline.get('commit') or baseline_path}:")
+    for name, summary in results.items():
+        before = baseline["stages"].get(name)
+        if not before or not before["median_ms"]:
+            continue
+        change = (summary["median_ms"] - before["median_ms"]) / before["median_ms"] * 100
+        print(f"{name:<34}{before['median_ms']:>12.1f} -> {summary['median_ms']:>10.1f} ms  ({change:+.1f}%)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--history-pages", type=int, default=50)
+    parser.add_argument("--latency", type=float, default=0.0, help="Simulated API latency in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of API requests that fail")
+    parser.add_argument("-o", "--output", help="Write the JSON report here")
+    parser.add_argument("--compare", help="Earlier JSON report to compare against")
+    args = parser.parse_args()
+
+    from benchmarks.fake_openai import FakeOpenAI
+
+    fake = FakeOpenAI(latency=args.latency, error_rate=args.error_rate, seed=0)
+    base_url = fake.start()
+    os.environ["OPENAI_BASE_URL"] = base_url
+    os.environ["OPENAI_API_KEY"] = "fake"
+    os.environ["ECHO_MED_CACHE_DIR"] = tempfile.mkdtemp(prefix="echo-med-bench-")
+    os.environ.setdefault("ECHO_MED_LOG_LEVEL", "WARNING")
+
+    from streamlit.config import set_option
+    from streamlit.logger import set_log_level
+    set_option("global.showWarningOnDirectExecution", False)
+    set_log_level("error")
+
+    print(f"{'stage':<34}{'median':>15}{'p95':>15}")
+    results = run_benchmarks(args.runs, args.history_pages)
+    fake.stop()
+
+    report = {
+        "commit": git_commit(),
+        "python": sys.version.split()[0],
+        "runs": args.runs,
+        "history_pages": args.history_pages,
+        "latency": args.latency,
+        "stages": results
+    }
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
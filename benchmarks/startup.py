@@ -0,0 +1,143 @@
+# -- coding: utf-8 --
+"""
+Measures cold start: importing app and serving the first page in a fresh interpreter.
+
+Usage:
+    python -m benchmarks.startup --runs 5 -o startup.json
+    python -m benchmarks.startup --compare startup.json --check
+
+Every run starts a new Python process, so nothing is cached in sys.modules.
+The import report comes from `python -X importtime` and lists the slowest
+modules app imports directly. --check fails if app imports any of
+HEAVY_MODULES at startup; those must be loaded on demand by the page or stage
+that needs them. No API key or network access is needed.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+from benchmarks.stages import ROOT, compare, git_commit, summarize
+
+# Dependencies that only some pages or stages need
+HEAVY_MODULES = ("pandas", "numpy", "openai", "reportlab", "PyPDF2")
+
+# First page of a new session: the API key prompt, then the About page once a key is entered
+FIRST_PAGE = """
+import time
+start = time.perf_counter()
+from streamlit.testing.v1 import AppTest
+at = AppTest.from_string("import app; app.main()", default_timeout=120)
+at.run()
+first_page = time.perf_counter() - start
+start = time.perf_counter()
+at.sidebar.text_input[0].input("startup-benchmark").run()
+print(first_page, time.perf_counter() - start)
+"""
+
+
+def run_python(*args):
+    env = dict(os.environ, ECHO_MED_LOG_LEVEL="WARNING")
+    result = subprocess.run([sys.executable, *args], cwd=ROOT, env=env, capture_output=True, text=True, check=True)
+    return result.stdout, result.stderr
+
+
+def parse_importtime(stderr):
+    """Yields (depth, cumulative seconds, module) for each -X importtime line."""
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        # One space of padding, then two per nesting level
+        yield (len(name) - len(name.lstrip()) - 1) // 2, int(cumulative) / 1e6, name.strip()
+
+
+def import_report():
+    """
+    Imports app in a fresh interpreter with -X importtime.
+
+    Modules the interpreter loads before running any code (site, .pth files)
+    are left out.
+
+    Returns:
+        tuple: (seconds to import app, {module app imports directly: seconds incl. its imports},
+        names of all modules imported by app)
+    """
+    _, baseline = run_python("-X", "importtime", "-c", "pass")
+    preloaded = {name for _, _, name in parse_importtime(baseline)}
+    _, stderr = run_python("-X", "importtime", "-c", "import app")
+    total, direct, modules = 0.0, {}, set()
+    for depth, seconds, name in parse_importtime(stderr):
+        if name in preloaded:
+            continue
+        modules.add(name)
+        if name == "app" and depth == 0:
+            total = seconds
+        elif depth == 1:
+            direct[name] = seconds
+    return total, direct, modules
+
+
+def first_page():
+    """Returns (seconds to serve the first page, seconds to render the About page) in a fresh interpreter."""
+    stdout, _ = run_python("-c", FIRST_PAGE)
+    first, about = stdout.split()[-2:]
+    return float(first), float(about)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=10, help="Slowest direct imports of app to list")
+    parser.add_argument("-o", "--output", help="Write the JSON report here")
+    parser.add_argument("--compare", help="Earlier JSON report to compare against")
+    parser.add_argument("--check", action="store_true", help="Exit with an error if app imports a heavy module at startup")
+    args = parser.parse_args()
+
+    samples = {"import_app": [], "first_page": [], "about_page": []}
+    direct_imports = {}
+    heavy = set()
+    for _ in range(args.runs):
+        total, direct, modules = import_report()
+        samples["import_app"].append(total)
+        for name, seconds in direct.items():
+            direct_imports.setdefault(name, []).append(seconds)
+        heavy |= {name for name in modules if name.split(".")[0] in HEAVY_MODULES}
+        first, about = first_page()
+        samples["first_page"].append(first)
+        samples["about_page"].append(about)
+
+    results = {name: summarize(values) for name, values in samples.items()}
+    print(f"{'phase':<34}{'median':>15}{'p95':>15}")
+    for name, summary in results.items():
+        print(f"{name:<34}{summary['median_ms']:>12.1f} ms{summary['p95_ms']:>12.1f} ms")
+
+    slowest = sorted(direct_imports.items(), key=lambda item: statistics.median(item[1]), reverse=True)[:args.top]
+    print(f"\nSlowest imports of app (median of {args.runs}, including their own imports):")
+    for name, values in slowest:
+        print(f"  {name:<32}{statistics.median(values) * 1000:>10.1f} ms")
+
+    heavy_roots = sorted({name.split(".")[0] for name in heavy})
+    print(f"\nHeavy modules imported at startup: {', '.join(heavy_roots) or 'none'}")
+
+    report = {
+        "commit": git_commit(),
+        "python": sys.version.split()[0],
+        "runs": args.runs,
+        "stages": results,
+        "imports_ms": {name: round(statistics.median(values) * 1000, 3) for name, values in slowest},
+        "heavy_modules": heavy_roots
+    }
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        compare(results, args.compare)
+    if args.check and heavy_roots:
+        sys.exit(f"app imports {', '.join(heavy_roots)} at startup; import them where they are used")
+
+
+if __name__ == "__main__":
+    main()
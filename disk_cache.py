@@ -0,0 +1,109 @@
+# -- coding: utf-8 --
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+
+def content_hash(*parts):
+    """Returns a SHA-256 hex digest over the given bytes/str parts."""
+    digest = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, str):
+            part = part.encode("utf-8")
+        digest.update(len(part).to_bytes(8, "big"))
+        digest.update(part)
+    return digest.hexdigest()
+
+
+class DiskCache:
+    """
+    Content-addressed JSON cache stored as one file per key.
+
+    Entries expire after ttl_seconds and the least recently used entries are
+    evicted once the directory grows beyond max_bytes. Because entries live on
+    disk, every Streamlit session and worker process pointing at the same
+    directory shares them.
+    """
+
+    def __init__(self, directory, max_bytes=200 * 1024 * 1024, ttl_seconds=7 * 24 * 3600):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.json")
+
+    def get(self, key, default=None):
+        """Returns the cached value for key, or default if missing or expired."""
+        path = self._path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return default
+
+        if self.ttl_seconds and time.time() - entry.get("created", 0) > self.ttl_seconds:
+            self._remove(path)
+            return default
+
+        # Bump the access time so eviction is least-recently-used
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return entry.get("value", default)
+
+    def set(self, key, value):
+        """Stores a JSON-serialisable value under key."""
+        entry = {"created": time.time(), "value": value}
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(entry, f, ensure_ascii=False)
+            os.replace(tmp_path, self._path(key))
+        except OSError:
+            self._remove(tmp_path)
+            return
+        self._evict()
+
+    def delete(self, key):
+        """Removes a single entry if present."""
+        self._remove(self._path(key))
+
+    def _remove(self, path):
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+    def _evict(self):
+        """Drops expired entries, then the oldest ones until under max_bytes."""
+        with self._lock:
+            now = time.time()
+            entries = []
+            total = 0
+            for name in os.listdir(self.directory):
+                if not name.endswith(".json"):
+                    continue
+                path = os.path.join(self.directory, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                if self.ttl_seconds and now - stat.st_mtime > self.ttl_seconds:
+                    self._remove(path)
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+                total += stat.st_size
+
+            entries.sort()
+            for _, size, path in entries:
+                if total <= self.max_bytes:
+                    break
+                self._remove(path)
+                total -= size
@@ -0,0 +1,244 @@
+# -- coding: utf-8 --
+"""
+SQLite store of past encounters with a full-text index for prior history.
+
+Each encounter keeps its transcript, extracted patient data, differential
+diagnosis and prescription, plus a compact "findings" text built when it is
+saved. When a returning patient is seen again, the findings of their earlier
+encounters are fetched with indexed queries and used as past history,
+instead of uploading and parsing a PDF at every visit. Patients are matched
+by IP No first, then by their whole name (ignoring case and spacing): the
+FTS5 index finds the encounters whose name contains its words, and only
+exact matches are kept. A name shared by patients with different IP Nos
+matches nobody.
+
+The database runs in write-ahead-logging mode, so readers are never blocked by
+the writer, and save_many writes a whole batch in one transaction.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+from ipd_form import IPDForm, json_default, prompt_value
+from prompt_budget import compact_json
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS encounters (
+    id TEXT PRIMARY KEY,
+    patient_id TEXT,
+    patient_name TEXT,
+    created REAL NOT NULL,
+    transcript TEXT NOT NULL,
+    patient_data TEXT,
+    differential_diagnosis TEXT,
+    prescription TEXT,
+    findings TEXT,
+    medications TEXT
+);
+CREATE INDEX IF NOT EXISTS encounters_patient ON encounters (patient_id, created);
+CREATE VIRTUAL TABLE IF NOT EXISTS encounters_fts USING fts5(
+    patient_name, findings, medications, content='encounters', content_rowid='rowid'
+);
+CREATE TRIGGER IF NOT EXISTS encounters_ai AFTER INSERT ON encounters BEGIN
+    INSERT INTO encounters_fts (rowid, patient_name, findings, medications)
+    VALUES (new.rowid, new.patient_name, new.findings, new.medications);
+END;
+CREATE TRIGGER IF NOT EXISTS encounters_ad AFTER DELETE ON encounters BEGIN
+    INSERT INTO encounters_fts (encounters_fts, rowid, patient_name, findings, medications)
+    VALUES ('delete', old.rowid, old.patient_name, old.findings, old.medications);
+END;
+CREATE TRIGGER IF NOT EXISTS encounters_au AFTER UPDATE ON encounters BEGIN
+    INSERT INTO encounters_fts (encounters_fts, rowid, patient_name, findings, medications)
+    VALUES ('delete', old.rowid, old.patient_name, old.findings, old.medications);
+    INSERT INTO encounters_fts (rowid, patient_name, findings, medications)
+    VALUES (new.rowid, new.patient_name, new.findings, new.medications);
+END;
+"""
+
+# Fields given as None keep what an earlier save stored, so the assessment and
+# the prescription of one encounter can be saved separately
+UPSERT = """
+INSERT INTO encounters (id, patient_id, patient_name, created, transcript, patient_data,
+                        differential_diagnosis, prescription, findings, medications)
+VALUES (:id, :patient_id, :patient_name, :created, :transcript, :patient_data,
+        :differential_diagnosis, :prescription, :findings, :medications)
+ON CONFLICT (id) DO UPDATE SET
+    patient_id = COALESCE(excluded.patient_id, patient_id),
+    patient_name = COALESCE(excluded.patient_name, patient_name),
+    transcript = CASE WHEN excluded.transcript != '' THEN excluded.transcript ELSE transcript END,
+    patient_data = COALESCE(excluded.patient_data, patient_data),
+    differential_diagnosis = COALESCE(excluded.differential_diagnosis, differential_diagnosis),
+    prescription = COALESCE(excluded.prescription, prescription),
+    findings = COALESCE(excluded.findings, findings),
+    medications = COALESCE(excluded.medications, medications)
+"""
+
+PRIOR_BY_ID = """
+SELECT created, findings, medications FROM encounters
+WHERE patient_id = :patient AND id != :exclude
+ORDER BY created DESC LIMIT :limit
+"""
+
+# Candidates sharing the name's words, through the FTS5 index; the whole name is compared in prior_findings
+NAME_CANDIDATES = """
+SELECT id, patient_id, patient_name, created, findings, medications FROM encounters
+WHERE rowid IN (SELECT rowid FROM encounters_fts WHERE encounters_fts MATCH :name_query)
+ORDER BY created DESC
+"""
+
+
+def findings_text(patient_data, differential_diagnosis):
+    """Compact text of an encounter's findings, as embedded in later prompts."""
+    parts = []
+    data = prompt_value(patient_data)
+    if isinstance(data, dict) and data and "Error" not in data:
+        parts.append(f"Patient data: {compact_json(data)}")
+    if isinstance(differential_diagnosis, dict) and differential_diagnosis.get("Differential Diagnosis"):
+        parts.append("Differential diagnosis: " + ", ".join(str(d) for d in differential_diagnosis["Differential Diagnosis"]))
+    return "\n".join(parts) or None
+
+
+def medications_text(prescription):
+    """One line per prescribed medicine, e.g. "Metformin 500 mg, Twice daily, 3 months"."""
+    if not isinstance(prescription, dict) or not prescription.get("Medications"):
+        return None
+    lines = []
+    for med in prescription["Medications"]:
+        details = ", ".join(str(med[key]) for key in ("Dosage", "Frequency", "Duration") if med.get(key))
+        lines.append(f"{med.get('Medicine Name', '')} {details}".strip())
+    return "\n".join(lines)
+
+
+def name_query(patient):
+    """FTS5 query for encounters whose patient_name contains the words of patient."""
+    return 'patient_name : "' + patient.replace('"', '""') + '"'
+
+
+def normalize_name(name):
+    """Name as compared when looking up a patient: case-folded, with single spaces ("" -> None)."""
+    return " ".join(str(name or "").casefold().split()) or None
+
+
+class EncounterStore:
+    """
+    Encounters saved in one SQLite file, shared by every session and batch worker.
+
+    Connections are per thread; writes are serialized by a lock (SQLite allows
+    a single writer) while reads proceed concurrently under WAL.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._write_lock = threading.Lock()
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        with self._write_lock:
+            self._connection().executescript(SCHEMA)
+
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            # Durable enough with WAL (only the last commits can be lost on power failure), and much faster
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    @staticmethod
+    def _row(record):
+        """Converts an encounter record (see save_many) to the upsert's parameters."""
+        patient_data = record.get("patient_data")
+        patient_id = record.get("patient_id")
+        patient_name = record.get("patient_name")
+        if isinstance(patient_data, IPDForm):
+            patient_id = patient_id or patient_data.get("Patient Information", "IP No") or None
+            patient_name = patient_name or patient_data.get("Patient Information", "Patient's Name") or None
+
+        def dumps(key):
+            value = record.get(key)
+            return None if value is None else json.dumps(value, ensure_ascii=False, default=json_default)
+
+        return {
+            "id": record["id"],
+            "patient_id": patient_id,
+            "patient_name": patient_name,
+            "created": record.get("created") or time.time(),
+            "transcript": record.get("transcript") or "",
+            "patient_data": dumps("patient_data"),
+            "differential_diagnosis": dumps("differential_diagnosis"),
+            "prescription": dumps("prescription"),
+            "findings": findings_text(patient_data, record.get("differential_diagnosis")),
+            "medications": medications_text(record.get("prescription")),
+        }
+
+    def save_many(self, records):
+        """
+        Saves encounters in a single transaction.
+
+        Args:
+            records (list): Dicts with "id" and any of "patient_id", "patient_name",
+                "transcript", "patient_data", "differential_diagnosis" and
+                "prescription". Saving an existing id updates the given fields.
+        """
+        rows = [self._row(record) for record in records]
+        if not rows:
+            return
+        connection = self._connection()
+        with self._write_lock, connection:
+            connection.executemany(UPSERT, rows)
+
+    def save(self, **record):
+        self.save_many([record])
+
+    def has_patient_id(self, patient):
+        """Whether an encounter is saved under this IP No."""
+        return self._connection().execute(KNOWN_PATIENT_ID, {"patient": patient}).fetchone() is not None
+
+    def prior_findings(self, patient, exclude=None, limit=3):
+        """
+        Returns the findings of a patient's most recent earlier encounters as past history text.
+
+        The IP No is matched first; only if no encounter has it, the whole name
+        is (ignoring case and spacing, never a part of it). A name saved for
+        patients with different IP Nos returns "", as their histories must not
+        be mixed.
+
+        Args:
+            patient (str): IP No, or the patient's name
+            exclude (str): Encounter id to leave out (the one being assessed)
+            limit (int): Maximum number of encounters
+        """
+        patient = (patient or "").strip()
+        if not patient:
+            return ""
+        connection = self._connection()
+        rows = connection.execute(PRIOR_BY_ID, {"patient": patient, "exclude": exclude or "", "limit": limit}).fetchall()
+        if not rows:
+            name = normalize_name(patient)
+            matches = [
+                row for row in connection.execute(NAME_CANDIDATES, {"name_query": name_query(patient)})
+                if normalize_name(row[2]) == name
+            ]
+            if len({row[1] for row in matches if row[1]}) > 1:
+                return ""
+            rows = [row[3:] for row in matches if row[0] != exclude][:limit]
+        entries = []
+        for created, findings, medications in rows:
+            lines = [f"Prior encounter on {datetime.fromtimestamp(created).strftime('%Y-%m-%d')}:"]
+            if findings:
+                lines.append(findings)
+            if medications:
+                lines.append("Medications: " + "; ".join(medications.split("\n")))
+            entries.append("\n".join(lines))
+        return "\n\n".join(entries)
+
+    def close(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is not None:
+            connection.close()
+            self._local.connection = None
@@ -0,0 +1,120 @@
+# -- coding: utf-8 --
+"""
+Local TF-IDF retrieval over past history text.
+
+Long histories are split into overlapping passages and indexed with NumPy so
+only the passages relevant to the current conversation (and to each section
+of the IPD form) are sent to the model, keeping prompt size roughly constant
+however thick the patient's file is.
+"""
+import math
+import re
+from collections import Counter
+
+import numpy as np
+
+from prompt_budget import approx_tokens
+
+STOPWORDS = frozenset("""
+a an and are as at be been but by for from had has have he her his i if in into is it its me my no not of on or our
+she so than that the their them then there these they this to was we were what when which who will with you your
+""".split())
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+(?:[./][a-z0-9]+)*")
+
+
+def tokenize(text):
+    """Lowercased word/number terms without stopwords (keeps e.g. 140/90, hba1c)."""
+    return [term for term in TOKEN_PATTERN.findall(text.lower()) if term not in STOPWORDS]
+
+
+def chunk_text(text, chunk_words=120, overlap_words=30):
+    """Splits text into overlapping passages of about chunk_words words."""
+    words = text.split()
+    if not words:
+        return []
+    step = max(1, chunk_words - overlap_words)
+    return [" ".join(words[start:start + chunk_words]) for start in range(0, max(1, len(words) - overlap_words), step)]
+
+
+class TfidfIndex:
+    """L2-normalised TF-IDF vectors of a list of passages."""
+
+    def __init__(self, passages):
+        self.passages = passages
+        counts = [Counter(tokenize(passage)) for passage in passages]
+        self.vocabulary = {}
+        for passage_counts in counts:
+            for term in passage_counts:
+                self.vocabulary.setdefault(term, len(self.vocabulary))
+
+        matrix = np.zeros((len(passages), len(self.vocabulary)), dtype=np.float32)
+        for row, passage_counts in enumerate(counts):
+            for term, count in passage_counts.items():
+                matrix[row, self.vocabulary[term]] = 1.0 + math.log(count)
+
+        document_frequency = np.count_nonzero(matrix, axis=0)
+        self.idf = (np.log((1 + len(passages)) / (1 + document_frequency)) + 1.0).astype(np.float32)
+        matrix *= self.idf
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        self.matrix = matrix / np.maximum(norms, 1e-12)
+
+    def scores(self, query):
+        """Cosine similarity of every passage to the query text."""
+        vector = np.zeros(len(self.vocabulary), dtype=np.float32)
+        for term, count in Counter(tokenize(query)).items():
+            index = self.vocabulary.get(term)
+            if index is not None:
+                vector[index] = 1.0 + math.log(count)
+        vector *= self.idf
+        norm = np.linalg.norm(vector)
+        if norm == 0:
+            return np.zeros(len(self.passages), dtype=np.float32)
+        return self.matrix @ (vector / norm)
+
+
+def select_passages(text, queries, token_budget=1500, top_k=3):
+    """
+    Returns the parts of text most relevant to the queries, within token_budget.
+
+    Each query contributes its top_k passages; passages are then taken in
+    round-robin rank order until the budget is used and returned in document
+    order, separated by "[...]" so the model can see where text was left out. Text that already
+    fits the budget is returned unchanged; if no passage shares a term with any
+    query, the leading passages are taken instead.
+
+    Args:
+        text (str): Full past history text
+        queries (list): Query strings (e.g. the transcript and one per form section)
+        token_budget (int): Approximate maximum tokens of the returned text
+        top_k (int): Passages considered per query
+
+    Returns:
+        str: The selected passages
+    """
+    if approx_tokens(text) <= token_budget:
+        return text
+    passages = chunk_text(text)
+    index = TfidfIndex(passages)
+
+    # Rank candidates round-robin: every query's best passage comes before any
+    # query's second best, so one broad query cannot crowd out the others
+    rank = {}
+    for query in queries:
+        scores = index.scores(query)
+        for position, i in enumerate(np.argsort(-scores)[:top_k]):
+            if scores[i] > 0:
+                key = (position, -float(scores[i]))
+                rank[int(i)] = min(rank.get(int(i), key), key)
+
+    # Nothing matched (e.g. a history in another language): keep the start of the history
+    candidates = sorted(rank, key=rank.get) if rank else range(len(passages))
+    selected = []
+    used = 0
+    for i in candidates:
+        cost = approx_tokens(passages[i])
+        if used + cost > token_budget:
+            continue
+        selected.append(i)
+        used += cost
+    return "\n[...]\n".join(passages[i] for i in sorted(selected))
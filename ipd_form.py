@@ -0,0 +1,269 @@
+# -- coding: utf-8 --
+"""
+Typed model of the Hospital Initial Assessment Form (IPD).
+
+IPD_FORM_TEMPLATE is the single definition of the form. Extracted patient
+data is validated against it once, when the model's JSON is parsed, into an
+IPDForm: every template field is present, every value is a string and extra
+fields the model added are kept at the end. The flattened rows, the pruned
+prompt dict and the display table are computed once per form and reused by
+prompts, the Streamlit tables and PDF export on every rerun.
+"""
+from dataclasses import dataclass
+
+from prompt_budget import compact_json, prune_empty
+
+# Hospital Initial Assessment Form (IPD) fields requested from the model
+IPD_FORM_TEMPLATE = {
+    "Patient Information": {
+        "Patient's Name": "",
+        "IP No": "",
+        "Age": "",
+        "Date/Time of Admission": "",
+        "Ward/ICU/EM": "",
+        "Medico-Legal Case": "",
+        "Marital Status": "",
+        "Socio-Economic Class": ""
+    },
+    "Allergies": {
+        "Has Allergies": "",
+        "Details": "",
+        "Reaction": ""
+    },
+    "Chief Complaints": "",
+    "Investigation Reports": "",
+    "Past History": {
+        "Hypertension": "",
+        "Diabetes": "",
+        "Heart Disease": "",
+        "Tuberculosis": "",
+        "Past Surgeries": "",
+        "Hospitalizations": ""
+    },
+    "Investigation Findings": {
+        "BP/Sugar": "",
+        "HbA1C": "",
+        "HIV/HBsAg/HCV": "",
+        "Imaging Findings": "",
+        "Other Tests": ""
+    },
+    "Advice": {
+        "NBM Consent": "",
+        "Surgical Risk": "",
+        "ASA Risk Grade": "",
+        "Plan of Anesthesia": "",
+        "Morning Investigations": ""
+    },
+    "Family History": {
+        "Hypertension": "",
+        "Diabetes": "",
+        "Heart Disease": "",
+        "Tuberculosis": "",
+        "Other Chronic Illnesses": ""
+    },
+    "Personal History": {
+        "Diet": "",
+        "Appetite": "",
+        "Sleep": "",
+        "Smoking": "",
+        "Alcohol": "",
+        "Drugs": "",
+        "Tobacco": ""
+    },
+    "Physical Examination": {
+        "Vital Signs": {
+            "Temperature": "",
+            "Pulse": "",
+            "BP": "",
+            "SPO2": "",
+            "Respiratory Rate": ""
+        },
+        "General Examination": {
+            "Anemia": "",
+            "Clubbing": "",
+            "Cyanosis": "",
+            "Jaundice": "",
+            "Lymphadenopathy": "",
+            "Pedal Edema": ""
+        },
+        "Systematic Examination": {
+            "Respiratory": "",
+            "Cardiovascular": "",
+            "Musculoskeletal": "",
+            "Abdomen": "",
+            "Neurological": ""
+        }
+    }
+}
+
+
+def _template_paths(template, prefix=()):
+    for key, value in template.items():
+        if isinstance(value, dict):
+            yield from _template_paths(value, prefix + (key,))
+        else:
+            yield prefix + (key,)
+
+
+# Field paths in form order, e.g. ("Physical Examination", "Vital Signs", "BP")
+FIELD_PATHS = tuple(_template_paths(IPD_FORM_TEMPLATE))
+
+# The empty form as sent in extraction prompts
+PROMPT_TEMPLATE = compact_json(IPD_FORM_TEMPLATE)
+
+
+def _section_query(section, fields):
+    terms = [section]
+    if isinstance(fields, dict):
+        for field, value in fields.items():
+            terms.append(field)
+            if isinstance(value, dict):
+                terms.extend(value)
+    return " ".join(terms)
+
+
+# One retrieval query per section: its name plus its field names
+SECTION_QUERIES = tuple(_section_query(section, fields) for section, fields in IPD_FORM_TEMPLATE.items())
+
+
+def normalize_value(value):
+    """Coerces a value the model returned for a field into the field's string."""
+    if value is None:
+        return ""
+    if isinstance(value, str):
+        return value.strip()
+    if isinstance(value, list):
+        return ", ".join(item for item in (normalize_value(v) for v in value) if item)
+    if isinstance(value, dict):
+        return "; ".join(f"{k}: {v}" for k, v in ((k, normalize_value(v)) for k, v in value.items()) if v)
+    return str(value)
+
+
+def _extra_fields(data, prefix, known):
+    """Yields fields of data that are not in the template, flattened to leaf paths."""
+    for key, value in data.items():
+        path = prefix + (str(key),)
+        if path in _FIELD_PATH_SET:
+            # A template field; parse() already flattened an object given here into its value
+            continue
+        if isinstance(value, dict) and path in known:
+            yield from _extra_fields(value, path, known)
+        elif path not in known:
+            if isinstance(value, dict):
+                yield from _extra_fields(value, path, set())
+            else:
+                yield FormField(path, normalize_value(value))
+
+
+# Prefixes of FIELD_PATHS, i.e. the sections and subsections of the template
+_SECTION_PATHS = frozenset(path[:i] for path in FIELD_PATHS for i in range(1, len(path)))
+_FIELD_PATH_SET = frozenset(FIELD_PATHS)
+_KNOWN_PATHS = _FIELD_PATH_SET | _SECTION_PATHS
+
+
+@dataclass
+class FormField:
+    """One leaf field of the form."""
+    __slots__ = ("path", "value")
+    path: tuple
+    value: str
+
+    @property
+    def section(self):
+        return self.path[0]
+
+    @property
+    def label(self):
+        """Field name within its section; nested names are joined, e.g. "Vital Signs - BP"."""
+        return " - ".join(self.path[1:]) or self.path[0]
+
+
+@dataclass
+class IPDForm:
+    """
+    Validated IPD patient data.
+
+    fields holds every template field in form order, followed by extra fields.
+    Forms are not modified after parsing; sessions and job threads share them.
+    """
+    __slots__ = ("fields", "sections", "compact", "_tables")
+    fields: tuple
+
+    def __post_init__(self):
+        sections = {}
+        for field in self.fields:
+            sections.setdefault(field.section, []).append(field)
+        # (section, fields) pairs for tables and PDF export
+        self.sections = tuple((section, tuple(fields)) for section, fields in sections.items())
+        # Filled fields only, as embedded in later prompts
+        self.compact = prune_empty(self.to_dict()) or {}
+        self._tables = None
+
+    def __reduce__(self):
+        # Pickle (for the PDF process pool) without the cached tables
+        return IPDForm, (self.fields,)
+
+    @classmethod
+    def parse(cls, data):
+        """
+        Validates extracted patient data against IPD_FORM_TEMPLATE.
+
+        Missing fields become "", lists and numbers become strings, and a
+        plain value given for a whole section is kept as its "Other" field.
+
+        Raises:
+            ValueError: If data is not a JSON object
+        """
+        if not isinstance(data, dict):
+            raise ValueError(f"Expected a JSON object, got {type(data).__name__}")
+        fields = []
+        for path in FIELD_PATHS:
+            value = data
+            for key in path:
+                value = value.get(key) if isinstance(value, dict) else None
+            fields.append(FormField(path, normalize_value(value)))
+        for section in IPD_FORM_TEMPLATE:
+            value = data.get(section)
+            if (section,) in _SECTION_PATHS and value is not None and not isinstance(value, dict):
+                fields.append(FormField((section, "Other"), normalize_value(value)))
+        fields.extend(_extra_fields(data, (), _KNOWN_PATHS))
+        return cls(tuple(fields))
+
+    def get(self, *path):
+        """Returns the value of the field at path, e.g. get("Patient Information", "IP No"), or ""."""
+        for field in self.fields:
+            if field.path == path:
+                return field.value
+        return ""
+
+    def to_dict(self):
+        """Returns the form as nested dicts shaped like IPD_FORM_TEMPLATE."""
+        data = {}
+        for field in self.fields:
+            target = data
+            for key in field.path[:-1]:
+                target = target.setdefault(key, {})
+            target[field.path[-1]] = field.value
+        return data
+
+    def tables(self):
+        """Returns (section, DataFrame of its fields) pairs for display, built once per form."""
+        if self._tables is None:
+            # Imported here so PDF pool workers, which only render forms, do not load pandas
+            import pandas as pd
+            self._tables = tuple(
+                (section, pd.DataFrame({"Value": [f.value for f in fields]}, index=pd.Index([f.label for f in fields], name="Field")))
+                for section, fields in self.sections
+            )
+        return self._tables
+
+def prompt_value(patient_data):
+    """Returns what to embed in a prompt for patient data: a form's pruned dict, anything else as is."""
+    return patient_data.compact if isinstance(patient_data, IPDForm) else patient_data
+
+
+def json_default(value):
+    """json.dumps default that serializes forms as nested dicts."""
+    if isinstance(value, IPDForm):
+        return value.to_dict()
+    return str(value)
@@ -0,0 +1,119 @@
+# -- coding: utf-8 --
+"""
+Background jobs that outlive Streamlit reruns.
+
+A rerun or page switch stops the script thread, so long work (transcription,
+LLM stages) runs on the JobManager's worker pool instead. Each job has an ID
+and per-stage status, partial output and results that the UI polls on every
+rerun. Submitting the same input twice returns the job already running (or
+finished) for it.
+"""
+import contextvars
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+QUEUED, RUNNING, DONE, FAILED = "queued", "running", "done", "failed"
+
+
+class Job:
+    """Status and per-stage results of one background job."""
+
+    def __init__(self, job_id, kind, key):
+        self.id = job_id
+        self.kind = kind
+        self.key = key
+        self.status = QUEUED
+        self.error = None
+        self.created = time.time()
+        self.finished = None
+        self.stages = {}
+        self._lock = threading.Lock()
+
+    @property
+    def done(self):
+        return self.status in (DONE, FAILED)
+
+    def update_stage(self, stage, **fields):
+        """Merges fields (status, result, partial, progress, ...) into a stage's entry."""
+        with self._lock:
+            self.stages.setdefault(stage, {"status": QUEUED}).update(fields)
+
+    def stage_result(self, stage, default=None):
+        with self._lock:
+            return self.stages.get(stage, {}).get("result", default)
+
+    def snapshot(self):
+        """Returns a consistent copy of the job's state for rendering."""
+        with self._lock:
+            return {
+                "id": self.id,
+                "kind": self.kind,
+                "status": self.status,
+                "error": self.error,
+                "created": self.created,
+                "finished": self.finished,
+                "stages": {stage: dict(info) for stage, info in self.stages.items()}
+            }
+
+
+class JobManager:
+    """Runs jobs on a bounded worker pool and keeps the most recent ones for polling."""
+
+    def __init__(self, max_workers=4, max_jobs=200):
+        self.max_jobs = max_jobs
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="echo-med-job")
+        self._jobs = OrderedDict()
+        self._by_key = {}
+        self._lock = threading.Lock()
+
+    def submit(self, kind, key, func, *args):
+        """
+        Starts func(job, *args) in the background, unless a job for key exists.
+
+        A failed job is replaced by a new one. The job runs in a copy of the
+        caller's context, so context variables such as the session's API key
+        and metrics target carry over.
+
+        Returns:
+            Job: The new or existing job
+        """
+        with self._lock:
+            existing = self._by_key.get(key)
+            if existing is not None and existing.status != FAILED:
+                return existing
+            job = Job(uuid.uuid4().hex[:12], kind, key)
+            self._jobs[job.id] = job
+            self._by_key[key] = job
+            self._evict()
+        self._executor.submit(contextvars.copy_context().run, self._run, job, func, args)
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def _run(self, job, func, args):
+        job.status = RUNNING
+        try:
+            func(job, *args)
+            job.status = DONE
+        except Exception as e:
+            job.error = str(e)
+            job.status = FAILED
+        finally:
+            job.finished = time.time()
+
+    def _evict(self):
+        """Forgets the oldest finished jobs beyond max_jobs; running jobs are kept."""
+        excess = len(self._jobs) - self.max_jobs
+        for job_id, job in list(self._jobs.items()):
+            if excess <= 0:
+                break
+            if job.done:
+                del self._jobs[job_id]
+                if self._by_key.get(job.key) is job:
+                    del self._by_key[job.key]
+                excess -= 1
@@ -0,0 +1,323 @@
+# -- coding: utf-8 --
+"""
+Local pre-annotation of transcripts with a drug and symptom lexicon.
+
+An Aho-Corasick automaton over every term of the lexicon (drug names and
+brands, symptom phrases, dosing frequencies, food instructions) finds all
+mentions in one pass over the transcript, however large the lexicon is. Doses
+and durations are picked up with regular expressions. The annotations
+pre-fill the prescription and chief complaints in milliseconds, select the
+transcript sentences the prescription prompt needs and cross-check what the
+model returned.
+
+A lexicon is a JSON file of {category: {canonical name: [synonyms]}}; see
+medical_lexicon.json.
+"""
+import bisect
+import json
+import os
+import re
+from collections import deque
+from dataclasses import dataclass
+
+DEFAULT_LEXICON = os.path.join(os.path.dirname(os.path.abspath(__file__)), "medical_lexicon.json")
+
+# Lexicon category -> annotation kind
+KINDS = {"drugs": "drug", "symptoms": "symptom", "frequencies": "frequency", "instructions": "instruction"}
+
+# Annotation kinds that describe a prescription
+PRESCRIPTION_KINDS = ("drug", "dose", "frequency", "instruction")
+
+NUMBER_WORDS = {
+    "a": 1, "an": 1, "one": 1, "two": 2, "three": 3, "four": 4, "five": 5, "six": 6, "seven": 7,
+    "eight": 8, "nine": 9, "ten": 10, "eleven": 11, "twelve": 12, "fifteen": 15, "twenty": 20, "thirty": 30
+}
+
+DOSE_PATTERN = re.compile(
+    r"\b(\d+(?:\.\d+)?)\s*(mg|milligrams?|mcg|micrograms?|g|grams?|ml|millilit(?:re|er)s?|iu|units?|puffs?|tablets?|tabs?|capsules?|drops?)\b",
+    re.IGNORECASE
+)
+DURATION_PATTERN = re.compile(
+    r"\b(?:for|since|past|last)\s+(?:(?:the|about|around|nearly|almost|over|past|last)\s+)*"
+    r"(\d+|" + "|".join(NUMBER_WORDS) + r")\s+(hours?|days?|weeks?|months?|years?)\b"
+    r"|\bsince\s+(yesterday)\b",
+    re.IGNORECASE
+)
+SENTENCE_END = re.compile(r"[.?!]+(?:\s+|$)")
+
+DOSE_UNITS = {"milligram": "mg", "microgram": "mcg", "gram": "g", "millilitre": "ml", "milliliter": "ml"}
+
+
+@dataclass
+class Annotation:
+    """A lexicon term, dose or duration found in a transcript."""
+    __slots__ = ("kind", "term", "start", "end")
+    kind: str
+    term: str
+    start: int
+    end: int
+
+
+class AhoCorasick:
+    """Finds every occurrence of many patterns in a single left-to-right pass over a text."""
+
+    def __init__(self, patterns):
+        """
+        Args:
+            patterns: Iterable of (pattern, payload); patterns are matched as given (lowercase them first)
+        """
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [()]
+        for pattern, payload in patterns:
+            node = 0
+            for char in pattern:
+                child = self._goto[node].get(char)
+                if child is None:
+                    child = len(self._goto)
+                    self._goto[node][char] = child
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._out.append(())
+                node = child
+            self._out[node] += ((len(pattern), payload),)
+
+        # Breadth-first, so a node's failure link (its longest proper suffix in
+        # the trie) is final before its children need it
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, child in self._goto[node].items():
+                fail = self._fail[node]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[child] = self._goto[fail].get(char, 0)
+                self._out[child] += self._out[self._fail[child]]
+                queue.append(child)
+        self.size = len(self._goto)
+
+    def find(self, text):
+        """Yields (start, end, payload) for every pattern occurrence in text."""
+        goto, fail, out = self._goto, self._fail, self._out
+        node = 0
+        for i, char in enumerate(text):
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            for length, payload in out[node]:
+                yield i + 1 - length, i + 1, payload
+
+
+def lowercase(text):
+    """Lowercases text without changing its length, so match offsets stay valid."""
+    lowered = text.lower()
+    if len(lowered) == len(text):
+        return lowered
+    return "".join(c.lower() if len(c.lower()) == 1 else c for c in text)
+
+
+def is_word_boundary(text, start, end):
+    return (start == 0 or not text[start - 1].isalnum()) and (end == len(text) or not text[end].isalnum())
+
+
+def normalize_dose(match):
+    unit = match.group(2).lower()
+    for name, short in DOSE_UNITS.items():
+        if unit.startswith(name):
+            unit = short
+    return f"{match.group(1)} {unit}"
+
+
+def normalize_duration(match):
+    if match.group(3):
+        return "1 day"
+    count = match.group(1).lower()
+    count = NUMBER_WORDS.get(count, count)
+    unit = match.group(2).lower().rstrip("s")
+    return f"{count} {unit}" + ("s" if str(count) != "1" else "")
+
+
+class Lexicon:
+    """Drug, symptom, frequency and instruction terms compiled into one automaton."""
+
+    def __init__(self, entries):
+        """
+        Args:
+            entries (dict): {category: {canonical name: [synonyms]}}; the categories
+                in KINDS are understood, others are annotated with their own name
+        """
+        self.canonical = {}
+        patterns = []
+        for category, terms in entries.items():
+            kind = KINDS.get(category, category)
+            for name, synonyms in terms.items():
+                for term in {name, *synonyms}:
+                    term = lowercase(term.strip())
+                    if term:
+                        patterns.append((term, (kind, name)))
+                        self.canonical[(kind, term)] = name
+        self.automaton = AhoCorasick(patterns)
+        self.terms = len(patterns)
+
+    @classmethod
+    def load(cls, path=DEFAULT_LEXICON):
+        with open(path, encoding="utf-8") as f:
+            return cls(json.load(f))
+
+    def annotate(self, text):
+        """
+        Returns the annotations of text, ordered by position.
+
+        Overlapping lexicon matches keep the longest (e.g. "chest pain" over
+        "pain"); every match must start and end on a word boundary.
+        """
+        lowered = lowercase(text)
+        matches = sorted(
+            (start, -end, payload) for start, end, payload in self.automaton.find(lowered)
+            if is_word_boundary(lowered, start, end)
+        )
+        annotations = []
+        covered = 0
+        for start, negative_end, (kind, name) in matches:
+            if start >= covered:
+                annotations.append(Annotation(kind, name, start, -negative_end))
+                covered = -negative_end
+        for match in DOSE_PATTERN.finditer(text):
+            annotations.append(Annotation("dose", normalize_dose(match), match.start(), match.end()))
+        for match in DURATION_PATTERN.finditer(text):
+            annotations.append(Annotation("duration", normalize_duration(match), match.start(), match.end()))
+        annotations.sort(key=lambda a: a.start)
+        return annotations
+
+    def find_term(self, kind, text):
+        """Returns the canonical name of the first kind term in text (e.g. a drug in "Amlodipine 5mg"), or None."""
+        lowered = lowercase(text.strip())
+        if (kind, lowered) in self.canonical:
+            return self.canonical[(kind, lowered)]
+        for start, end, (found_kind, name) in self.automaton.find(lowered):
+            if found_kind == kind and is_word_boundary(lowered, start, end):
+                return name
+        return None
+
+
+def sentence_starts(text):
+    """Start offsets of the sentences of text."""
+    return [0] + [match.end() for match in SENTENCE_END.finditer(text) if match.end() < len(text)]
+
+
+def prefill_prescription(text, annotations):
+    """
+    Builds prescription rows from the annotations alone.
+
+    Each drug takes the dose, frequency, duration and instruction that follow
+    it in the same sentence, up to the next drug.
+    """
+    starts = sentence_starts(text)
+    medications = {}
+    current, sentence = None, None
+    for annotation in annotations:
+        annotation_sentence = bisect.bisect_right(starts, annotation.start)
+        if annotation.kind == "drug":
+            current = medications.setdefault(annotation.term, {
+                "Medicine Name": annotation.term, "Dosage": "", "Frequency": "", "Duration": "", "Special Instructions": ""
+            })
+            sentence = annotation_sentence
+        elif current is not None and annotation_sentence == sentence:
+            field = {"dose": "Dosage", "frequency": "Frequency", "duration": "Duration", "instruction": "Special Instructions"}.get(annotation.kind)
+            if field and not current[field]:
+                current[field] = annotation.term
+    return list(medications.values())
+
+
+def prefill_complaints(text, annotations):
+    """Builds chief complaints (symptom and, if stated in the same sentence, its duration) from the annotations."""
+    starts = sentence_starts(text)
+    durations = {}
+    for annotation in annotations:
+        if annotation.kind == "duration":
+            durations.setdefault(bisect.bisect_right(starts, annotation.start), annotation.term)
+    complaints = {}
+    for annotation in annotations:
+        if annotation.kind == "symptom" and annotation.term not in complaints:
+            complaints[annotation.term] = {
+                "Complaint": annotation.term,
+                "Duration": durations.get(bisect.bisect_right(starts, annotation.start), "")
+            }
+    return list(complaints.values())
+
+
+def relevant_excerpt(text, annotations, kinds, context=1):
+    """
+    Returns the sentences of text that contain an annotation of the given kinds,
+    with context sentences around each; text itself if there are none.
+    """
+    starts = sentence_starts(text)
+    keep = set()
+    for annotation in annotations:
+        if annotation.kind in kinds:
+            index = bisect.bisect_right(starts, annotation.start) - 1
+            keep.update(range(max(0, index - context), min(len(starts), index + context + 1)))
+    if not keep:
+        return text
+    ends = starts[1:] + [len(text)]
+    parts = []
+    previous = None
+    for index in sorted(keep):
+        if previous is not None and index != previous + 1:
+            parts.append("...")
+        parts.append(text[starts[index]:ends[index]].strip())
+        previous = index
+    return " ".join(parts)
+
+
+def dose_number(dose):
+    match = re.search(r"\d+(?:\.\d+)?", dose or "")
+    return float(match.group()) if match else None
+
+
+def cross_check_prescription(prescription, text, annotations, lexicon):
+    """
+    Compares a generated prescription with what the transcript mentions.
+
+    Returns:
+        list: Warnings for medicines not mentioned in the conversation, mentioned
+        medicines missing from the prescription, and doses that differ
+    """
+    medications = prescription.get("Medications") if isinstance(prescription, dict) else None
+    medications = [med for med in medications or [] if isinstance(med, dict)]
+    mentioned = {med["Medicine Name"]: med for med in prefill_prescription(text, annotations)}
+    lowered = lowercase(text)
+    warnings = []
+    prescribed = set()
+    for med in medications:
+        name = str(med.get("Medicine Name", "")).strip()
+        if not name:
+            continue
+        canonical = lexicon.find_term("drug", name)
+        prescribed.add(canonical)
+        if canonical in mentioned:
+            said, written = dose_number(mentioned[canonical]["Dosage"]), dose_number(str(med.get("Dosage", "")))
+            if said is not None and written is not None and said != written:
+                warnings.append(f"{name}: the conversation mentions {mentioned[canonical]['Dosage']}, the prescription says {med.get('Dosage')}")
+        elif canonical is not None or lowercase(name) not in lowered:
+            warnings.append(f"{name} is not mentioned in the conversation")
+    for canonical in mentioned:
+        if canonical not in prescribed:
+            warnings.append(f"{canonical} is mentioned in the conversation but not in the prescription")
+    return warnings
+
+
+def cross_check_complaints(complaints, annotations, lexicon):
+    """Returns warnings for symptoms mentioned in the conversation but missing from the chief complaints."""
+    if not isinstance(complaints, list):
+        return []
+    listed = " ; ".join(
+        " ".join(str(v) for v in complaint.values()) if isinstance(complaint, dict) else str(complaint)
+        for complaint in complaints
+    )
+    covered = {annotation.term for annotation in lexicon.annotate(listed) if annotation.kind == "symptom"}
+    missing = []
+    for annotation in annotations:
+        if annotation.kind == "symptom" and annotation.term not in covered and annotation.term not in missing:
+            missing.append(annotation.term)
+    return [f"{symptom} is mentioned in the conversation but not among the chief complaints" for symptom in missing]
@@ -0,0 +1,239 @@
+# -- coding: utf-8 --
+"""
+Per-stage latency, token and cost instrumentation.
+
+Pipeline functions are wrapped with @instrument(stage). Every OpenAI call made
+inside a stage is reported with record_api_call, so each finished stage yields
+one record with its wall time, tokens, retries and estimated cost. Records
+feed process-wide histograms/counters (exported in the Prometheus text
+format), the current session's breakdown, and optionally a JSON log.
+"""
+import contextvars
+import functools
+import http.server
+import json
+import os
+import tempfile
+import threading
+import time
+
+# USD per 1M prompt/completion tokens, and per minute of audio for Whisper
+MODEL_PRICES = {
+    "gpt-4": (30.00, 60.00),
+    "gpt-4-turbo": (10.00, 30.00),
+    "gpt-4o": (2.50, 10.00),
+    "gpt-4o-mini": (0.15, 0.60),
+    "gpt-3.5-turbo": (0.50, 1.50),
+}
+AUDIO_PRICE_PER_MINUTE = {"whisper-1": 0.006}
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 40.0, 80.0)
+
+current_record = contextvars.ContextVar("current_record", default=None)
+current_session = contextvars.ContextVar("current_session", default=None)
+_record_lock = threading.Lock()
+
+
+def estimate_cost(model, prompt_tokens=0, completion_tokens=0, audio_seconds=0.0):
+    """Estimates the USD cost of a call from MODEL_PRICES."""
+    if model in AUDIO_PRICE_PER_MINUTE:
+        return AUDIO_PRICE_PER_MINUTE[model] * audio_seconds / 60.0
+    # Dated snapshots (e.g. gpt-4o-2024-08-06) are priced like their base model
+    base = max((name for name in MODEL_PRICES if model.startswith(name)), key=len, default=None)
+    if base is None:
+        return 0.0
+    prompt_price, completion_price = MODEL_PRICES[base]
+    return (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1_000_000
+
+
+class StageRecord:
+    """Accumulates the measurements of one stage execution."""
+
+    __slots__ = ("stage", "started", "seconds", "calls", "errors", "retries",
+                 "prompt_tokens", "completion_tokens", "cost", "models")
+
+    def __init__(self, stage):
+        self.stage = stage
+        self.started = time.time()
+        self.seconds = 0.0
+        self.calls = 0
+        self.errors = 0
+        self.retries = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.cost = 0.0
+        self.models = set()
+
+    def as_dict(self):
+        return {
+            "stage": self.stage,
+            "started": round(self.started, 3),
+            "seconds": round(self.seconds, 4),
+            "calls": self.calls,
+            "errors": self.errors,
+            "retries": self.retries,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "cost_usd": round(self.cost, 6),
+            "models": sorted(self.models)
+        }
+
+
+def format_value(value):
+    """Formats a sample value without losing precision (ints exact, floats round-trip)."""
+    if isinstance(value, int):
+        return str(int(value))
+    return repr(float(value))
+
+
+class MetricsRegistry:
+    """Process-wide histograms and counters, labelled by stage."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.durations = {}
+        self.counters = {}
+
+    def observe(self, record):
+        with self._lock:
+            buckets, total, count = self.durations.get(record.stage, ([0] * len(LATENCY_BUCKETS), 0.0, 0))
+            buckets = [n + (record.seconds <= le) for n, le in zip(buckets, LATENCY_BUCKETS)]
+            self.durations[record.stage] = (buckets, total + record.seconds, count + 1)
+            for name, value in (
+                ("echo_med_api_calls_total", record.calls),
+                ("echo_med_api_errors_total", record.errors),
+                ("echo_med_api_retries_total", record.retries),
+                ("echo_med_prompt_tokens_total", record.prompt_tokens),
+                ("echo_med_completion_tokens_total", record.completion_tokens),
+                ("echo_med_cost_usd_total", record.cost),
+            ):
+                key = (name, record.stage)
+                self.counters[key] = self.counters.get(key, 0) + value
+
+    def render_prometheus(self):
+        """Renders all metrics in the Prometheus text exposition format."""
+        with self._lock:
+            lines = [
+                "# HELP echo_med_stage_duration_seconds Wall time of pipeline stages.",
+                "# TYPE echo_med_stage_duration_seconds histogram"
+            ]
+            for stage, (buckets, total, count) in sorted(self.durations.items()):
+                for le, n in zip(LATENCY_BUCKETS, buckets):
+                    lines.append(f'echo_med_stage_duration_seconds_bucket{{stage="{stage}",le="{le}"}} {n}')
+                lines.append(f'echo_med_stage_duration_seconds_bucket{{stage="{stage}",le="+Inf"}} {count}')
+                lines.append(f'echo_med_stage_duration_seconds_sum{{stage="{stage}"}} {format_value(total)}')
+                lines.append(f'echo_med_stage_duration_seconds_count{{stage="{stage}"}} {count}')
+            for name in sorted({name for name, _ in self.counters}):
+                lines.append(f"# TYPE {name} counter")
+                for (counter, stage), value in sorted(self.counters.items()):
+                    if counter == name:
+                        lines.append(f'{name}{{stage="{stage}"}} {format_value(value)}')
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+
+
+class SessionMetrics:
+    """Stage records of one user session, for the sidebar breakdown."""
+
+    def __init__(self, max_records=500):
+        self.records = []
+        self.max_records = max_records
+        self._lock = threading.Lock()
+
+    def add(self, record):
+        with self._lock:
+            self.records.append(record.as_dict())
+            del self.records[:-self.max_records]
+
+    def breakdown(self):
+        """Returns per-stage totals: {stage: {runs, seconds, tokens, retries, cost_usd}}."""
+        totals = {}
+        with self._lock:
+            for record in self.records:
+                stage = totals.setdefault(record["stage"], {"runs": 0, "seconds": 0.0, "tokens": 0, "retries": 0, "cost_usd": 0.0})
+                stage["runs"] += 1
+                stage["seconds"] += record["seconds"]
+                stage["tokens"] += record["prompt_tokens"] + record["completion_tokens"]
+                stage["retries"] += record["retries"]
+                stage["cost_usd"] += record["cost_usd"]
+        return totals
+
+
+def _export(record):
+    """Appends a record to the JSON log and rewrites the Prometheus textfile, if configured."""
+    log_path = os.getenv("ECHO_MED_METRICS_LOG")
+    if log_path:
+        with open(log_path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record.as_dict()) + "\n")
+
+    prom_path = os.getenv("ECHO_MED_METRICS_PROM")
+    if prom_path:
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(prom_path)), suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(REGISTRY.render_prometheus())
+        os.replace(tmp_path, prom_path)
+
+
+def instrument(stage):
+    """Decorator recording the wall time and API usage of a pipeline stage."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            # Nested instrumented calls are accounted to the outermost stage
+            if current_record.get() is not None:
+                return func(*args, **kwargs)
+            record = StageRecord(stage)
+            token = current_record.set(record)
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                record.seconds = time.perf_counter() - start
+                current_record.reset(token)
+                REGISTRY.observe(record)
+                session = current_session.get()
+                if session is not None:
+                    session.add(record)
+                try:
+                    _export(record)
+                except OSError:
+                    pass
+        return wrapper
+    return decorator
+
+
+def record_api_call(model, prompt_tokens=0, completion_tokens=0, retries=0, audio_seconds=0.0, error=False):
+    """Adds one OpenAI call to the stage currently running on this thread/context."""
+    record = current_record.get()
+    if record is None:
+        return
+    # A stage may fan out over several threads (e.g. transcription segments)
+    with _record_lock:
+        record.calls += 1
+        record.errors += bool(error)
+        record.retries += retries
+        record.prompt_tokens += prompt_tokens or 0
+        record.completion_tokens += completion_tokens or 0
+        record.cost += estimate_cost(model, prompt_tokens or 0, completion_tokens or 0, audio_seconds)
+        record.models.add(model)
+
+
+def start_http_exporter(port, host="0.0.0.0"):
+    """Serves REGISTRY on http://host:port/metrics from a daemon thread."""
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = REGISTRY.render_prometheus().encode("utf-8")
+            self.send_response(200 if self.path.startswith("/metrics") else 404)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,153 @@
+# -- coding: utf-8 --
+"""
+Per-stage model routing: the model, temperature and max_tokens of every LLM stage.
+
+A routing profile maps stage names to routes. The built-in profiles are
+"quality" (the strongest model for every stage, the app's original
+behaviour), "balanced" (small models for listing chief complaints and
+formatting the prescription, gpt-4 kept for the differential diagnosis) and
+"fast". A route may name an escalation model: when a response fails its
+stage's validation (e.g. the prescription is not a JSON object with a
+Medications list), the request is repeated once with that model.
+
+ECHO_MED_MODEL_ROUTING selects a built-in profile, or a JSON file that
+overrides some routes of a base profile:
+
+    {"base": "balanced", "stages": {"summary": {"model": "gpt-4", "escalate_to": null}}}
+"""
+import contextvars
+import json
+from dataclasses import dataclass
+
+# LLM stages, named as in the assessment and prescription jobs
+STAGES = (
+    "chief_complaints", "patient_data", "presenting_illness", "structured_data",
+    "differential_diagnosis", "summary", "prescription", "update_extraction"
+)
+
+
+@dataclass(frozen=True)
+class Route:
+    """How one stage calls the chat API."""
+    __slots__ = ("model", "temperature", "max_tokens", "escalate_to")
+    model: str
+    temperature: float
+    max_tokens: int
+    escalate_to: str
+
+    def request_args(self, model=None):
+        """Keyword arguments for chat.completions.create; model overrides the route's (for escalation)."""
+        args = {"model": model or self.model, "temperature": self.temperature}
+        if self.max_tokens:
+            args["max_tokens"] = self.max_tokens
+        return args
+
+
+def route(model, temperature=0.2, max_tokens=None, escalate_to=None):
+    return Route(model, temperature, max_tokens, escalate_to)
+
+
+PROFILES = {
+    "quality": {
+        "chief_complaints": route("gpt-4"),
+        "patient_data": route("gpt-4"),
+        "presenting_illness": route("gpt-4", 0.3, 1000),
+        "structured_data": route("gpt-4o"),
+        "differential_diagnosis": route("gpt-4"),
+        "summary": route("gpt-4"),
+        "prescription": route("gpt-4"),
+        "update_extraction": route("gpt-4"),
+    },
+    "balanced": {
+        "chief_complaints": route("gpt-4o-mini", max_tokens=400, escalate_to="gpt-4"),
+        "patient_data": route("gpt-4o", escalate_to="gpt-4"),
+        "presenting_illness": route("gpt-4o", 0.3, 1000, escalate_to="gpt-4"),
+        "structured_data": route("gpt-4o"),
+        "differential_diagnosis": route("gpt-4"),
+        "summary": route("gpt-4o", escalate_to="gpt-4"),
+        "prescription": route("gpt-4o-mini", max_tokens=800, escalate_to="gpt-4"),
+        "update_extraction": route("gpt-4o-mini"),
+    },
+    "fast": {
+        "chief_complaints": route("gpt-4o-mini", max_tokens=400, escalate_to="gpt-4o"),
+        "patient_data": route("gpt-4o-mini", escalate_to="gpt-4o"),
+        "presenting_illness": route("gpt-4o-mini", 0.3, 1000, escalate_to="gpt-4o"),
+        "structured_data": route("gpt-4o-mini", escalate_to="gpt-4o"),
+        "differential_diagnosis": route("gpt-4o", escalate_to="gpt-4"),
+        "summary": route("gpt-4o-mini", escalate_to="gpt-4o"),
+        "prescription": route("gpt-4o-mini", max_tokens=800, escalate_to="gpt-4o"),
+        "update_extraction": route("gpt-4o-mini"),
+    },
+}
+
+# Routing used instead of the configured one in this context (e.g. by benchmarks comparing profiles)
+active_routing = contextvars.ContextVar("active_routing", default=None)
+
+
+def load_routing(spec, overrides=None):
+    """
+    Returns {stage: Route} for a profile name or a JSON routing file.
+
+    Args:
+        spec (str): Built-in profile name, or path of a JSON file with an optional
+            "base" profile and "stages" overrides
+        overrides (dict): {stage: {field: value}} applied last
+
+    Raises:
+        ValueError: For an unknown profile or stage, or an invalid route
+    """
+    if spec in PROFILES:
+        base, stages = spec, {}
+    else:
+        try:
+            with open(spec, encoding="utf-8") as f:
+                config = json.load(f)
+        except OSError as e:
+            raise ValueError(f"Unknown routing profile or unreadable file {spec!r}: {e}")
+        base, stages = config.get("base", "quality"), config.get("stages", {})
+    if base not in PROFILES:
+        raise ValueError(f"Unknown routing profile {base!r}; choose one of {', '.join(PROFILES)}")
+
+    routing = dict(PROFILES[base])
+    for stage, fields in list(stages.items()) + list((overrides or {}).items()):
+        if stage not in STAGES:
+            raise ValueError(f"Unknown stage {stage!r} in model routing")
+        current = routing[stage]
+        try:
+            routing[stage] = Route(**{
+                "model": current.model, "temperature": current.temperature,
+                "max_tokens": current.max_tokens, "escalate_to": current.escalate_to, **fields
+            })
+        except TypeError as e:
+            raise ValueError(f"Invalid route for {stage}: {e}")
+    return routing
+
+
+def parse_json(content):
+    try:
+        return json.loads(content.strip())
+    except (json.JSONDecodeError, AttributeError):
+        return None
+
+
+def is_json_object_with(content, key, value_type):
+    data = parse_json(content)
+    return isinstance(data, dict) and isinstance(data.get(key), value_type)
+
+
+# Checks that a stage's response has the shape its parser needs; a failure triggers escalation
+VALIDATORS = {
+    "chief_complaints": lambda content: isinstance(parse_json(content), list),
+    "patient_data": lambda content: isinstance(parse_json(content), dict),
+    "presenting_illness": lambda content: bool(content and content.strip()),
+    "structured_data": lambda content: isinstance(parse_json(content), dict),
+    "differential_diagnosis": lambda content: is_json_object_with(content, "Differential Diagnosis", list),
+    "summary": lambda content: is_json_object_with(content, "Summary", str),
+    "prescription": lambda content: is_json_object_with(content, "Medications", list),
+}
+
+
+def is_valid_response(stage, content):
+    """Whether content passes the stage's validation (stages without one always pass)."""
+    validate = VALIDATORS.get(stage)
+    return validate is None or validate(content)
@@ -0,0 +1,44 @@
+# -- coding: utf-8 --
+"""
+Pooled OpenAI clients, one per API key.
+
+Each Streamlit session may enter its own key, so instead of setting the
+module-level openai.api_key (shared, and racy across sessions) the key is kept
+in a context variable and requests use a client built for that key. Clients
+keep their HTTP connections alive, so the five or six calls of an encounter
+reuse one TLS connection instead of handshaking for each.
+"""
+import contextvars
+
+# API key of the current session; worker threads inherit it through copy_context()
+current_api_key = contextvars.ContextVar("current_api_key", default=None)
+
+
+def build_client(api_key, max_connections=20, max_keepalive_connections=10, keepalive_expiry=120.0,
+                 connect_timeout=5.0, read_timeout=120.0):
+    """
+    Creates an OpenAI client with its own keep-alive connection pool.
+
+    Retries are left to the request scheduler (max_retries=0). The base URL
+    still comes from OPENAI_BASE_URL when set.
+    """
+    # Imported on the first API call rather than at app start (openai alone takes about a second)
+    import openai
+
+    # Use the config types of the HTTP library the installed openai is built on
+    # (httpx or httpx2); its own default limits tell us which Limits class that is
+    limits_type = type(openai.DEFAULT_CONNECTION_LIMITS)
+    timeout = openai.Timeout(read_timeout, connect=connect_timeout)
+    return openai.OpenAI(
+        api_key=api_key,
+        max_retries=0,
+        timeout=timeout,
+        http_client=openai.DefaultHttpxClient(
+            limits=limits_type(
+                max_connections=max_connections,
+                max_keepalive_connections=max_keepalive_connections,
+                keepalive_expiry=keepalive_expiry
+            ),
+            timeout=timeout
+        )
+    )
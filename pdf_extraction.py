@@ -0,0 +1,46 @@
+# -- coding: utf-8 --
+"""
+Page-parallel PDF text extraction.
+
+Kept free of Streamlit and app imports so it is cheap to load in the worker
+processes of a spawn-based process pool.
+"""
+import io
+
+import PyPDF2
+
+
+def page_count(pdf_bytes):
+    """Returns the number of pages in a PDF."""
+    return len(PyPDF2.PdfReader(io.BytesIO(pdf_bytes)).pages)
+
+
+def extract_page_range(pdf_bytes, start, stop):
+    """Extracts the text of pages [start, stop) of a PDF, one string per page."""
+    reader = PyPDF2.PdfReader(io.BytesIO(pdf_bytes))
+    return [reader.pages[i].extract_text() or "" for i in range(start, stop)]
+
+
+def iter_page_chunks(pdf_bytes, pages, executor=None, chunk_pages=8):
+    """
+    Yields the page texts of the first `pages` pages in order, a chunk at a time.
+
+    With an executor, chunks of chunk_pages pages are parsed concurrently in
+    its workers; results are still yielded in page order as soon as each
+    chunk and all chunks before it are done.
+    """
+    ranges = [(start, min(start + chunk_pages, pages)) for start in range(0, pages, chunk_pages)]
+    if executor is None or len(ranges) < 2:
+        # Parse the document once and walk it in-process
+        reader = PyPDF2.PdfReader(io.BytesIO(pdf_bytes))
+        for start, stop in ranges:
+            yield [reader.pages[i].extract_text() or "" for i in range(start, stop)]
+        return
+
+    futures = [executor.submit(extract_page_range, pdf_bytes, start, stop) for start, stop in ranges]
+    try:
+        for future in futures:
+            yield future.result()
+    finally:
+        for future in futures:
+            future.cancel()
@@ -0,0 +1,240 @@
+# -- coding: utf-8 --
+"""
+PDF rendering of prescriptions and Clinical Assessment reports.
+
+Paragraph and table styles are built once per process and reused by every
+document. The module has no Streamlit or app imports, so render_many can fan
+documents out to the workers of a spawn-based process pool cheaply.
+"""
+import functools
+import io
+from datetime import datetime
+from xml.sax.saxutils import escape
+
+from reportlab.lib import colors
+from reportlab.lib.pagesizes import letter
+from reportlab.lib.styles import ParagraphStyle, getSampleStyleSheet
+from reportlab.lib.units import inch
+from reportlab.platypus import ListFlowable, Paragraph, SimpleDocTemplate, Spacer, Table, TableStyle
+
+from ipd_form import IPDForm
+
+PRESCRIPTION_COLUMNS = ["Medicine Name", "Dosage", "Frequency", "Duration", "Special Instructions"]
+PRESCRIPTION_COL_WIDTHS = [2 * inch, 1.5 * inch, 1.5 * inch, 1.5 * inch, 2 * inch]
+
+MEDICATION_TABLE_STYLE = TableStyle([
+    ('BACKGROUND', (0, 0), (-1, 0), colors.grey),
+    ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
+    ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
+    ('FONTSIZE', (0, 0), (-1, 0), 12),
+    ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
+    ('BACKGROUND', (0, 1), (-1, -1), colors.white),
+    ('TEXTCOLOR', (0, 1), (-1, -1), colors.black),
+    ('FONTNAME', (0, 1), (-1, -1), 'Helvetica'),
+    ('FONTSIZE', (0, 1), (-1, -1), 10),
+    ('GRID', (0, 0), (-1, -1), 1, colors.black),
+    ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
+    ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
+])
+
+FIELD_TABLE_STYLE = TableStyle([
+    ('BACKGROUND', (0, 0), (0, -1), colors.whitesmoke),
+    ('GRID', (0, 0), (-1, -1), 0.5, colors.grey),
+    ('VALIGN', (0, 0), (-1, -1), 'TOP'),
+])
+
+HEADER_TABLE_STYLE = TableStyle([
+    ('BACKGROUND', (0, 0), (-1, 0), colors.grey),
+    ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
+    ('GRID', (0, 0), (-1, -1), 0.5, colors.grey),
+    ('VALIGN', (0, 0), (-1, -1), 'TOP'),
+])
+
+
+@functools.lru_cache(maxsize=None)
+def get_styles():
+    """Returns the paragraph styles shared by all documents (built once per process)."""
+    sample = getSampleStyleSheet()
+    return {
+        "header": ParagraphStyle('CustomHeader', parent=sample['Heading1'], fontSize=16, spaceAfter=30),
+        "date": ParagraphStyle('DateStyle', parent=sample['Normal'], fontSize=12, spaceAfter=20),
+        "signature": ParagraphStyle('SignatureStyle', parent=sample['Normal'], fontSize=12, spaceAfter=20),
+        "section": ParagraphStyle('SectionStyle', parent=sample['Heading2'], spaceBefore=12, spaceAfter=6),
+        "subsection": ParagraphStyle('SubsectionStyle', parent=sample['Heading3'], spaceBefore=6, spaceAfter=4),
+        "body": sample['Normal'],
+        "cell": ParagraphStyle('CellStyle', parent=sample['Normal'], fontSize=10, leading=12),
+        "cell_header": ParagraphStyle('CellHeaderStyle', parent=sample['Normal'], fontSize=9, leading=11,
+                                      fontName='Helvetica-Bold', textColor=colors.whitesmoke),
+    }
+
+
+def text(value):
+    """Escapes a value for use in Paragraph markup."""
+    if isinstance(value, list):
+        value = ", ".join(str(item) for item in value)
+    return escape(str(value))
+
+
+def has_content(value):
+    if isinstance(value, dict):
+        return any(has_content(v) for v in value.values())
+    if isinstance(value, list):
+        return any(has_content(v) for v in value)
+    return value is not None and str(value).strip() != ""
+
+
+def flatten_fields(data, prefix=""):
+    """Yields (label, value) pairs of a nested dict, skipping empty fields."""
+    for key, value in data.items():
+        label = f"{prefix} - {key}" if prefix else str(key)
+        if isinstance(value, dict):
+            yield from flatten_fields(value, label)
+        elif has_content(value):
+            yield label, value
+
+
+def field_table(rows):
+    """Renders (label, value) rows as a two-column table."""
+    styles = get_styles()
+    table = Table([[Paragraph(text(label), styles["cell"]), Paragraph(text(value), styles["cell"])] for label, value in rows],
+                  colWidths=[2.2 * inch, 4.8 * inch])
+    table.setStyle(FIELD_TABLE_STYLE)
+    return table
+
+
+def value_flowables(value):
+    """Renders any extracted value: text, bullet lists, field tables or row tables."""
+    styles = get_styles()
+    if isinstance(value, dict):
+        rows = list(flatten_fields(value))
+        return [field_table(rows)] if rows else []
+    if isinstance(value, list):
+        items = [item for item in value if has_content(item)]
+        if items and all(isinstance(item, dict) for item in items):
+            columns = list(dict.fromkeys(key for item in items for key in item))
+            rows = [[Paragraph(text(c), styles["cell_header"]) for c in columns]]
+            rows += [[Paragraph(text(item.get(c, "")), styles["cell"]) for c in columns] for item in items]
+            table = Table(rows, colWidths=[7 * inch / len(columns)] * len(columns))
+            table.setStyle(HEADER_TABLE_STYLE)
+            return [table]
+        if not items:
+            return []
+        return [ListFlowable([Paragraph(text(item), styles["body"]) for item in items], bulletType='bullet')]
+    if not has_content(value):
+        return []
+    return [Paragraph(text(line), styles["body"]) for line in str(value).split("\n") if line.strip()]
+
+
+def build_pdf(elements):
+    buffer = io.BytesIO()
+    SimpleDocTemplate(buffer, pagesize=letter).build(elements)
+    return buffer.getvalue()
+
+
+def render_prescription(prescription_data, doctor_name):
+    """Renders a prescription (as returned by generate_prescription) and returns the PDF bytes."""
+    styles = get_styles()
+    elements = [
+        Paragraph("MEDICAL PRESCRIPTION", styles["header"]),
+        Spacer(1, 20),
+        Paragraph(f"Date: {text(prescription_data['Date'])}", styles["date"]),
+        Paragraph(f"Doctor: {text(doctor_name)}", styles["date"]),
+        Spacer(1, 20)
+    ]
+
+    data = [PRESCRIPTION_COLUMNS]
+    for med in prescription_data['Medications']:
+        data.append([med[column] for column in PRESCRIPTION_COLUMNS])
+    table = Table(data, colWidths=PRESCRIPTION_COL_WIDTHS)
+    table.setStyle(MEDICATION_TABLE_STYLE)
+    elements += [table, Spacer(1, 30)]
+
+    elements.append(Paragraph("Doctor's Signature: _________________", styles["signature"]))
+    elements.append(Paragraph(f"Dr. {text(doctor_name)}", styles["signature"]))
+    return build_pdf(elements)
+
+
+def render_assessment_report(results, doctor_name=""):
+    """
+    Renders a Clinical Assessment report and returns the PDF bytes.
+
+    Args:
+        results (dict): Stage results keyed by stage name (chief_complaints,
+            patient_data, presenting_illness, differential_diagnosis, summary)
+        doctor_name (str): Optional assessing doctor
+    """
+    styles = get_styles()
+    elements = [
+        Paragraph("CLINICAL ASSESSMENT REPORT", styles["header"]),
+        Paragraph(f"Date: {datetime.now().strftime('%Y-%m-%d')}", styles["date"])
+    ]
+    if doctor_name:
+        elements.append(Paragraph(f"Doctor: {text(doctor_name)}", styles["date"]))
+
+    summary = results.get("summary") or {}
+    if isinstance(summary, dict) and has_content(summary.get("Summary")):
+        elements.append(Paragraph("Summary", styles["section"]))
+        elements += value_flowables(summary.get("Summary"))
+        for key, title in (("KeyFindings", "Key Findings"), ("NextSteps", "Next Steps")):
+            if has_content(summary.get(key)):
+                elements.append(Paragraph(title, styles["subsection"]))
+                elements += value_flowables(summary[key])
+
+    for stage, title in (("chief_complaints", "Chief Complaints"), ("presenting_illness", "History of Presenting Illness")):
+        result = results.get(stage)
+        if has_content(result) and not (isinstance(result, dict) and "Error" in result):
+            elements.append(Paragraph(title, styles["section"]))
+            elements += value_flowables(result)
+
+    patient_data = results.get("patient_data") or {}
+    if isinstance(patient_data, IPDForm):
+        sections = [(section, [(f.label, f.value) for f in fields if f.value]) for section, fields in patient_data.sections]
+        if any(rows for _, rows in sections):
+            elements.append(Paragraph("Patient Data", styles["section"]))
+        for section, rows in sections:
+            if rows:
+                elements.append(Paragraph(text(section), styles["subsection"]))
+                elements.append(field_table(rows))
+    elif isinstance(patient_data, dict) and "Error" not in patient_data and has_content(patient_data):
+        elements.append(Paragraph("Patient Data", styles["section"]))
+        for section, details in patient_data.items():
+            if has_content(details):
+                elements.append(Paragraph(text(section), styles["subsection"]))
+                elements += value_flowables(details)
+
+    diagnosis = results.get("differential_diagnosis") or {}
+    if isinstance(diagnosis, dict) and has_content(diagnosis.get("Differential Diagnosis")):
+        elements.append(Paragraph("Differential Diagnosis", styles["section"]))
+        elements += value_flowables(diagnosis["Differential Diagnosis"])
+        for title, items in (diagnosis.get("Recommendations") or {}).items():
+            if has_content(items):
+                elements.append(Paragraph(text(title), styles["subsection"]))
+                elements += value_flowables(items)
+    return build_pdf(elements)
+
+
+RENDERERS = {
+    "prescription": render_prescription,
+    "assessment": render_assessment_report,
+}
+
+
+def render_document(document):
+    """Renders a (kind, args) document spec; module-level so process pools can pickle it."""
+    kind, args = document
+    return RENDERERS[kind](*args)
+
+
+def render_many(documents, executor=None, chunksize=4):
+    """
+    Renders (kind, args) documents, yielding each PDF's bytes in input order.
+
+    With an executor (ideally a process pool) documents are rendered in its
+    workers concurrently, and each is yielded as soon as it and all documents
+    before it are done.
+    """
+    if executor is None:
+        for document in documents:
+            yield render_document(document)
+        return
+    yield from executor.map(render_document, documents, chunksize=chunksize)
@@ -0,0 +1,107 @@
+# -- coding: utf-8 --
+"""
+Token-budgeted prompt building.
+
+Stage results are embedded in later prompts (patient data in the differential
+diagnosis, everything in the summary). Serialized with indent=2 and full of
+empty IPD fields they cost far more input tokens than the information they
+carry. This module prunes empty/unknown values, serializes compactly and, when
+a stage's budget is still exceeded, truncates the least important sections
+first. Before/after token counts are logged per stage.
+"""
+import json
+import logging
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+logger = logging.getLogger("echo_med.prompts")
+
+# Placeholder answers the model gives for fields the conversation did not cover
+UNKNOWN_VALUES = frozenset(["", "unknown", "n/a", "na", "not mentioned", "not specified", "not available", "not provided"])
+
+TRUNCATION_MARK = " [truncated]"
+
+_encoding = None
+
+
+def approx_tokens(text):
+    """Rough token count (about four characters per token for English)."""
+    return len(text) // 4
+
+
+def count_tokens(text):
+    """Counts tokens with tiktoken when installed, otherwise estimates them."""
+    global _encoding
+    if tiktoken is None:
+        return approx_tokens(text)
+    if _encoding is None:
+        _encoding = tiktoken.get_encoding("cl100k_base")
+    return len(_encoding.encode(text, disallowed_special=()))
+
+
+def prune_empty(value):
+    """Recursively drops None, empty containers and placeholder strings; returns None if nothing is left."""
+    if isinstance(value, dict):
+        pruned = {k: v for k, v in ((k, prune_empty(v)) for k, v in value.items()) if v is not None}
+        return pruned or None
+    if isinstance(value, list):
+        pruned = [v for v in (prune_empty(v) for v in value) if v is not None]
+        return pruned or None
+    if isinstance(value, str):
+        value = value.strip()
+        return None if value.lower() in UNKNOWN_VALUES else value
+    return value
+
+
+def compact_json(value):
+    """Serializes without indentation or padding; keeps non-ASCII text as is."""
+    return json.dumps(value, separators=(",", ":"), ensure_ascii=False)
+
+
+def truncate_to_tokens(text, max_tokens):
+    """Cuts text to roughly max_tokens tokens, marking the cut."""
+    if max_tokens <= 0:
+        return ""
+    if count_tokens(text) <= max_tokens:
+        return text
+    # Shrink by the measured ratio until it fits (one or two passes in practice)
+    while text and count_tokens(text + TRUNCATION_MARK) > max_tokens:
+        text = text[:int(len(text) * max_tokens / count_tokens(text + TRUNCATION_MARK)) - 1]
+    return text + TRUNCATION_MARK if text else ""
+
+
+def render_sections(stage, sections, token_budget):
+    """
+    Serializes prompt sections within a token budget.
+
+    Args:
+        stage (str): Stage name, for logging
+        sections (list): (label, value, priority) tuples; lower priority numbers
+            are more important and keep their text when the budget is tight
+        token_budget (int): Approximate maximum tokens of all sections together
+
+    Returns:
+        dict: label -> serialized text (empty if the section had no content)
+    """
+    before = 0
+    rendered = {}
+    for label, value, _ in sections:
+        before += count_tokens(json.dumps(value, indent=2))
+        value = prune_empty(value)
+        if value is None:
+            rendered[label] = ""
+        else:
+            rendered[label] = value if isinstance(value, str) else compact_json(value)
+
+    # Most important sections claim their share of the budget first
+    remaining = token_budget
+    for label, _, _ in sorted(sections, key=lambda section: section[2]):
+        rendered[label] = truncate_to_tokens(rendered[label], remaining)
+        remaining -= count_tokens(rendered[label])
+
+    after = sum(count_tokens(text) for text in rendered.values())
+    logger.info("%s prompt context: %d -> %d tokens (budget %d)", stage, before, after, token_budget)
+    return rendered
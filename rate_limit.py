@@ -0,0 +1,196 @@
+# -- coding: utf-8 --
+"""
+Process-wide scheduling of OpenAI requests.
+
+All clinicians share one organisation key, so every request goes through a
+single RequestScheduler: per-model token buckets keep requests/min and
+tokens/min under the account limits, at most max_concurrent requests are in
+flight, waiting requests are served by priority (interactive sessions before
+batch work) and rate-limited or failed requests are retried with jittered
+exponential backoff that honours Retry-After.
+"""
+import contextvars
+import heapq
+import itertools
+import random
+import threading
+import time
+
+INTERACTIVE = 0
+BATCH = 10
+
+# Priority of requests made from the current thread/context
+request_priority = contextvars.ContextVar("request_priority", default=INTERACTIVE)
+
+
+def retryable_errors():
+    """The OpenAI errors worth retrying; openai is imported on first use as it takes about a second."""
+    import openai
+    return (openai.RateLimitError, openai.APITimeoutError, openai.APIConnectionError, openai.InternalServerError)
+
+
+class TokenBucket:
+    """Refills continuously at per_minute units per minute, up to per_minute units."""
+
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, amount, now):
+        """Seconds until amount units are available (requests larger than the bucket wait for a full one)."""
+        self._refill(now)
+        return max(0.0, (min(amount, self.capacity) - self.level) / self.rate)
+
+    def take(self, amount):
+        self.level -= amount
+
+    def pause(self, seconds, now):
+        """Empties the bucket so nothing is taken for the next seconds."""
+        self._refill(now)
+        self.level = min(self.level, -seconds * self.rate)
+
+
+def retry_after(error):
+    """Returns the server's requested delay in seconds, if the error carries one."""
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    try:
+        if response.headers.get("retry-after-ms"):
+            return float(response.headers["retry-after-ms"]) / 1000
+        if response.headers.get("retry-after"):
+            return float(response.headers["retry-after"])
+    except ValueError:
+        pass
+    return None
+
+
+class RequestScheduler:
+    """Admits, limits and retries OpenAI requests for the whole process."""
+
+    def __init__(self, requests_per_minute=500, tokens_per_minute=30000, max_concurrent=8,
+                 max_retries=6, base_delay=1.0, max_delay=60.0):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.max_concurrent = max_concurrent
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._cond = threading.Condition()
+        # One queue per model: a request waiting for its model's buckets does not hold up other models
+        self._waiting = {}
+        self._tickets = itertools.count()
+        self._active = 0
+        self._buckets = {}
+
+    def _buckets_for(self, model):
+        if model not in self._buckets:
+            self._buckets[model] = (TokenBucket(self.requests_per_minute), TokenBucket(self.tokens_per_minute))
+        return self._buckets[model]
+
+    def _delay(self, model, tokens, now):
+        """Seconds until model's buckets allow a request of tokens."""
+        requests, token_bucket = self._buckets_for(model)
+        return max(requests.delay(1, now), token_bucket.delay(tokens, now))
+
+    def _outranked(self, model, ticket, now):
+        """True if another model's first request comes before ticket and could start now."""
+        for other, queue in self._waiting.items():
+            if other != model and queue and queue[0] < ticket and self._delay(other, queue[0][2], now) <= 0:
+                return True
+        return False
+
+    def _acquire(self, model, tokens, priority):
+        """
+        Blocks until this request is first in its model's line, a slot is free and the model's buckets allow it.
+
+        Free slots go to the ready request with the best priority across models.
+        """
+        with self._cond:
+            queue = self._waiting.setdefault(model, [])
+            ticket = (priority, next(self._tickets), tokens)
+            heapq.heappush(queue, ticket)
+            try:
+                while True:
+                    if queue[0] != ticket:
+                        self._cond.wait()
+                        continue
+                    now = time.monotonic()
+                    delay = self._delay(model, tokens, now)
+                    if delay > 0:
+                        self._cond.wait(delay)
+                    elif self._active >= self.max_concurrent or self._outranked(model, ticket, now):
+                        self._cond.wait()
+                    else:
+                        heapq.heappop(queue)
+                        requests, token_bucket = self._buckets_for(model)
+                        requests.take(1)
+                        token_bucket.take(tokens)
+                        self._active += 1
+                        self._cond.notify_all()
+                        return
+            except BaseException:
+                queue.remove(ticket)
+                heapq.heapify(queue)
+                self._cond.notify_all()
+                raise
+
+    def _release(self):
+        with self._cond:
+            self._active -= 1
+            self._cond.notify_all()
+
+    def settle(self, model, estimated_tokens, actual_tokens):
+        """Corrects the tokens/min bucket once a request's real usage is known."""
+        with self._cond:
+            self._buckets_for(model)[1].take(actual_tokens - estimated_tokens)
+            self._cond.notify_all()
+
+    def backoff(self, attempt, error):
+        """Delay before retry number attempt: Retry-After if given, else jittered exponential."""
+        delay = retry_after(error)
+        if delay is None:
+            delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        return min(self.max_delay, delay)
+
+    def run(self, func, model, tokens=0, priority=None):
+        """
+        Calls func once admitted, retrying transient failures.
+
+        Args:
+            func (callable): Makes the request; the slot is held until it returns
+            model (str): Model the request is for (limits are per model)
+            tokens (int): Estimated prompt + completion tokens of the request
+            priority (int): Lower runs first; defaults to request_priority
+
+        Returns:
+            tuple: (func's result, number of retries)
+        """
+        if priority is None:
+            priority = request_priority.get()
+        import openai
+        retryable = retryable_errors()
+        attempt = 0
+        while True:
+            self._acquire(model, tokens, priority)
+            try:
+                return func(), attempt
+            except retryable as e:
+                # An exhausted quota will not recover by waiting
+                if attempt >= self.max_retries or getattr(e, "code", None) == "insufficient_quota":
+                    raise
+                delay = self.backoff(attempt, e)
+                if isinstance(e, openai.RateLimitError):
+                    # The limit is shared: hold back every request for this model, not just this one
+                    with self._cond:
+                        self._buckets_for(model)[0].pause(delay, time.monotonic())
+            finally:
+                self._release()
+            attempt += 1
+            time.sleep(delay)
@@ -0,0 +1,19 @@
+from ipd_form import IPDForm
+
+
+def test_object_under_top_level_field_is_flattened():
+    form = IPDForm.parse({"Chief Complaints": {"Chest pain": "2 days"}})
+    assert form.get("Chief Complaints") == "Chest pain: 2 days"
+    assert form.to_dict()["Chief Complaints"] == "Chest pain: 2 days"
+
+
+def test_object_under_section_field_is_flattened():
+    form = IPDForm.parse({"Allergies": {"Details": {"drug": "penicillin"}}})
+    assert form.get("Allergies", "Details") == "drug: penicillin"
+    assert not any(len(field.path) > 2 for field in form.fields if field.section == "Allergies")
+
+
+def test_extra_fields_are_kept():
+    form = IPDForm.parse({"Allergies": {"Food": "peanuts"}, "Notes": {"Ward": "3B"}})
+    assert form.get("Allergies", "Food") == "peanuts"
+    assert form.to_dict()["Notes"] == {"Ward": "3B"}
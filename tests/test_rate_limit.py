@@ -0,0 +1,42 @@
+import threading
+import time
+
+from rate_limit import RequestScheduler
+
+
+def test_model_waiting_for_tokens_does_not_block_other_models():
+    scheduler = RequestScheduler(tokens_per_minute=600, max_concurrent=4)
+    # Drain gpt-4's tokens/min bucket so its next request waits about a minute
+    scheduler.run(lambda: None, "gpt-4", tokens=600)
+    waiter = threading.Thread(target=scheduler.run, args=(lambda: None, "gpt-4"), kwargs={"tokens": 600}, daemon=True)
+    waiter.start()
+    time.sleep(0.1)
+
+    start = time.monotonic()
+    result, retries = scheduler.run(lambda: "transcribed", "whisper-1", tokens=10)
+    assert (result, retries) == ("transcribed", 0)
+    assert time.monotonic() - start < 1.0
+    assert waiter.is_alive()
+
+
+def test_free_slot_goes_to_best_priority_across_models():
+    scheduler = RequestScheduler(max_concurrent=1)
+    release = threading.Event()
+    order = []
+    holder = threading.Thread(target=scheduler.run, args=(release.wait, "gpt-4o"), daemon=True)
+    holder.start()
+    time.sleep(0.1)
+
+    threads = [
+        threading.Thread(target=scheduler.run, args=(lambda: order.append("batch"), "gpt-4o-mini"),
+                         kwargs={"priority": 10}, daemon=True),
+        threading.Thread(target=scheduler.run, args=(lambda: order.append("interactive"), "gpt-4"),
+                         kwargs={"priority": 0}, daemon=True),
+    ]
+    for thread in threads:
+        thread.start()
+        time.sleep(0.05)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    assert order == ["interactive", "batch"]
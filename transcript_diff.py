@@ -0,0 +1,51 @@
+# -- coding: utf-8 --
+"""
+Word-level differences between two versions of a transcript.
+
+Used to re-assess an edited or extended transcript by sending the model only
+what changed (with a little surrounding context) instead of the whole text.
+"""
+import difflib
+
+
+def transcript_changes(old_text, new_text, context_words=8):
+    """
+    Returns the edits that turn old_text into new_text.
+
+    Returns:
+        tuple: (changes, changed_fraction). Each change is a dict with "kind"
+        ("replace", "insert", "delete" or "append"), the "before" and "after"
+        words and the new text around it as "context". changed_fraction is the
+        share of words touched, relative to the longer version.
+    """
+    old_words, new_words = old_text.split(), new_text.split()
+    matcher = difflib.SequenceMatcher(None, old_words, new_words, autojunk=False)
+    changes = []
+    touched = 0
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == "equal":
+            continue
+        touched += max(i2 - i1, j2 - j1)
+        kind = "append" if tag == "insert" and i1 == len(old_words) else tag
+        changes.append({
+            "kind": kind,
+            "before": " ".join(old_words[i1:i2]),
+            "after": " ".join(new_words[j1:j2]),
+            "context": " ".join(new_words[max(0, j1 - context_words):j2 + context_words])
+        })
+    return changes, touched / max(len(old_words), len(new_words), 1)
+
+
+def format_changes(changes):
+    """Describes changes as prompt text, one line per edit."""
+    lines = []
+    for change in changes:
+        if change["kind"] == "append":
+            lines.append(f'Added at the end: "{change["after"]}"')
+        elif change["kind"] == "insert":
+            lines.append(f'Inserted "{change["after"]}" in: "...{change["context"]}..."')
+        elif change["kind"] == "delete":
+            lines.append(f'Removed "{change["before"]}" near: "...{change["context"]}..."')
+        else:
+            lines.append(f'Changed "{change["before"]}" to "{change["after"]}" in: "...{change["context"]}..."')
+    return "\n".join(lines)